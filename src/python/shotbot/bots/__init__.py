@@ -1,7 +1,8 @@
 """Task-specific workers."""
 from .commenter import Commenter, QuoteCommenter
 from .renderer import Renderer, CommentContextRenderer
-from .watcher import Watcher
+from .uploader import Uploader
+from .watcher import MultiWatcher, Watcher
 
 __all__ = ('Commenter', 'Renderer', 'Watcher', 'QuoteCommenter',
-           'CommentContextRenderer')
+           'CommentContextRenderer', 'MultiWatcher', 'Uploader')
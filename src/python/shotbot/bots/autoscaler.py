@@ -0,0 +1,278 @@
+"""Scales renderers with the backlog of submissions awaiting screenshots."""
+import datetime
+import logging
+import os
+import time
+from threading import Event, Thread
+
+from sqlalchemy.sql import and_, func, or_, select
+
+from ..exceptions import RendererException
+from ..utils import connect_db, needs_screenshot, release_connection
+
+__all__ = ('Autoscaler', 'RendererThreads')
+
+log = logging.getLogger(__name__)
+
+
+class RendererThreads():
+    """A resizable group of renderer threads, sharing a pool of browsers."""
+
+    def __init__(self, factory, driver_pool, new_submissions):
+        """
+        Create a new RendererThreads.
+
+        :param callable factory: makes a renderer, given the event that
+        stops it
+        :param DriverPool driver_pool: resized along with the group
+        :param Event new_submissions: set to wake renderers being stopped
+        """
+        self._factory = factory
+        self.driver_pool = driver_pool
+        self._new_submissions = new_submissions
+        self._running = []
+        self._stopped = []
+
+    def __repr__(self):
+        return '<{cls}({size} renderers, {pool!r})>'.format(
+            cls=self.__class__.__name__,
+            size=self.size,
+            pool=self.driver_pool)
+
+    @property
+    def size(self):
+        """Number of renderers running."""
+        return len(self._running)
+
+    @property
+    def renderers(self):
+        """The running renderers."""
+        return [renderer for renderer, _, _ in self._running]
+
+    def resize(self, size):
+        """
+        Start or stop renderers until `size` are running.
+
+        Stopped renderers finish the submissions they've claimed first.
+
+        :param int size: number of renderers to run
+        :raises RendererException: if a renderer thread has died
+        """
+        for renderer, thread, _ in self._running:
+            if not thread.is_alive():
+                raise RendererException("{} died".format(thread.name))
+        if size > self.size:
+            self.driver_pool.resize(size)
+        while self.size < size:
+            stop = Event()
+            renderer = self._factory(stop)
+            thread = Thread(name='renderer-{}'.format(id(stop)),
+                            target=renderer.run)
+            thread.start()
+            self._running.append((renderer, thread, stop))
+        if self.size > size:
+            while self.size > size:
+                _, thread, stop = self._running.pop()
+                stop.set()
+                self._stopped.append(thread)
+            self._new_submissions.set()
+            self.driver_pool.resize(size)
+        self._stopped = [
+            thread for thread in self._stopped if thread.is_alive()
+        ]
+
+    def stop(self):
+        """Stop every renderer, waiting for them to finish."""
+        for _, thread, stop in self._running:
+            stop.set()
+            self._stopped.append(thread)
+        self._running = []
+        self._new_submissions.set()
+        for thread in self._stopped:
+            thread.join()
+        self._stopped = []
+
+
+class Autoscaler():
+    """
+    Starts renderers as the backlog grows and stops them as it shrinks.
+
+    The backlog is measured by the number of submissions awaiting
+    screenshots and the age of the oldest. Renderers are added one at a time
+    while either is over its threshold, and there's memory to spare, and
+    removed one at a time once the backlog has stayed small for a while; the
+    gap between the thresholds keeps the count from flapping.
+    """
+
+    INTERVAL = 30
+    """Seconds between checks of the backlog."""
+
+    SCALE_UP_BACKLOG = 10
+    """Default submissions per renderer awaiting screenshots to scale up at."""
+
+    SCALE_DOWN_BACKLOG = 2
+    """Default submissions per renderer awaiting screenshots to scale down
+    below."""
+
+    SCALE_UP_AGE = datetime.timedelta(minutes=10)
+    """Default age of the oldest submission awaiting a screenshot to scale up
+    at."""
+
+    SCALE_UP_COOLDOWN = datetime.timedelta(minutes=1)
+    """Default least time between adding renderers."""
+
+    SCALE_DOWN_AFTER = datetime.timedelta(minutes=10)
+    """Default time the backlog must stay small before removing a renderer."""
+
+    MEMINFO_PATH = '/proc/meminfo'
+    """Where Linux reports memory available, page cache included."""
+
+    def __init__(self,
+                 db,
+                 target,
+                 kill_switch,
+                 min_size=1,
+                 max_size=None,
+                 scale_up_backlog=SCALE_UP_BACKLOG,
+                 scale_down_backlog=SCALE_DOWN_BACKLOG,
+                 scale_up_age=SCALE_UP_AGE,
+                 scale_up_cooldown=SCALE_UP_COOLDOWN,
+                 scale_down_after=SCALE_DOWN_AFTER,
+                 min_free_memory=None):
+        """
+        Create a new Autoscaler.
+
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
+        :param target: renderers to scale; anything with a `size` and a
+        `resize(size)` method, e.g. :class:`RendererThreads` or
+        :class:`RendererSupervisor`
+        :param Event kill_switch: when set, breaks the loop in :meth:`run`
+        :param int min_size: fewest renderers to run
+        :param max_size: most renderers to run; defaults to the number of CPUs
+        :type max_size: int or None
+        :param float scale_up_backlog: submissions per renderer awaiting
+        screenshots at which to add a renderer
+        :param float scale_down_backlog: submissions per renderer awaiting
+        screenshots below which to remove one
+        :param timedelta scale_up_age: age of the oldest submission awaiting a
+        screenshot at which to add a renderer
+        :param timedelta scale_up_cooldown: least time between adding
+        renderers
+        :param timedelta scale_down_after: time the backlog must stay small
+        before removing a renderer
+        :param min_free_memory: MiB of memory that must be free to add a
+        renderer; None for no limit
+        :type min_free_memory: int or None
+        """
+        self._db = connect_db(db)
+        self.target = target
+        self._kill = kill_switch
+        self.min_size = min_size
+        self.max_size = max(max_size or os.cpu_count(), min_size)
+        self.scale_up_backlog = scale_up_backlog
+        self.scale_down_backlog = scale_down_backlog
+        self.scale_up_age = scale_up_age.total_seconds()
+        self.scale_up_cooldown = scale_up_cooldown.total_seconds()
+        self.scale_down_after = scale_down_after.total_seconds()
+        self.min_free_memory = min_free_memory
+        self._scaled_up_at = 0
+        self._calm_since = None
+
+    def __repr__(self):
+        return '<{cls}({target!r}, {min_size}-{max_size})>'.format(
+            cls=self.__class__.__name__,
+            target=self.target,
+            min_size=self.min_size,
+            max_size=self.max_size)
+
+    def run(self):
+        """Scale renderers until killed."""
+        log.debug("%r running", self)
+        self.target.resize(
+            min(max(self.target.size, self.min_size), self.max_size))
+        while not self._kill.wait(self.INTERVAL):
+            backlog, oldest_age = self._measure_backlog()
+            size = self.target.size
+            desired = self._desired_size(size, backlog, oldest_age,
+                                         time.time())
+            if desired != size:
+                log.info(
+                    "scaling renderers from %d to %d; %d submissions "
+                    "awaiting screenshots, oldest %ds old", size, desired,
+                    backlog, oldest_age)
+            self.target.resize(desired)
+
+    def _measure_backlog(self):
+        """
+        :returns: number of submissions awaiting screenshots, and the age of
+        the oldest in seconds
+        :rtype: tuple[int, float]
+        """
+        db = self._db
+        try:
+            col = db['submissions'].table.columns
+            # submissions deferred by a circuit breaker or the uploader, or
+            # backing off after failing, aren't waiting on us; nor are those
+            # that have failed too often to try again
+            not_deferred = or_(
+                col.bot_screenshot_lock == None,  # noqa
+                col.bot_screenshot_lock <= datetime.datetime.utcnow(),
+                and_(col.bot_screenshot_worker != None,  # noqa
+                     or_(col.bot_screenshot_failures == None,  # noqa
+                         col.bot_screenshot_failures == 0)))
+            query = select([func.count(col.id),
+                            func.min(col.created_utc)]).where(
+                                and_(needs_screenshot(col), not_deferred))
+            count, oldest = db.executable.execute(query).fetchone()
+        finally:
+            release_connection(db)
+        return count, time.time() - oldest if oldest else 0
+
+    def _desired_size(self, size, backlog, oldest_age, now):
+        per_renderer = backlog / max(size, 1)
+        if (per_renderer >= self.scale_up_backlog
+                or oldest_age >= self.scale_up_age):
+            self._calm_since = None
+            if (size >= self.max_size
+                    or now - self._scaled_up_at < self.scale_up_cooldown):
+                return size
+            free_memory = self._free_memory()
+            if (self.min_free_memory is not None and free_memory is not None
+                    and free_memory < self.min_free_memory):
+                log.warning(
+                    "not adding a renderer; only %dMiB of memory free",
+                    free_memory)
+                return size
+            self._scaled_up_at = now
+            return size + 1
+        if per_renderer < self.scale_down_backlog and size > self.min_size:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.scale_down_after:
+                self._calm_since = now
+                return size - 1
+            return size
+        self._calm_since = None
+        return size
+
+    @classmethod
+    def _free_memory(cls):
+        """
+        :returns: MiB of memory available to new renderers, counting page
+        cache the OS can reclaim where it says how much, or None if unknown
+        :rtype: int or None
+        """
+        try:
+            with open(cls.MEMINFO_PATH) as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) // 1024
+        except (OSError, ValueError):
+            log.debug("can't read %s", cls.MEMINFO_PATH, exc_info=True)
+        try:
+            pages = os.sysconf('SC_AVPHYS_PAGES')
+            page_size = os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, OSError, ValueError):
+            return None
+        return pages * page_size // (1024 * 1024)
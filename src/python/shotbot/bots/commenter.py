@@ -2,13 +2,13 @@
 import datetime
 import logging
 
-import dataset
 import praw
 from jinja2 import Environment, PackageLoader
 
 from ..exceptions import CommenterException
-from ..utils import (base36_decode, comment_id_from_url, is_comment_url,
-                     load_submission_for_dict, markdown_escape, markdown_quote)
+from ..utils import (base36_decode, comment_id_from_url, connect_db,
+                     is_comment_url, load_submission_for_dict, markdown_escape,
+                     markdown_quote, release_connection)
 
 __all__ = ('Commenter', )
 
@@ -18,22 +18,38 @@ log = logging.getLogger(__name__)
 class Commenter():
     """Comments on submissions with screenshot and quote."""
 
-    def __init__(self, reddit_args, db_uri, kill_switch, dry_run=True):
+    POLL_INTERVAL = 1
+    """Seconds between checks for screenshots to comment with."""
+
+    NOTIFIED_POLL_INTERVAL = 60
+    """Most seconds between checks, when woken by new screenshots."""
+
+    def __init__(self,
+                 reddit_args,
+                 db,
+                 kill_switch,
+                 dry_run=True,
+                 new_screenshots=None):
         """
         Create a new Commenter.
 
         :param reddit_args: dict of arguments to pass to :class:`Reddit`
         :type reddit_args: dict[str, str]
-        :param str db_uri: SQLAlchemy-style DB URI
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
         :param Event kill_switch: when set, breaks the loop in :meth:`run`,
         and prevents :meth:`_process_submissions` from processing submissions
         :param bool dry_run: if True, doesn't post comments, just logs them
+        :param Event new_screenshots: if given, wakes the commenter as soon as
+        it's set, so it can poll the DB far less often; it must also be set
+        when the kill switch is thrown
         """
         self._reddit = praw.Reddit(**reddit_args)
-        self._db_uri = db_uri
+        self._db = connect_db(db)
         self._kill = kill_switch
         self._jinja = self._create_jinja_env()
         self.dry_run = dry_run
+        self._new_screenshots = new_screenshots
 
     @staticmethod
     def _create_jinja_env():
@@ -46,20 +62,29 @@ class Commenter():
     def __repr__(self):
         return '<{cls}({db_uri}, /u/{reddit_user})>'.format(
             cls=self.__class__.__name__,
-            db_uri=self._db_uri,
+            db_uri=self._db.url,
             reddit_user=self._reddit.config.username)
 
     def run(self):
         """Consume and comment on submissions until killed."""
         log.debug("%r running", self)
         while True:
+            if self._new_screenshots is not None:
+                # clear before looking, so nothing committed since is missed
+                self._new_screenshots.clear()
             self._process_submissions()
-            self._kill.wait(1)
+            self._wait_for_screenshots()
             if self._kill.is_set():
                 break
 
+    def _wait_for_screenshots(self):
+        if self._new_screenshots is None:
+            self._kill.wait(self.POLL_INTERVAL)
+        else:
+            self._new_screenshots.wait(self.NOTIFIED_POLL_INTERVAL)
+
     def _process_submissions(self):
-        db = dataset.connect(self._db_uri)
+        db = self._db
         try:
             submissions = db['submissions']
             for submission in submissions.find(
@@ -71,9 +96,7 @@ class Commenter():
                 self._process_submission(submissions, submission)
                 db.commit()
         finally:
-            if hasattr(db.local, 'conn'):
-                db.local.conn.close()
-            db.engine.dispose()
+            release_connection(db)
 
     def _process_submission(self, submissions, submission):
         commented_at = self.comment(submission)
@@ -1,25 +1,43 @@
 """Renders screenshots."""
 import datetime
+import json
 import logging
 import os
-from tempfile import NamedTemporaryFile
-from threading import Lock
+import platform
+import shutil
+import socket
+import subprocess
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
+from threading import Condition, RLock
 from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
-import dataset
 import imgurpython
 import requests
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import (NoSuchElementException,
+                                        TimeoutException, WebDriverException)
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
+from selenium.webdriver.remote.remote_connection import RemoteConnection
 from selenium.webdriver.support import expected_conditions as expect
 from selenium.webdriver.support.ui import WebDriverWait
-from sqlalchemy.sql import or_
+from sqlalchemy.sql import and_, or_, select
 
-from ..exceptions import RendererException
-from ..utils import is_comment_url
+from ..comments import CommentThreadPages
+from ..exceptions import BrowserUnavailable, RendererException
+from ..utils import (canonical_url, comment_id_from_url, connect_db,
+                     is_comment_url, needs_screenshot,
+                     record_screenshot_failure, release_connection)
+from .uploader import upload_screenshot
 
-__all__ = ('REDDIT_HOME', 'MAX_SCREENSHOT_HEIGHT', 'Renderer')
+__all__ = ('REDDIT_HOME', 'MAX_SCREENSHOT_HEIGHT', 'SessionCookies',
+           'DriverFactory', 'DriverPool', 'Renderer')
 
 log = logging.getLogger(__name__)
 
@@ -27,28 +45,421 @@ REDDIT_HOME = 'https://www.reddit.com'
 
 MAX_SCREENSHOT_HEIGHT = 4000
 
+CAP_HEIGHT_JS = """
+arguments[0].style.maxHeight = arguments[1] + 'px';
+arguments[0].style.overflow = 'hidden';
+"""
 
-class Renderer():
-    """Renders screenshots of submitted webpages."""
-    _lock = Lock()
 
-    def __init__(self, imgur_auth, reddit_args, db_uri, kill_switch):
+class SessionCookies():
+    """
+    Keeps a Reddit login's cookies on disk, so browsers can skip logging in.
+
+    The file is only readable by its owner, and written atomically, so
+    browsers in other threads or processes never see half of it. Saved
+    cookies expire with the login's session cookie, or after `max_age`,
+    whichever is sooner.
+    """
+
+    SESSION_COOKIE = 'reddit_session'
+    """Name of the cookie that keeps a browser logged in to Reddit."""
+
+    MAX_AGE = datetime.timedelta(days=7)
+    """Default longest time saved cookies are used for."""
+
+    def __init__(self, path, username, max_age=MAX_AGE):
         """
-        Create a new Renderer.
+        Create a new SessionCookies.
 
-        :param imgur_auth: dict of arguments to pass to :class:`ImgurClient`
-        :type imgur_auth: dict[str, str]
-        :param reddit_args: dict of arguments to pass to :class:`Reddit`
+        :param str path: file to keep cookies in
+        :param str username: Reddit user the cookies log in; cookies saved
+        for anyone else are ignored
+        :param timedelta max_age: longest time saved cookies are used for
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.username = username
+        self.max_age = max_age.total_seconds()
+
+    def __repr__(self):
+        return '<{cls}({path!r}, {username})>'.format(
+            cls=self.__class__.__name__,
+            path=self.path,
+            username=self.username)
+
+    def load(self):
+        """
+        :returns: cookies saved for `username` that haven't expired, or None
+        if there aren't any
+        :rtype: list[dict[str, Any]] or None
+        """
+        try:
+            with open(self.path) as cookie_file:
+                saved = json.load(cookie_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning("couldn't read session cookies from %s",
+                        self.path,
+                        exc_info=True)
+            return None
+        now = time.time()
+        if (saved.get('username') != self.username
+                or saved.get('expires_at', 0) <= now):
+            return None
+        return [
+            cookie for cookie in saved.get('cookies', [])
+            if cookie.get('expiry', now + 1) > now
+        ] or None
+
+    def save(self, cookies):
+        """
+        Save cookies for `username`, replacing any saved before.
+
+        :param cookies: cookies as returned by :meth:`WebDriver.get_cookies`
+        :type cookies: list[dict[str, Any]]
+        """
+        expires_at = time.time() + self.max_age
+        for cookie in cookies:
+            if cookie['name'] == self.SESSION_COOKIE and cookie.get('expiry'):
+                expires_at = min(expires_at, cookie['expiry'])
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # mkstemp creates the file readable only by us
+        handle, tmp_path = mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as cookie_file:
+                json.dump({
+                    'username': self.username,
+                    'expires_at': expires_at,
+                    'cookies': cookies,
+                }, cookie_file)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        log.debug("saved %d session cookies to %s", len(cookies), self.path)
+
+    def clear(self):
+        """Forget the saved cookies."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DriverFactory():
+    """Creates Firefox webdrivers with uBlock installed, logged in to Reddit."""
+    _lock = RLock()
+
+    DEFAULT_PREFS = {
+        'media.autoplay.default': 1,  # blocked
+        'media.autoplay.enabled': False,
+        'network.dns.disablePrefetch': True,
+        'network.http.speculative-parallel-limit': 0,
+        'network.prefetch-next': False,
+    }
+    """Firefox preferences turning off features screenshots don't need."""
+
+    PAGE_LOAD_STRATEGIES = ('normal', 'eager', 'none')
+
+    BLOCKING_PREFS = {
+        'fonts': {
+            'browser.display.use_document_fonts': 0,
+            'gfx.downloadable_fonts.enabled': False,
+        },
+        'images': {
+            'permissions.default.image': 2,  # blocked
+        },
+        'media': {
+            'media.mediasource.enabled': False,
+            'media.mp4.enabled': False,
+            'media.ogg.enabled': False,
+            'media.webm.enabled': False,
+        },
+    }
+    """Firefox preferences keeping each kind of resource from loading."""
+
+    PROFILE_LOCKS = ('lock', '.parentlock', 'parent.lock')
+    """Files Firefox uses to lock a profile, not copied with it."""
+
+    PROFILE_SETTLE_TIME = 5
+    """Seconds add-ons get to finish setting up before a profile is saved."""
+
+    CLONE_PREFIX = '.clone-'
+    """Prefix of profile copies, made alongside the profile and tagged with
+    the PID of the process using them."""
+
+    def __init__(self,
+                 reddit_args,
+                 headless=False,
+                 window_size=None,
+                 page_load_strategy='eager',
+                 prefs=None,
+                 block_resources=(),
+                 proxy=None,
+                 command_timeout=None,
+                 session_file=None,
+                 session_max_age=SessionCookies.MAX_AGE,
+                 profile_dir=None):
+        """
+        Create a new DriverFactory.
+
+        :param reddit_args: dict of arguments to pass to :class:`Reddit`; only
+        `username` and `password` are used
         :type reddit_args: dict[str, str]
-        :param str db_uri: SQLAlchemy-style DB URI
-        :param Event kill_switch: when set, breaks the loop in :meth:`run`,
-        and prevents :meth:`_process_submissions` from processing submissions
+        :param bool headless: if True, run Firefox without a display
+        :param window_size: browser window width and height, in px
+        :type window_size: tuple[int, int] or None
+        :param str page_load_strategy: `normal` waits for every subresource,
+        `eager` only for the DOM, `none` for nothing; renderers' readiness
+        waits only start once the page has loaded this far
+        :param prefs: Firefox preferences, added to :attr:`DEFAULT_PREFS`
+        :type prefs: dict[str, Any] or None
+        :param block_resources: kinds of resource not to load, from
+        :attr:`BLOCKING_PREFS`
+        :type block_resources: iterable[str]
+        :param proxy: host and port of an HTTP proxy to send all traffic
+        through, e.g. a :class:`BlockingProxy`
+        :type proxy: tuple[str, int] or None
+        :param command_timeout: most seconds to wait on any one browser
+        command before giving up on the browser; applies to every webdriver
+        in the process
+        :type command_timeout: float or None
+        :param session_file: if set, Reddit login cookies are saved here and
+        reused by later browsers, which only log in if they're missing or
+        rejected
+        :type session_file: str or None
+        :param timedelta session_max_age: longest time saved login cookies
+        are reused for
+        :param profile_dir: if set, a Firefox profile with uBlock installed
+        and Reddit's cookie policy accepted is built here once, and each
+        browser starts from a copy of it, made alongside it and removed by
+        :meth:`cleanup`; delete it to rebuild it
+        :type profile_dir: str or None
+        :raises ValueError: if `page_load_strategy` or a resource in
+        `block_resources` isn't known
         """
-        self._db_uri = db_uri
-        self._imgur = imgurpython.ImgurClient(**imgur_auth)
+        if page_load_strategy not in self.PAGE_LOAD_STRATEGIES:
+            raise ValueError(
+                "Unknown page load strategy {!r}".format(page_load_strategy))
+        unknown = set(block_resources) - set(self.BLOCKING_PREFS)
+        if unknown:
+            raise ValueError("Unknown resources to block {}".format(
+                ', '.join(sorted(unknown))))
         self._reddit_args = reddit_args
-        self._kill = kill_switch
-        self.driver = None
+        self.headless = headless
+        self.window_size = tuple(window_size) if window_size else None
+        self.page_load_strategy = page_load_strategy
+        self.command_timeout = command_timeout
+        self.prefs = dict(self.DEFAULT_PREFS)
+        for resource in block_resources:
+            self.prefs.update(self.BLOCKING_PREFS[resource])
+        if proxy:
+            host, port = proxy
+            self.prefs.update({
+                'network.proxy.type': 1,  # manual
+                'network.proxy.http': host,
+                'network.proxy.http_port': port,
+                'network.proxy.ssl': host,
+                'network.proxy.ssl_port': port,
+            })
+        self.prefs.update(prefs or {})
+        self.profile_dir = (os.path.abspath(os.path.expanduser(profile_dir))
+                            if profile_dir else None)
+        self._clones = weakref.WeakKeyDictionary()
+        self._swept = False
+        self.session_cookies = None
+        if session_file:
+            self.session_cookies = SessionCookies(session_file,
+                                                  reddit_args['username'],
+                                                  session_max_age)
+
+    def _firefox_options(self, profile=None):
+        options = FirefoxOptions()
+        if self.headless:
+            options.add_argument('-headless')
+        if profile is not None:
+            # used in place, rather than zipped up and copied by geckodriver
+            options.add_argument('-profile')
+            options.add_argument(profile)
+        for name, value in self.prefs.items():
+            options.set_preference(name, value)
+        return options
+
+    def _capabilities(self):
+        capabilities = DesiredCapabilities.FIREFOX.copy()
+        capabilities['pageLoadStrategy'] = self.page_load_strategy
+        return capabilities
+
+    def __call__(self):
+        """
+        Create a new webdriver.
+
+        :returns: a browser logged in to Reddit
+        :rtype: WebDriver
+        """
+        profile = None
+        if self.profile_dir is not None:
+            self.build_profile()
+            profile = self._clone_profile()
+        try:
+            driver = self._launch(profile)
+        except BaseException:
+            if profile is not None:
+                shutil.rmtree(profile, ignore_errors=True)
+            raise
+        if profile is not None:
+            # should the browser never be cleaned up, remove it once it's gone
+            self._clones[driver] = weakref.finalize(driver, shutil.rmtree,
+                                                    profile, True)
+        try:
+            if profile is None:
+                self._install_ublock(driver)
+            driver.get(REDDIT_HOME)
+            self._accept_cookies(driver)
+            if not self._restore_session(driver):
+                self._authenticate_reddit(driver)
+                if self.session_cookies is not None:
+                    self.session_cookies.save(driver.get_cookies())
+        except Exception:
+            driver.quit()
+            self.cleanup(driver)
+            raise
+        return driver
+
+    def cleanup(self, driver):
+        """
+        Remove the profile copy a quit browser started from, if any.
+
+        :param WebDriver driver: a browser made by this factory
+        """
+        remove_clone = self._clones.pop(driver, None)
+        if remove_clone is not None:
+            remove_clone()
+
+    def _launch(self, profile=None):
+        if self.command_timeout:
+            # set before the driver exists, so starting the session is
+            # covered too; it's class-wide, so every webdriver in the process
+            # shares it
+            RemoteConnection.set_timeout(self.command_timeout)
+        driver = webdriver.Firefox(
+            firefox_options=self._firefox_options(profile),
+            capabilities=self._capabilities())
+        try:
+            if self.window_size:
+                driver.set_window_size(*self.window_size)
+        except Exception:
+            driver.quit()
+            raise
+        return driver
+
+    def build_profile(self):
+        """
+        Build the profile browsers start from, unless it's already built.
+
+        The profile's built elsewhere and moved into `profile_dir` once
+        complete, so browsers in other processes only ever copy a whole one.
+        """
+        with self._lock:
+            if os.path.isdir(self.profile_dir):
+                return
+            log.info("building firefox profile %s", self.profile_dir)
+            parent = os.path.dirname(self.profile_dir)
+            os.makedirs(parent, mode=0o700, exist_ok=True)
+            building = mkdtemp(dir=parent, prefix='.building-')
+            try:
+                driver = self._launch(building)
+                try:
+                    self._install_ublock(driver)
+                    driver.get(REDDIT_HOME)
+                    self._accept_cookies(driver)
+                    time.sleep(self.PROFILE_SETTLE_TIME)
+                finally:
+                    driver.quit()
+                os.rename(building, self.profile_dir)
+            except OSError:
+                if not os.path.isdir(self.profile_dir):
+                    raise
+                log.debug("firefox profile built elsewhere meanwhile")
+            finally:
+                shutil.rmtree(building, ignore_errors=True)
+
+    def _clone_profile(self):
+        """
+        :returns: path to a new copy of the built profile, copy-on-write
+        where the filesystem supports it
+        :rtype: str
+        """
+        if not self._swept:
+            self._sweep_clones()
+        clone = mkdtemp(dir=os.path.dirname(self.profile_dir),
+                        prefix='{}{}-'.format(self.CLONE_PREFIX, os.getpid()))
+        try:
+            subprocess.run(
+                ['cp', '-a', '--reflink=auto',
+                 os.path.join(self.profile_dir, '.'), clone],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            # no GNU cp; copy it ourselves
+            shutil.rmtree(clone)
+            shutil.copytree(self.profile_dir, clone, symlinks=True)
+        for lock in self.PROFILE_LOCKS:
+            try:
+                os.remove(os.path.join(clone, lock))
+            except FileNotFoundError:
+                pass
+        return clone
+
+    def _sweep_clones(self):
+        """Remove profile copies left behind by processes that have died."""
+        self._swept = True
+        parent = os.path.dirname(self.profile_dir)
+        for name in os.listdir(parent):
+            if not name.startswith(self.CLONE_PREFIX):
+                continue
+            try:
+                pid = int(name[len(self.CLONE_PREFIX):].split('-', 1)[0])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                log.debug("removing stale firefox profile copy %s", name)
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+            except PermissionError:
+                # alive, just not ours
+                pass
+
+    def _restore_session(self, driver):
+        """
+        Log a browser in to Reddit with saved cookies, if there are any.
+
+        :returns: True if the browser's now logged in
+        :rtype: bool
+        """
+        if self.session_cookies is None:
+            return False
+        cookies = self.session_cookies.load()
+        if not cookies:
+            return False
+        for cookie in cookies:
+            try:
+                driver.add_cookie(cookie)
+            except WebDriverException:
+                log.debug("couldn't restore cookie %r", cookie['name'])
+        driver.get(REDDIT_HOME)
+        if driver.find_elements_by_class_name('userkarma'):
+            log.debug("restored reddit session from %r",
+                      self.session_cookies)
+            return True
+        log.info("saved reddit session rejected; logging in again")
+        self.session_cookies.clear()
+        driver.delete_all_cookies()
+        driver.get(REDDIT_HOME)
+        self._accept_cookies(driver)
+        return False
 
     def _authenticate_reddit(self, driver):
         username_field = driver.find_element_by_xpath(
@@ -68,7 +479,7 @@ class Renderer():
                                                         'userkarma'))
         try:
             WebDriverWait(driver, 10).until(logged_in)
-        except TimeoutError:
+        except TimeoutException:
             log.warning("Failed to login to reddit")
             with NamedTemporaryFile(suffix='.png', delete=False) as tmp_fh:
                 tmp_fh.write(driver.get_screenshot_as_png())
@@ -103,109 +514,611 @@ class Renderer():
         log.debug("installing ublock origin")
         driver.install_addon(self.UBLOCK_XPI_PATH)
 
-    def _create_driver(self):
-        driver = webdriver.Firefox()
+
+class _PooledDriver():
+    # pylint: disable=too-few-public-methods
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+
+
+class DriverPool():
+    """
+    A pool of webdrivers shared between renderers.
+
+    Browsers are created on demand, up to `max_size`, health checked when
+    checked out, and recycled after `max_uses` renders or any error.
+    """
+
+    def __init__(self, factory, min_size=1, max_size=1, max_uses=100):
+        """
+        Create a new DriverPool.
+
+        :param callable factory: creates a new webdriver; if it has a
+        `cleanup` method, that's called with each browser once it's quit
+        :param int min_size: browsers started by :meth:`start`
+        :param int max_size: most browsers alive at once
+        :param max_uses: renders after which a browser is recycled; None for
+        no limit
+        :type max_uses: int or None
+        """
+        self._factory = factory
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.max_uses = max_uses
+        self._idle = []
+        self._size = 0
+        self._available = Condition()
+
+    def __repr__(self):
+        return '<{cls}({idle} idle, {size}/{max_size})>'.format(
+            cls=self.__class__.__name__,
+            idle=len(self._idle),
+            size=self._size,
+            max_size=self.max_size)
+
+    def start(self):
+        """Create browsers until there are at least `min_size`."""
+        while True:
+            with self._available:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            self._checkin(self._create())
+
+    def close(self):
+        """Quit all idle browsers."""
+        with self._available:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._discard(pooled)
+
+    def resize(self, max_size):
+        """
+        Change how many browsers may be alive at once.
+
+        Idle browsers over the new limit are quit now, busy ones when they're
+        checked back in.
+
+        :param int max_size: most browsers alive at once
+        """
+        with self._available:
+            self.max_size = max(max_size, self.min_size, 1)
+            surplus = [
+                self._idle.pop()
+                for _ in range(min(len(self._idle),
+                                   self._size - self.max_size))
+            ]
+            self._available.notify_all()
+        for pooled in surplus:
+            self._discard(pooled)
+
+    @contextmanager
+    def driver(self, timeout=None):
+        """
+        Check out a webdriver for the duration of a `with` block.
+
+        If the block raises, the browser is recycled rather than reused.
+
+        :param timeout: seconds to wait for a browser; waits forever if None
+        :type timeout: float or None
+        :returns: context manager yielding a webdriver
+        :rtype: ContextManager[WebDriver]
+        """
+        pooled = self._checkout(timeout)
         try:
-            self._install_ublock(driver)
-            driver.get(REDDIT_HOME)
-            self._accept_cookies(driver)
-            self._authenticate_reddit(driver)
-        except Exception:
-            driver.quit()
+            yield pooled.driver
+        except BaseException:
+            self._discard(pooled)
             raise
-        self.driver = driver
+        pooled.uses += 1
+        if self.max_uses and pooled.uses >= self.max_uses:
+            log.debug("recycling browser after %d renders", pooled.uses)
+            self._discard(pooled)
+        elif self._size > self.max_size:
+            log.debug("quitting browser surplus to %r", self)
+            self._discard(pooled)
+        else:
+            self._checkin(pooled)
+
+    def _checkout(self, timeout):
+        while True:
+            with self._available:
+                while not self._idle and self._size >= self.max_size:
+                    if not self._available.wait(timeout):
+                        raise BrowserUnavailable(
+                            "no browser available after {}s".format(timeout))
+                if not self._idle:
+                    self._size += 1
+                    break
+                pooled = self._idle.pop()
+            # checked and quit outside the lock, so other checkouts needn't
+            # wait on the browser
+            if self._healthy(pooled.driver):
+                return pooled
+            log.warning("discarding unhealthy browser")
+            self._discard(pooled)
+        return self._create()
+
+    def _checkin(self, pooled):
+        with self._available:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    def _create(self):
+        """Create a browser for a slot already counted in `_size`."""
+        try:
+            return _PooledDriver(self._factory())
+        except BaseException as e:
+            with self._available:
+                self._size -= 1
+                self._available.notify()
+            if isinstance(e, Exception):
+                raise BrowserUnavailable("couldn't start a browser") from e
+            raise
+
+    def _discard(self, pooled):
+        self._quit(pooled.driver)
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+
+    @staticmethod
+    def _healthy(driver):
+        try:
+            driver.current_url  # pylint: disable=pointless-statement
+        except WebDriverException:
+            return False
+        return True
+
+    def _quit(self, driver):
+        try:
+            driver.quit()
+        except WebDriverException:
+            log.debug("failed to quit browser", exc_info=True)
+        cleanup = getattr(self._factory, 'cleanup', None)
+        if cleanup is not None:
+            cleanup(driver)
+
+
+class Renderer():
+    """Renders screenshots of submitted webpages."""
+
+    CLAIM_BATCH_SIZE = 3
+    """Default number of submissions claimed at once."""
+
+    RENDER_TIMEOUT = 30
+    """Default most seconds a render waits for its page to be ready."""
+
+    READY_STATES = {
+        'interactive': ('interactive', 'complete'),
+        'complete': ('complete', ),
+    }
+    """`document.readyState` values satisfying each readiness condition."""
+
+    def __init__(self,
+                 imgur_auth,
+                 reddit_args,
+                 db,
+                 kill_switch,
+                 driver_pool=None,
+                 claim_batch_size=CLAIM_BATCH_SIZE,
+                 new_submissions=None,
+                 new_screenshots=None,
+                 debug_screenshot_dir=None,
+                 uploader=None,
+                 screenshot_cache=None,
+                 render_timeout=RENDER_TIMEOUT,
+                 ready_state='interactive',
+                 circuit_breaker=None,
+                 clip_selectors=None):
+        """
+        Create a new Renderer.
+
+        :param imgur_auth: dict of arguments to pass to :class:`ImgurClient`
+        :type imgur_auth: dict[str, str]
+        :param reddit_args: dict of arguments to pass to :class:`Reddit`
+        :type reddit_args: dict[str, str]
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
+        :param Event kill_switch: when set, breaks the loop in :meth:`run`,
+        and prevents :meth:`_process_submissions` from processing submissions
+        :param driver_pool: browsers to render with; if None, the renderer
+        gets a pool with a single browser of its own
+        :type driver_pool: DriverPool or None
+        :param int claim_batch_size: most submissions claimed at once; all must
+        be rendered within :attr:`LOCK_TIME`
+        :param Event new_submissions: if given, wakes the renderer as soon as
+        it's set, rather than waiting out :attr:`POLL_INTERVAL`; it must also
+        be set when the kill switch is thrown
+        :param Event new_screenshots: if given, set whenever a screenshot is
+        committed, to wake commenters
+        :param debug_screenshot_dir: if set, every screenshot is also written
+        to a file in this directory, for debugging; otherwise screenshots
+        never touch the disk
+        :type debug_screenshot_dir: str or None
+        :param uploader: if given, screenshots are handed off to it and
+        uploaded in the background, rather than by the renderer itself
+        :type uploader: Uploader or None
+        :param screenshot_cache: if given, submissions linking to a page
+        screenshotted recently reuse that screenshot instead of rendering
+        :type screenshot_cache: ScreenshotCache or None
+        :param float render_timeout: most seconds to wait for a page to be
+        ready; pages that aren't are stopped and rendered as they are
+        :param str ready_state: `document.readyState` generic pages must reach
+        before rendering, `interactive` (DOM ready) or `complete` (loaded)
+        :param circuit_breaker: if given, renders are recorded with it, and
+        submissions on domains it's tripped for are deferred
+        :type circuit_breaker: CircuitBreaker or None
+        :param clip_selectors: CSS selectors of the element to screenshot,
+        keyed by host pattern, e.g. `{'*.wikipedia.org': '#content'}`; other
+        pages are screenshotted whole
+        :type clip_selectors: dict[str, str] or None
+        :raises ValueError: if `ready_state` isn't one of
+        :attr:`READY_STATES`
+        """
+        if ready_state not in self.READY_STATES:
+            raise ValueError("Unknown ready state {!r}".format(ready_state))
+        self._db = connect_db(db)
+        self._imgur = imgurpython.ImgurClient(**imgur_auth)
+        self._reddit_args = reddit_args
+        self._kill = kill_switch
+        self._owns_driver_pool = driver_pool is None
+        if driver_pool is None:
+            driver_pool = DriverPool(DriverFactory(reddit_args))
+        self.driver_pool = driver_pool
+        self.driver = None
+        self.claim_batch_size = claim_batch_size
+        self._new_submissions = new_submissions
+        self._new_screenshots = new_screenshots
+        self.debug_screenshot_dir = debug_screenshot_dir
+        self.uploader = uploader
+        self.screenshot_cache = screenshot_cache
+        self.render_timeout = render_timeout
+        self.ready_state = ready_state
+        self.circuit_breaker = circuit_breaker
+        self.clip_selectors = clip_selectors or {}
+        self._busy_seconds = 0.0
+        self._started = None
+        self._browser_retry_delay = self.BROWSER_RETRY_DELAY
+        self.worker_id = '{}:{}:{}'.format(platform.node(), os.getpid(),
+                                           uuid.uuid4().hex[:8])[-64:]
 
     def __del__(self):
         try:
-            self.driver.quit()
+            if self._owns_driver_pool:
+                self.driver_pool.close()
         except AttributeError:
             pass
 
     def __repr__(self):
         return '<{cls}({db_uri}, Firefox, Imgur, {db_uri})>'.format(
             cls=self.__class__.__name__,
-            db_uri=self._db_uri)
+            db_uri=self._db.url)
+
+    @property
+    def utilization(self):
+        """Fraction of time spent rendering since :meth:`run` started."""
+        if self._started is None:
+            return 0.0
+        elapsed = time.time() - self._started
+        return min(self._busy_seconds / elapsed, 1.0) if elapsed else 0.0
 
     def run(self):
         """Consume and render submissions until killed."""
         log.debug("%r running", self)
-        self._create_driver()
+        self._started = time.time()
+        try:
+            self.driver_pool.start()
+        except BrowserUnavailable:
+            # the pool tries again when a submission needs a browser
+            log.exception("%r couldn't start its browsers", self)
         while True:
-            self._process_next_submission()
-            self._kill.wait(60)
+            if self._new_submissions is not None:
+                # clear before looking, so nothing committed since is missed
+                self._new_submissions.clear()
+            if not self._process_next_submissions():
+                self._wait_for_submissions()
             if self._kill.is_set():
                 break
 
+    POLL_INTERVAL = 60
+    """Most seconds between checks for submissions that need screenshots."""
+
+    def _wait_for_submissions(self):
+        if self._new_submissions is None:
+            self._kill.wait(self.POLL_INTERVAL)
+        else:
+            self._new_submissions.wait(self.POLL_INTERVAL)
+
     LOCK_TIME = datetime.timedelta(minutes=5)
 
-    def _process_next_submission(self):
-        db = dataset.connect(self._db_uri)
+    BROWSER_RETRY_DELAY = 30
+    """Seconds to wait after failing to get a browser, doubling per failure."""
+
+    MAX_BROWSER_RETRY_DELAY = 300
+    """Most seconds to wait after failing to get a browser."""
+
+    def _process_next_submissions(self):
+        """
+        Claim and render a batch of submissions that need screenshots.
+
+        :returns: number of submissions claimed
+        :rtype: int
+        """
+        db = self._db
         try:
             submissions_table = db['submissions']
-            log.debug("checking for next submission that needs screenshot")
-            col = submissions_table.table.columns
-            now = datetime.datetime.utcnow()
-            for submission in submissions_table.find(
-                    or_(col.bot_screenshot_lock == None,  # noqa
-                        col.bot_screenshot_lock < now),
-                    bot_screenshot_at=None,
-                    order_by='created'):
-                submission['bot_screenshot_lock'] = now + self.LOCK_TIME
-                submissions_table.update(submission, ['id'])
-                db.commit()
-                log.debug("submission %d screenshot lock acquired",
-                          submission['id'])
-                self._process_submission(submissions_table, submission)
-                db.commit()
-                log.info("submission %d screenshot generated",
-                         submission['id'])
-                return
+            log.debug("claiming submissions that need screenshots")
+            claimed = self._claim_submissions(db, submissions_table,
+                                              self.claim_batch_size)
+            if not claimed:
+                return 0
+            log.debug("submissions %s screenshot lock acquired by %s",
+                      claimed, self.worker_id)
+            pending = set(claimed)
+            try:
+                for submission in submissions_table.find(id=claimed,
+                                                         order_by='created'):
+                    if self._kill.is_set():
+                        break
+                    pending.discard(submission['id'])
+                    try:
+                        stored = self._process_submission(
+                            submissions_table, submission)
+                    except BrowserUnavailable:
+                        # hand this and the rest of the batch back, and give
+                        # the browser a while to come good
+                        pending.add(submission['id'])
+                        log.exception("no browser to render submission %d; "
+                                      "retrying in %ds", submission['id'],
+                                      self._browser_retry_delay)
+                        self._kill.wait(self._browser_retry_delay)
+                        self._browser_retry_delay = min(
+                            self._browser_retry_delay * 2,
+                            self.MAX_BROWSER_RETRY_DELAY)
+                        break
+                    except (WebDriverException, socket.timeout):
+                        # the browser's been recycled; retry once the lock
+                        # expires
+                        log.exception("failed to render submission %d",
+                                      submission['id'])
+                        continue
+                    except Exception:  # pylint: disable=broad-except
+                        # one bad submission mustn't take the renderer with
+                        # it; keep the claim, so it's retried once the lock
+                        # expires, unless it's failed too often
+                        log.exception("failed to process submission %d",
+                                      submission['id'])
+                        record_screenshot_failure(submissions_table,
+                                                  submission['id'])
+                        continue
+                    self._browser_retry_delay = self.BROWSER_RETRY_DELAY
+                    if not stored:
+                        continue
+                    db.commit()
+                    log.info("submission %d screenshot generated",
+                             submission['id'])
+                    if self._new_screenshots is not None:
+                        self._new_screenshots.set()
+            finally:
+                self._release_claims(submissions_table, pending)
+            return len(claimed)
         finally:
-            if hasattr(db.local, 'conn'):
-                db.local.conn.close()
-            db.engine.dispose()
+            release_connection(db)
+
+    def _claim_submissions(self, db, submissions_table, limit):
+        """
+        Atomically lease up to `limit` submissions that need screenshots.
+
+        On PostgreSQL, a single ``UPDATE`` claims rows picked with
+        ``FOR UPDATE SKIP LOCKED``, so concurrent renderers never wait on or
+        steal each other's rows. Elsewhere, each candidate is claimed with an
+        ``UPDATE`` conditional on its lock still being free, and only rows it
+        changed count as claimed.
+
+        :param Database db:
+        :param Table submissions_table:
+        :param int limit: most submissions to claim
+        :returns: IDs of the claimed submissions
+        :rtype: list[int]
+        """
+        table = submissions_table.table
+        col = table.columns
+        now = datetime.datetime.utcnow()
+        claimable = and_(
+            needs_screenshot(col),
+            or_(col.bot_screenshot_lock == None,  # noqa
+                col.bot_screenshot_lock < now))
+        lease = {
+            'bot_screenshot_lock': now + self.LOCK_TIME,
+            'bot_screenshot_worker': self.worker_id,
+        }
+        candidates = select([col.id]).where(claimable).order_by(
+            col.created).limit(limit)
+        if db.engine.dialect.name == 'postgresql':
+            claim = table.update().where(
+                col.id.in_(candidates.with_for_update(
+                    skip_locked=True))).values(**lease).returning(col.id)
+            return [row[0] for row in db.executable.execute(claim)]
+        claimed = []
+        for (_id, ) in db.executable.execute(candidates).fetchall():
+            claim = table.update().where(and_(col.id == _id,
+                                              claimable)).values(**lease)
+            if db.executable.execute(claim).rowcount == 1:
+                claimed.append(_id)
+        return claimed
+
+    def _release_claims(self, submissions_table, ids):
+        """
+        Give up claims on submissions we didn't get to, so others can.
+
+        :param Table submissions_table:
+        :param ids: IDs of claimed submissions
+        :type ids: iterable[int]
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        table = submissions_table.table
+        col = table.columns
+        self._db.executable.execute(table.update().where(
+            and_(col.id.in_(ids), col.bot_screenshot_worker == self.worker_id,
+                 col.bot_screenshot_at == None)).values(  # noqa
+                     bot_screenshot_lock=None, bot_screenshot_worker=None))
+        log.debug("released claims on submissions %s", ids)
 
     def _process_submission(self, submissions_table, submission):
+        """
+        Screenshot a submission, storing it or handing it to the uploader.
+
+        :param Table submissions_table:
+        :param dict submission:
+        :returns: True if the screenshot was stored, False if it was handed
+        off to :attr:`uploader`
+        :rtype: bool
+        """
+        cache_key = self.cache_key(submission['url'])
+        if self.screenshot_cache is not None:
+            cached = self.screenshot_cache.get(cache_key)
+            if cached is not None:
+                log.debug("submission %d screenshot cached as %r",
+                          submission['id'], cached[0])
+                self._store_screenshot(submissions_table, submission, *cached)
+                return True
+        domain = urlsplit(submission['url']).hostname
+        if (self.circuit_breaker is not None
+                and not self.circuit_breaker.allows(domain)):
+            self._defer(submissions_table, submission,
+                        self.circuit_breaker.retry_at(domain))
+            return False
         log.debug("rendering submission %d", submission['id'])
-        url, deletehash = self.capture(submission['url'])
+        screenshot = self.snapshot(submission['url'], domain)
+        if self.uploader is not None:
+            if not self.uploader.submit(submission['id'], self.worker_id,
+                                        screenshot, cache_key):
+                self._release_claims(submissions_table, [submission['id']])
+            return False
+        url, deletehash = self.upload(screenshot)
+        log.info("captured %r to %r", submission['url'], url)
+        if self.screenshot_cache is not None:
+            self.screenshot_cache.put(cache_key, url, deletehash)
+        self._store_screenshot(submissions_table, submission, url, deletehash)
+        return True
+
+    def _defer(self, submissions_table, submission, until):
+        """Put off rendering a submission, releasing our claim until then."""
+        log.info("deferring submission %d until %s; %s keeps failing",
+                 submission['id'], until, urlsplit(submission['url']).hostname)
+        table = submissions_table.table
+        col = table.columns
+        self._db.executable.execute(table.update().where(
+            and_(col.id == submission['id'],
+                 col.bot_screenshot_worker == self.worker_id)).values(
+                     bot_screenshot_lock=until, bot_screenshot_worker=None))
+
+    @staticmethod
+    def _store_screenshot(submissions_table, submission, url, deletehash):
         submission['bot_screenshot_url'] = url
         submission['bot_screenshot_deletehash'] = deletehash
         submission['bot_screenshot_at'] = datetime.datetime.utcnow()
         submissions_table.update(submission, ['id'])
 
+    def cache_key(self, url):
+        """
+        Key screenshots of a URL are cached under.
+
+        URLs that render the same page should share a key.
+
+        :param str url: URL of webpage
+        :returns: canonical form of the URL
+        :rtype: str
+        """
+        return canonical_url(url)
+
     def render(self, url, max_height=MAX_SCREENSHOT_HEIGHT):
         """
-        Render a screenshot of a webpage to a temporary file.
+        Render a screenshot of a webpage.
 
         :param str url: URL of webpage to render
         :param int max_height: maximum height in px
-        :returns: path to PNG screenshot of webpage
-        :rtype: str
+        :returns: PNG screenshot of webpage
+        :rtype: bytes
         """
         log.debug("rendering %s", url)
-        self.driver.get(url)
-        screenshot_file = NamedTemporaryFile('wb', suffix='.png', delete=False)
+        self._load(url)
+        return self._screenshot_element(self._clip_element(url), max_height)
+
+    def _screenshot_element(self, element, max_height):
+        """
+        :param WebElement element: element to screenshot
+        :param int max_height: maximum height in px
+        :returns: PNG screenshot of the element, cut off at `max_height`
+        :rtype: bytes
+        """
+        if max_height and element.size['height'] > max_height:
+            log.debug("element height %d greater than %d; trimming",
+                      element.size['height'], max_height)
+            self.driver.execute_script(CAP_HEIGHT_JS, element, max_height)
+            log.debug("new element height %d", element.size['height'])
+
+        return element.screenshot_as_png
+
+    def _clip_element(self, url):
+        """
+        Find the element a page's screenshot is clipped to.
+
+        :param str url: URL of the loaded page
+        :returns: the first element matching the :attr:`clip_selectors`
+        pattern for the page's host, or the page's body
+        :rtype: WebElement
+        """
+        host = urlsplit(url).hostname or ''
+        for pattern, selector in self.clip_selectors.items():
+            if fnmatch(host, pattern):
+                elements = self.driver.find_elements_by_css_selector(selector)
+                if elements:
+                    return elements[0]
+                log.debug("nothing matches %r on %s", selector, url)
+                break
+        return self.driver.find_element_by_xpath("/html/body")
+
+    def _load(self, url):
+        """
+        Navigate to a page, waiting only until it's ready to render.
+
+        The page load and the wait for :meth:`_ready_condition` share a budget
+        of :attr:`render_timeout` seconds; once it's spent, loading is stopped.
+
+        :param str url: URL of webpage to load
+        """
+        deadline = time.time() + self.render_timeout
+        self.driver.set_page_load_timeout(self.render_timeout)
         try:
-            page = self.driver.find_element_by_xpath("/html/body")
-            if max_height and page.size['height'] > max_height:
-                log.debug("page height %d greater than %d; trimming",
-                          page.size['height'], max_height)
-                cap_element_js = """
-                $('{selector}')[0].style.maxHeight = '{height}px';
-                $('{selector}')[0].style.overflow = 'hidden';
-                """
-
-                script = cap_element_js.format(selector='body',
-                                               height=max_height)
-                self.driver.execute_script(script)
-                log.debug("new page height %d", page.size['height'])
-
-            screenshot = page.screenshot_as_png
-            screenshot_file.write(screenshot)
-            screenshot_file.flush()
-        finally:
-            screenshot_file.close()
-        return screenshot_file.name
+            self.driver.get(url)
+            WebDriverWait(self.driver, max(deadline - time.time(), 0)).until(
+                self._ready_condition(url))
+        except TimeoutException:
+            log.warning("%s not ready after %ss; rendering it as it is", url,
+                        self.render_timeout)
+            self.driver.execute_script('window.stop();')
+
+    def _ready_condition(self, url):
+        """
+        Condition a page must meet before it's rendered.
+
+        :param str url: URL of the page
+        :returns: a :class:`WebDriverWait` condition; by default, that
+        `document.readyState` is one of :attr:`READY_STATES`
+        :rtype: callable
+        """
+        ready_states = self.READY_STATES[self.ready_state]
+
+        def document_ready(driver):
+            return driver.execute_script(
+                'return document.readyState;') in ready_states
+
+        return document_ready
 
     def capture(self, url):
         """
@@ -215,38 +1128,132 @@ class Renderer():
         :returns: URL of screenshot and image deletehash
         :rtype: tuple[str, str]
         """
-        temp_file_path = None
-        try:
-            # render to temporary file
-            temp_file_path = self.render(url)
-            # upload to ?
-            image_url, deletehash = self.upload(temp_file_path)
-        finally:
-            if temp_file_path:
-                os.unlink(temp_file_path)
+        screenshot = self.snapshot(url)
+        image_url, deletehash = self.upload(screenshot)
         # return hosted URL
         log.info("captured %r to %r", url, image_url)
         return image_url, deletehash
 
-    def upload(self, file_path):
+    def snapshot(self, url, domain=None):
+        """
+        Render a screenshot of a webpage with a browser from the pool.
+
+        :param str url: URL of webpage to render
+        :param domain: domain to record how the render went against with
+        :attr:`circuit_breaker`, if any
+        :type domain: str or None
+        :returns: PNG screenshot of webpage
+        :rtype: bytes
         """
-        Upload a file to Imgur.
+        screenshot = self._render_pooled(url, domain)
+        if self.debug_screenshot_dir:
+            self._save_screenshot(screenshot)
+        return screenshot
+
+    def _save_screenshot(self, screenshot):
+        with NamedTemporaryFile(suffix='.png',
+                                dir=self.debug_screenshot_dir,
+                                delete=False) as screenshot_file:
+            screenshot_file.write(screenshot)
+        log.debug("wrote screenshot to %s", screenshot_file.name)
+
+    def _render_pooled(self, url, domain=None):
+        with self.driver_pool.driver() as driver:
+            # timed from checkout, so waiting on the pool isn't held against
+            # the domain
+            self.driver = driver
+            started = time.time()
+            failed = True
+            try:
+                screenshot = self.render(url)
+                failed = time.time() - started >= self.render_timeout
+                return screenshot
+            finally:
+                elapsed = time.time() - started
+                self._busy_seconds += elapsed
+                self.driver = None
+                if domain is not None and self.circuit_breaker is not None:
+                    self.circuit_breaker.record(domain, elapsed, failed)
 
-        :param str file_path: path to file to upload
+    def upload(self, screenshot):
+        """
+        Upload a screenshot to Imgur, straight from memory.
+
+        :param screenshot: PNG image
+        :type screenshot: bytes or memoryview
         :returns: URL of screenshot and image deletehash
         :rtype: tuple[str, str]
         """
-        log.debug("uploading %s to imgur", file_path)
-        response = self._imgur.upload_from_path(file_path)
-        log.debug("upload respons: %r", response)
-        return response['link'], response['deletehash']
+        return upload_screenshot(self._imgur, screenshot)
 
 
 class CommentContextRenderer(Renderer):
-    """Rewrites Reddit comment URLs with extra context before screenshotting."""
+    """
+    Screenshots Reddit comments with extra context.
+
+    Comment URLs are rewritten to show parent comments, and screenshots
+    clipped to the linked comment and its parents. With the `api` comment
+    engine, comments are instead fetched from Reddit's API and laid out on a
+    static page, which the browser only has to draw; pages the API can't
+    provide are rendered in full as a fallback.
+    """
+
+    COMMENT_CONTEXT = 9
+    """Parent comments shown above a linked comment."""
+
+    COMMENT_ENGINES = ('browser', 'api')
+    """Ways comments can be rendered."""
+
+    WRITE_PAGE_JS = """
+    document.open();
+    document.write(arguments[0]);
+    document.close();
+    """
+    """Replaces the current page with the given HTML."""
+
+    def __init__(self, *args, comment_engine='browser', **kwargs):
+        """
+        Create a new CommentContextRenderer.
+
+        Takes the arguments of :class:`Renderer`, and:
+
+        :param str comment_engine: `browser` to render comments by loading
+        their Reddit pages, or `api` to lay them out from Reddit's API
+        :raises ValueError: if `comment_engine` isn't one of
+        :attr:`COMMENT_ENGINES`
+        """
+        if comment_engine not in self.COMMENT_ENGINES:
+            raise ValueError(
+                "Unknown comment engine {!r}".format(comment_engine))
+        super().__init__(*args, **kwargs)
+        self.comment_engine = comment_engine
+        self.comment_pages = None
+        if comment_engine == 'api':
+            self.comment_pages = CommentThreadPages(
+                self._reddit_args.get('user_agent', 'shotbot'),
+                context=self.COMMENT_CONTEXT)
+
+    COMMENT_THREAD_JS = """
+    var comment = document.getElementById(arguments[0]);
+    if (!comment) {
+        return null;
+    }
+    var thread = comment;
+    for (var node = comment.parentElement; node; node = node.parentElement) {
+        if (node.classList.contains('comment')) {
+            thread = node;
+        }
+    }
+    var replies = comment.querySelector('.child');
+    if (replies) {
+        replies.style.display = 'none';
+    }
+    return thread;
+    """
+    """Finds a comment's outermost parent comment, hiding its replies."""
 
     @staticmethod
-    def _set_comment_context(url, context=9):
+    def _set_comment_context(url, context=COMMENT_CONTEXT):
         url = urlsplit(url)
         query = parse_qs(url.query)
         query['context'] = context
@@ -256,16 +1263,95 @@ class CommentContextRenderer(Renderer):
 
     def render(self, url, max_height=MAX_SCREENSHOT_HEIGHT):
         """
-        Render a screenshot of a webpage to a temporary file.
+        Render a screenshot of a webpage.
 
         If the URL is a Reddit comment URL, sets the `context` parameter to `9`
         before rendering.
 
         :param str url: URL of webpage to render
         :param int max_height: maximum height in px
-        :returns: path to PNG screenshot of webpage
-        :rtype: str
+        :returns: PNG screenshot of webpage
+        :rtype: bytes
         """
         if is_comment_url(url):
             url = self._set_comment_context(url)
+            if self.comment_pages is not None:
+                screenshot = self._render_comment_page(url, max_height)
+                if screenshot is not None:
+                    return screenshot
         return super().render(url, max_height)
+
+    def _render_comment_page(self, url, max_height):
+        """
+        Render a comment from a page laid out from Reddit's API.
+
+        :param str url: a Reddit comment URL
+        :param int max_height: maximum height in px
+        :returns: PNG screenshot of the comment and its parents, or None if
+        the API couldn't provide them
+        :rtype: bytes or None
+        """
+        try:
+            page = self.comment_pages(url)
+        except (requests.RequestException, RendererException):
+            log.warning("couldn't lay out %s from the API; loading it instead",
+                        url,
+                        exc_info=True)
+            return None
+        log.debug("rendering %s from the API", url)
+        self.driver.get('about:blank')
+        self.driver.execute_script(self.WRITE_PAGE_JS, page)
+        thread = self.driver.find_element_by_id(self.comment_pages.THREAD_ID)
+        return self._screenshot_element(thread, max_height)
+
+    def _clip_element(self, url):
+        """
+        Find the element a page's screenshot is clipped to.
+
+        Comment pages are clipped to the linked comment's thread, from its
+        outermost parent down to the comment itself.
+
+        :param str url: URL of the loaded page
+        :returns: element to screenshot
+        :rtype: WebElement
+        """
+        if is_comment_url(url):
+            thread = self.driver.execute_script(
+                self.COMMENT_THREAD_JS,
+                'thing_t1_{}'.format(comment_id_from_url(url)))
+            if thread is not None:
+                return thread
+            log.debug("comment not found on %s; not clipping", url)
+        return super()._clip_element(url)
+
+    def _ready_condition(self, url):
+        """
+        Condition a page must meet before it's rendered.
+
+        Comment pages are ready as soon as the linked comment is laid out,
+        without waiting on the rest of the page.
+
+        :param str url: URL of the page
+        :returns: a :class:`WebDriverWait` condition
+        :rtype: callable
+        """
+        if is_comment_url(url):
+            comment = (By.ID, 'thing_t1_{}'.format(comment_id_from_url(url)))
+            return expect.visibility_of_element_located(comment)
+        return super()._ready_condition(url)
+
+    def cache_key(self, url):
+        """
+        Key screenshots of a URL are cached under.
+
+        Every link to a Reddit comment renders the same page, whatever the
+        rest of the URL says, so they share a key.
+
+        :param str url: URL of webpage
+        :returns: comment ID and context, or the canonical form of the URL
+        :rtype: str
+        """
+        if is_comment_url(url):
+            return 'comment:{}?context={}'.format(comment_id_from_url(url),
+                                                  self.COMMENT_CONTEXT)
+        return super().cache_key(url)
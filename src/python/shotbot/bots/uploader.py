@@ -0,0 +1,281 @@
+"""Uploads rendered screenshots."""
+import base64
+import datetime
+import logging
+import time
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+import imgurpython
+import requests
+from imgurpython.helpers.error import (ImgurClientError,
+                                       ImgurClientRateLimitError)
+from sqlalchemy.sql import and_
+
+from ..utils import (connect_db, record_screenshot_failure,
+                     release_connection)
+
+__all__ = ('Uploader', 'upload_screenshot')
+
+log = logging.getLogger(__name__)
+
+
+def upload_screenshot(imgur, screenshot):
+    """
+    Upload a screenshot to Imgur, straight from memory.
+
+    :param ImgurClient imgur: client to upload with
+    :param screenshot: PNG image
+    :type screenshot: bytes or memoryview
+    :returns: URL of screenshot and image deletehash
+    :rtype: tuple[str, str]
+    """
+    log.debug("uploading %d byte screenshot to imgur", len(screenshot))
+    data = {'image': base64.b64encode(screenshot), 'type': 'base64'}
+    response = imgur.make_request('POST', 'upload', data, True)
+    log.debug("upload response: %r", response)
+    return response['link'], response['deletehash']
+
+
+class Uploader():
+    """
+    Uploads screenshots to Imgur on a pool of threads, off the renderers'.
+
+    Renderers :meth:`submit` screenshots of the submissions they've claimed
+    and move straight on to their next submission; an upload thread later
+    stores the hosted URL. If the upload fails, the failure is counted and
+    the claim left to expire before the submission is rendered again; if
+    Imgur's rate limit is hit, the submission is put off until it's lifted.
+    """
+
+    WORKERS = 2
+    """Default number of upload threads."""
+
+    QUEUE_SIZE = 8
+    """Default most screenshots waiting to be uploaded."""
+
+    WAIT_INTERVAL = 1
+    """Most seconds to block on the queue between checks of the kill switch."""
+
+    RATE_LIMIT_DELAY = datetime.timedelta(hours=1)
+    """Time a submission is put off for after hitting Imgur's rate limit."""
+
+    def __init__(self,
+                 imgur_auth,
+                 db,
+                 kill_switch,
+                 workers=WORKERS,
+                 queue_size=QUEUE_SIZE,
+                 new_screenshots=None,
+                 optimizer=None,
+                 screenshot_cache=None):
+        """
+        Create a new Uploader.
+
+        :param imgur_auth: dict of arguments to pass to :class:`ImgurClient`
+        :type imgur_auth: dict[str, str]
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
+        :param Event kill_switch: when set, :meth:`run` returns once the
+        screenshots already queued are uploaded
+        :param int workers: number of upload threads
+        :param int queue_size: most screenshots waiting to be uploaded; once
+        it's full, :meth:`submit` blocks, holding renderers back
+        :param Event new_screenshots: if given, set whenever a screenshot is
+        committed, to wake commenters
+        :param optimizer: if given, shrinks screenshots before they're
+        uploaded
+        :type optimizer: ScreenshotOptimizer or None
+        :param screenshot_cache: if given, uploaded screenshots are remembered
+        here, under the key they're submitted with
+        :type screenshot_cache: ScreenshotCache or None
+        """
+        self._imgur = imgurpython.ImgurClient(**imgur_auth)
+        self._db = connect_db(db)
+        self._kill = kill_switch
+        self.workers = workers
+        self._queue = Queue(maxsize=queue_size)
+        self._new_screenshots = new_screenshots
+        self.optimizer = optimizer
+        self.screenshot_cache = screenshot_cache
+        self._lock = Lock()
+        self._busy_seconds = 0.0
+        self._started = None
+        self.uploaded = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return '<{cls}({db_uri}, Imgur, {workers} workers)>'.format(
+            cls=self.__class__.__name__,
+            db_uri=self._db.url,
+            workers=self.workers)
+
+    @property
+    def queue_depth(self):
+        """Number of screenshots waiting to be uploaded."""
+        return self._queue.qsize()
+
+    @property
+    def queue_size(self):
+        """Most screenshots that can wait to be uploaded."""
+        return self._queue.maxsize
+
+    @property
+    def utilization(self):
+        """Fraction of upload threads' time spent uploading since started."""
+        if self._started is None:
+            return 0.0
+        elapsed = (time.time() - self._started) * self.workers
+        return min(self._busy_seconds / elapsed, 1.0) if elapsed else 0.0
+
+    def submit(self, submission_id, worker_id, screenshot, cache_key=None):
+        """
+        Queue a screenshot to be uploaded and stored against a submission.
+
+        Blocks while the queue is full.
+
+        :param int submission_id: ID of the submission the screenshot is of
+        :param str worker_id: the renderer holding the submission's claim
+        :param screenshot: PNG image
+        :type screenshot: bytes or memoryview
+        :param cache_key: if given, key to cache the uploaded screenshot under
+        :type cache_key: str or None
+        :returns: False if killed before the screenshot could be queued
+        :rtype: bool
+        """
+        while not self._kill.is_set():
+            try:
+                self._queue.put(
+                    (submission_id, worker_id, screenshot, cache_key),
+                    timeout=self.WAIT_INTERVAL)
+                log.debug("submission %d screenshot queued for upload",
+                          submission_id)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run(self):
+        """Upload queued screenshots until killed and the queue is empty."""
+        log.debug("%r running", self)
+        self._started = time.time()
+        threads = [
+            Thread(name='uploader-{}'.format(i), target=self._work)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=self.WAIT_INTERVAL)
+            except Empty:
+                if self._kill.is_set():
+                    break
+                continue
+            started = time.time()
+            try:
+                self._process_upload(*job)
+            except Exception:  # pylint: disable=broad-except
+                # one bad screenshot mustn't take the upload thread with it
+                log.exception("failed to upload submission %d screenshot",
+                              job[0])
+                with self._lock:
+                    self.failed += 1
+                self._record_failed(job[0])
+            finally:
+                with self._lock:
+                    self._busy_seconds += time.time() - started
+                self._queue.task_done()
+
+    def _process_upload(self,
+                        submission_id,
+                        worker_id,
+                        screenshot,
+                        cache_key=None):
+        db = self._db
+        try:
+            submissions_table = db['submissions']
+            if self.optimizer is not None:
+                screenshot = self.optimizer(screenshot)
+            try:
+                url, deletehash = self.upload(screenshot)
+            except ImgurClientRateLimitError:
+                until = datetime.datetime.utcnow() + self.RATE_LIMIT_DELAY
+                log.warning("imgur rate limit hit; deferring submission %d "
+                            "until %s", submission_id, until)
+                with self._lock:
+                    self.failed += 1
+                self._defer(submissions_table, submission_id, worker_id,
+                            until)
+                return
+            except (ImgurClientError, requests.RequestException):
+                log.exception("failed to upload submission %d screenshot",
+                              submission_id)
+                with self._lock:
+                    self.failed += 1
+                record_screenshot_failure(submissions_table, submission_id)
+                return
+            if cache_key is not None and self.screenshot_cache is not None:
+                self.screenshot_cache.put(cache_key, url, deletehash)
+            if self._store(submissions_table, submission_id, url, deletehash):
+                db.commit()
+                with self._lock:
+                    self.uploaded += 1
+                log.info("submission %d screenshot uploaded to %r",
+                         submission_id, url)
+                if self._new_screenshots is not None:
+                    self._new_screenshots.set()
+            else:
+                log.info("submission %d screenshotted elsewhere meanwhile; "
+                         "discarding %r", submission_id, url)
+        finally:
+            release_connection(db)
+
+    def _record_failed(self, submission_id):
+        """Count a failure for a submission whose upload failed oddly."""
+        db = self._db
+        try:
+            record_screenshot_failure(db['submissions'], submission_id)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("failed to record submission %d failing; it'll "
+                          "be retried once the lock expires", submission_id)
+        finally:
+            release_connection(db)
+
+    @staticmethod
+    def _store(submissions_table, submission_id, url, deletehash):
+        table = submissions_table.table
+        col = table.columns
+        result = submissions_table.db.executable.execute(table.update().where(
+            and_(col.id == submission_id,
+                 col.bot_screenshot_at == None)).values(  # noqa
+                     bot_screenshot_url=url,
+                     bot_screenshot_deletehash=deletehash,
+                     bot_screenshot_at=datetime.datetime.utcnow()))
+        return result.rowcount == 1
+
+    @staticmethod
+    def _defer(submissions_table, submission_id, worker_id, until):
+        """Put off rendering a submission, releasing our claim until then."""
+        table = submissions_table.table
+        col = table.columns
+        submissions_table.db.executable.execute(table.update().where(
+            and_(col.id == submission_id,
+                 col.bot_screenshot_worker == worker_id,
+                 col.bot_screenshot_at == None)).values(  # noqa
+                     bot_screenshot_lock=until, bot_screenshot_worker=None))
+
+    def upload(self, screenshot):
+        """
+        Upload a screenshot to Imgur, straight from memory.
+
+        :param screenshot: PNG image
+        :type screenshot: bytes or memoryview
+        :returns: URL of screenshot and image deletehash
+        :rtype: tuple[str, str]
+        """
+        return upload_screenshot(self._imgur, screenshot)
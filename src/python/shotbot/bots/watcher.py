@@ -1,86 +1,561 @@
 """Watches a subreddit for submissions."""
+import datetime
+import itertools
 import logging
+import time
 
-import dataset
 import praw
+import sqlalchemy.types
+from sqlalchemy.sql import select
 
-from ..utils import (base36_decode, remove_blacklisted_fields,
-                     submission_as_dict)
+from ..utils import (SeenIndex, base36_decode, connect_db, ensure_schema,
+                     release_connection, submission_as_dict, subreddit_name)
 
-__all__ = ('Watcher', )
+__all__ = ('Watcher', 'MultiWatcher', 'PollSchedule')
 
 log = logging.getLogger(__name__)
 
 
+class PollSchedule():
+    """
+    Decides when a listing is next due a poll from how often it gets posts.
+
+    Tracks a smoothed arrival rate and polls often enough to expect about
+    `target` new submissions each time, within `min_interval` and
+    `max_interval`, so busy listings are noticed quickly and quiet ones don't
+    waste API requests.
+    """
+
+    def __init__(self, min_interval, max_interval, target=1, smoothing=0.3):
+        """
+        Create a new PollSchedule.
+
+        :param float min_interval: fewest seconds between polls
+        :param float max_interval: most seconds between polls
+        :param float target: new submissions hoped for on each poll
+        :param float smoothing: weight given to the latest poll's arrival
+        rate, between 0 and 1
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target = target
+        self.smoothing = smoothing
+        self.rate = None
+        self.interval = min_interval
+        self.last_poll = None
+        self.next_poll = 0
+
+    def __repr__(self):
+        return '<{cls}({rate} posts/s, every {interval:.0f}s)>'.format(
+            cls=self.__class__.__name__,
+            rate='?' if self.rate is None else '{:.4f}'.format(self.rate),
+            interval=self.interval)
+
+    def due(self, now=None):
+        """
+        :param now: `time.monotonic()` time; defaults to now
+        :type now: float or None
+        :returns: True if the listing should be polled
+        :rtype: bool
+        """
+        return (time.monotonic() if now is None else now) >= self.next_poll
+
+    def polled(self, new_count, now=None):
+        """
+        Record a poll, and schedule the next.
+
+        The first poll's count is ignored, as it replays the whole listing;
+        with no rate known yet, the next poll is due after `min_interval`, so
+        one is measured quickly.
+
+        :param int new_count: number of new submissions the poll returned
+        :param now: `time.monotonic()` time; defaults to now
+        :type now: float or None
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.last_poll is not None:
+            rate = new_count / max(now - self.last_poll, 1)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = (self.smoothing * rate +
+                             (1 - self.smoothing) * self.rate)
+        self.last_poll = now
+        if self.rate is None:
+            interval = self.min_interval
+        else:
+            interval = (self.target / self.rate
+                        if self.rate else self.max_interval)
+        self.interval = min(max(interval, self.min_interval),
+                            self.max_interval)
+        self.next_poll = now + self.interval
+
+
 class Watcher():
     """Watches a subreddit and inserts submissions into a database."""
 
+    SEEN_INDEX_SIZE = 10000
+    """Default number of submission IDs remembered in memory."""
+
+    INSERT_BATCH_SIZE = 100
+    """Most new submissions buffered before they're written to the DB."""
+
+    INSERT_BATCH_TIME = datetime.timedelta(seconds=10)
+    """Longest a new submission is buffered before it's written to the DB."""
+
+    CURSOR_TABLE = 'stream_cursors'
+    """Table recording the newest submission seen in each listing."""
+
+    CATCH_UP_PAGE_SIZE = 100
+    """Submissions requested per page when catching up from a cursor."""
+
+    MIN_POLL_INTERVAL = 15
+    """Default fewest seconds between polls of a listing."""
+
+    MAX_POLL_INTERVAL = 300
+    """Default most seconds between polls of a listing."""
+
     def __init__(self,
                  reddit_args,
-                 db_uri,
+                 db,
                  subreddit,
                  kill_switch,
-                 filter_fn=None):
+                 filter_fn=None,
+                 seen_index_size=SEEN_INDEX_SIZE,
+                 min_poll_interval=MIN_POLL_INTERVAL,
+                 max_poll_interval=MAX_POLL_INTERVAL,
+                 extra_fields=False,
+                 new_submissions=None):
         """
         Create a new Watcher.
 
         :param reddit_args: dict of arguments to pass to :class:`Reddit`
         :type reddit_args: dict[str, str]
-        :param str db_uri: SQLAlchemy-style DB URI
-        :param str subreddit: name of the subreddit to watch
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
+        :param subreddit: name of the subreddit to watch
+        :type subreddit: str or None
         :param Event kill_switch: when set, breaks the loop in :meth:`run`,
         and prevents :meth:`_process_submissions` from processing submissions
         :param callable filter_fn: if set, ignore submissions for which
-        `filter_fn(submission)` returns False
+        `filter_fn(submission)` returns False, before they're serialized or
+        looked up in the DB
+        :param int seen_index_size: number of recently seen submission IDs to
+        remember, so duplicates are rejected without querying the DB
+        :param float min_poll_interval: fewest seconds between polls
+        :param float max_poll_interval: most seconds between polls
+        :param bool extra_fields: if True, store undeclared submission fields
+        as JSON; see :func:`submission_as_dict`
+        :param Event new_submissions: if set, set whenever new submissions are
+        committed, to wake renderers
         """
         self._reddit = praw.Reddit(**reddit_args)
         # self._reddit.read_only = True
-        self._db_uri = db_uri
-        self.subreddit = self._reddit.subreddit(subreddit)
+        self._db = connect_db(db)
+        self.subreddit = None
+        if subreddit:
+            self.subreddit = self._reddit.subreddit(subreddit)
         self._kill = kill_switch
         self.filter = filter_fn
+        self.seen_ids = SeenIndex(seen_index_size)
+        self._seen_ids_seeded = False
+        self.extra_fields = extra_fields
+        self._new_submissions = new_submissions
+        self._pending = []
+        self._pending_since = None
+        self._cursors = {}
+        self._dirty_cursors = set()
+        self._streams = {}
+        self._poll_intervals = (min_poll_interval, max_poll_interval)
+        self._schedules = {}
 
     def __repr__(self):
         return '<{cls}(/r/{subreddit}, {db_uri})>'.format(
             cls=self.__class__.__name__,
             subreddit=self.subreddit.display_name,
-            db_uri=self._db_uri)
+            db_uri=self._db.url)
 
     def run(self):
         """Watch submission stream until the kill switch is flipped."""
         log.debug("%r running", self)
         while True:
             self._process_submissions()
-            self._kill.wait(60)
+            self._kill.wait(self._seconds_until_due())
             if self._kill.is_set():
                 return
 
+    def _schedule(self, listing):
+        if listing not in self._schedules:
+            self._schedules[listing] = PollSchedule(*self._poll_intervals)
+        return self._schedules[listing]
+
+    def _seconds_until_due(self):
+        now = time.monotonic()
+        return max(
+            min(self._schedule(str(subreddit)).next_poll
+                for subreddit in self._subreddits()) - now, 0)
+
+    def _subreddits(self):
+        """
+        :returns: the listings polled each cycle
+        :rtype: list[Subreddit]
+        """
+        return [self.subreddit]
+
+    def _filter_for(self, submission):  # pylint: disable=unused-argument
+        """
+        :param Submission submission:
+        :returns: the filter that applies to `submission`, if any
+        :rtype: callable or None
+        """
+        return self.filter
+
+    def _log_filter_counts(self):
+        if self.filter:
+            log.debug("/r/%s filters: %r", self.subreddit.display_name,
+                      self.filter)
+
     def _process_submissions(self):
-        db = dataset.connect(self._db_uri)
+        db = self._db
         try:
             seen = db.create_table('submissions', primary_id='id')
-            submissions = self.subreddit.stream.submissions(pause_after=5)
-            for submission in submissions:
+            cursors = db.create_table(
+                self.CURSOR_TABLE,
+                primary_id='listing',
+                primary_type=sqlalchemy.types.String(length=512))
+            if not self._seen_ids_seeded:
+                ensure_schema(seen)
+                self._seed_seen_ids(db, seen)
+            try:
+                self._process_streams(db, seen, cursors)
+            finally:
+                self._flush_pending(db, seen, cursors)
+        finally:
+            log.debug("%r", self.seen_ids)
+            self._log_filter_counts()
+            release_connection(db)
+
+    def _process_streams(self, db, seen, cursors):
+        for subreddit in self._subreddits():
+            listing = str(subreddit)
+            schedule = self._schedule(listing)
+            if not schedule.due():
+                continue
+            new_count = self._process_stream(db, seen, cursors, subreddit)
+            if self._kill.is_set():
+                return
+            schedule.polled(new_count)
+            log.debug("/r/%s polled: %d new, %r", listing, new_count,
+                      schedule)
+
+    def _stream(self, cursors, subreddit):
+        """
+        :param Table cursors: the stream cursors table
+        :param Subreddit subreddit: listing to stream
+        :returns: the listing's stream, which yields None once it runs out of
+        new submissions, and resumes from there when next iterated
+        :rtype: Iterator[Submission or None]
+        """
+        listing = str(subreddit)
+        if listing not in self._streams:
+            stream = iter(subreddit.stream.submissions(pause_after=0))
+            if listing not in self._cursors:
+                stream = itertools.chain(self._catch_up(cursors, subreddit),
+                                         stream)
+            self._streams[listing] = stream
+        return self._streams[listing]
+
+    def _process_stream(self, db, seen, cursors, subreddit):
+        """
+        Process one listing's new submissions, until it runs out.
+
+        :param Database db:
+        :param Table seen: the submissions table
+        :param Table cursors: the stream cursors table
+        :param Subreddit subreddit: listing to process
+        :returns: number of submissions the listing yielded
+        :rtype: int
+        """
+        listing = str(subreddit)
+        stream = self._stream(cursors, subreddit)
+        count = 0
+        try:
+            for submission in stream:
                 if self._kill.is_set() or submission is None:
-                    return
-                if self.filter and not self.filter(submission):
-                    log.debug("Filtering submission %d",
-                              base36_decode(submission.id))
+                    break
+                count += 1
+                self._advance_cursor(listing, submission)
+                filter_fn = self._filter_for(submission)
+                if filter_fn and not filter_fn(submission):
+                    continue
                 if self._process_submission(seen, submission):
-                    db.commit()
-                    log.info("new submission %d inserted",
-                             base36_decode(submission.id))
-        finally:
-            if hasattr(db.local, 'conn'):
-                db.local.conn.close()
-            db.engine.dispose()
+                    log.debug("new submission %d queued",
+                              base36_decode(submission.id))
+                if self._pending_full():
+                    self._flush_pending(db, seen, cursors)
+            else:
+                # streams never end, unless they fail; start afresh next time
+                del self._streams[listing]
+        except Exception:
+            del self._streams[listing]
+            raise
+        self._flush_pending(db, seen, cursors)
+        return count
 
-    @staticmethod
-    def _process_submission(seen, submission):
+    def _catch_up(self, cursors, subreddit):
+        """
+        Page forward through submissions made since the listing's cursor.
+
+        Yields oldest first, so the cursor only ever moves forward. If the
+        cursor's submission has been deleted, Reddit lists nothing before it,
+        so the listing is instead scanned back to the cursor's time.
+
+        :param Table cursors: the stream cursors table
+        :param Subreddit subreddit: listing to catch up on
+        :returns: submissions newer than the cursor
+        :rtype: Iterator[Submission]
+        """
+        listing = str(subreddit)
+        cursor = cursors.find_one(listing=listing)
+        self._cursors[listing] = cursor
+        if not cursor:
+            log.debug("no cursor for /r/%s; starting cold", listing)
+            return
+        log.debug("catching up /r/%s from %s", listing, cursor['fullname'])
+        before = cursor['fullname']
+        caught_up = 0
+        while not self._kill.is_set():
+            page = list(
+                subreddit.new(limit=self.CATCH_UP_PAGE_SIZE,
+                              params={'before': before}))
+            if not page and before == cursor['fullname']:
+                page = self._scan_since(subreddit, cursor['created_utc'])
+                if page:
+                    log.warning(
+                        "/r/%s cursor %s gone; caught up by time instead",
+                        listing, cursor['fullname'])
+                yield from reversed(page)
+                caught_up += len(page)
+                break
+            # listings are newest first
+            yield from reversed(page)
+            caught_up += len(page)
+            if len(page) < self.CATCH_UP_PAGE_SIZE:
+                break
+            before = page[0].fullname
+        log.info("caught up on %d submissions in /r/%s", caught_up, listing)
+
+    def _scan_since(self, subreddit, created_utc):
+        """
+        Page back from a listing's newest submission to a point in time.
+
+        :param Subreddit subreddit: listing to scan
+        :param float created_utc: time to scan back to
+        :returns: submissions made after `created_utc`, newest first
+        :rtype: list[Submission]
+        """
+        newer = []
+        after = None
+        while not self._kill.is_set():
+            page = list(
+                subreddit.new(limit=self.CATCH_UP_PAGE_SIZE,
+                              params={'after': after} if after else {}))
+            newer.extend(submission for submission in page
+                         if submission.created_utc > created_utc)
+            if (len(page) < self.CATCH_UP_PAGE_SIZE
+                    or page[-1].created_utc <= created_utc):
+                break
+            after = page[-1].fullname
+        return newer
+
+    def _advance_cursor(self, listing, submission):
+        cursor = self._cursors.get(listing)
+        if cursor and cursor['created_utc'] >= submission.created_utc:
+            return
+        self._cursors[listing] = {
+            'listing': listing,
+            'fullname': submission.fullname,
+            'created_utc': submission.created_utc,
+        }
+        self._dirty_cursors.add(listing)
+
+    def _pending_full(self):
+        if len(self._pending) >= self.INSERT_BATCH_SIZE:
+            return True
+        return bool(self._pending) and (datetime.datetime.utcnow() -
+                                        self._pending_since >=
+                                        self.INSERT_BATCH_TIME)
+
+    def _flush_pending(self, db, seen, cursors):
+        """
+        Insert buffered submissions and save cursors in a single transaction.
+
+        Cursors are only saved alongside the submissions they've passed, so a
+        restart never skips a submission that wasn't stored.
+
+        :param Database db:
+        :param Table seen: the submissions table
+        :param Table cursors: the stream cursors table
+        """
+        if not self._pending and not self._dirty_cursors:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_since = None
+        dirty, self._dirty_cursors = self._dirty_cursors, set()
+        db.begin()
+        try:
+            if pending:
+                # the schema is fixed; never alter the table mid-insert, and
+                # insert on this thread's connection, inside the transaction
+                db.executable.execute(seen.table.insert(), pending)
+            for listing in dirty:
+                cursors.upsert(self._cursors[listing], ['listing'])
+            db.commit()
+        except Exception:
+            db.rollback()
+            # let them be seen, and inserted, again next time
+            for row in pending:
+                self.seen_ids.discard(row['id'])
+            self._dirty_cursors |= dirty
+            raise
+        if pending:
+            log.info("%d new submissions inserted", len(pending))
+            if self._new_submissions is not None:
+                self._new_submissions.set()
+
+    def _seed_seen_ids(self, db, seen):
+        query = select([seen.table.columns.id]).order_by(
+            seen.table.columns.id.desc()).limit(self.seen_ids.maxsize)
+        # oldest first, so the newest are the last to be evicted
+        for row in reversed(list(db.query(query))):
+            self.seen_ids.add(row['id'])
+        log.debug("seeded seen index with %d IDs", len(self.seen_ids))
+        self._seen_ids_seeded = True
+
+    def _process_submission(self, seen, submission):
         _id = base36_decode(submission.id)
+        if _id in self.seen_ids:
+            return False
         existing = seen.find_one(id=_id)
+        self.seen_ids.add(_id)
         if existing:
             # log.debug("submission %d seen before", _id)
             return False
-        seen.insert(remove_blacklisted_fields(submission_as_dict(submission)))
+        if not self._pending:
+            self._pending_since = datetime.datetime.utcnow()
+        self._pending.append(
+            submission_as_dict(submission, self.extra_fields))
         return True
+
+
+class MultiWatcher(Watcher):
+    """
+    Watches many subreddits through combined ``a+b+c`` listings.
+
+    Reddit serves a combined listing for the same cost as a single subreddit,
+    so API usage stays roughly flat as the number of watched subreddits grows.
+    Names are chunked so each combined listing's URL stays a sensible length.
+
+    Stream cursors are kept per combined listing, so changing the watched
+    subreddits starts the affected listings cold.
+    """
+
+    MAX_COMBINED_LENGTH = 512
+    """Longest ``a+b+c`` path segment requested in one listing."""
+
+    def __init__(self,
+                 reddit_args,
+                 db,
+                 subreddit_filters,
+                 kill_switch,
+                 seen_index_size=Watcher.SEEN_INDEX_SIZE,
+                 min_poll_interval=Watcher.MIN_POLL_INTERVAL,
+                 max_poll_interval=Watcher.MAX_POLL_INTERVAL,
+                 extra_fields=False,
+                 new_submissions=None):
+        """
+        Create a new MultiWatcher.
+
+        :param reddit_args: dict of arguments to pass to :class:`Reddit`
+        :type reddit_args: dict[str, str]
+        :param db: shared database, or an SQLAlchemy-style DB URI
+        :type db: Database or str
+        :param subreddit_filters: filter function, or None, for each subreddit
+        to watch, keyed by subreddit name
+        :type subreddit_filters: dict[str, callable or None]
+        :param Event kill_switch: when set, breaks the loop in :meth:`run`,
+        and prevents :meth:`_process_submissions` from processing submissions
+        :param int seen_index_size: number of recently seen submission IDs to
+        remember, so duplicates are rejected without querying the DB
+        :param float min_poll_interval: fewest seconds between polls of each
+        combined listing
+        :param float max_poll_interval: most seconds between polls of each
+        combined listing
+        :param bool extra_fields: if True, store undeclared submission fields
+        as JSON; see :func:`submission_as_dict`
+        :param Event new_submissions: if set, set whenever new submissions are
+        committed, to wake renderers
+        """
+        super().__init__(reddit_args,
+                         db,
+                         None,
+                         kill_switch,
+                         seen_index_size=seen_index_size,
+                         min_poll_interval=min_poll_interval,
+                         max_poll_interval=max_poll_interval,
+                         extra_fields=extra_fields,
+                         new_submissions=new_submissions)
+        self.filters = {
+            name.lower(): filter_fn
+            for name, filter_fn in subreddit_filters.items()
+        }
+        self.subreddits = [
+            self._reddit.subreddit(combined)
+            for combined in self.combine(subreddit_filters,
+                                         self.MAX_COMBINED_LENGTH)
+        ]
+
+    def __repr__(self):
+        return '<{cls}({count} subreddits, {db_uri})>'.format(
+            cls=self.__class__.__name__,
+            count=len(self.filters),
+            db_uri=self._db.url)
+
+    @staticmethod
+    def combine(names, max_length):
+        """
+        Join subreddit names into ``a+b+c`` strings no longer than max_length.
+
+        A single name longer than `max_length` gets a chunk to itself.
+
+        :param names: subreddit names
+        :type names: iterable[str]
+        :param int max_length: maximum length of each combined name
+        :returns: combined subreddit names
+        :rtype: list[str]
+        """
+        chunks = []
+        chunk = []
+        length = 0
+        for name in names:
+            if chunk and length + 1 + len(name) > max_length:
+                chunks.append('+'.join(chunk))
+                chunk = []
+                length = 0
+            length += len(name) + (1 if chunk else 0)
+            chunk.append(name)
+        if chunk:
+            chunks.append('+'.join(chunk))
+        return chunks
+
+    def _subreddits(self):
+        return self.subreddits
+
+    def _filter_for(self, submission):
+        return self.filters.get(subreddit_name(submission))
+
+    def _log_filter_counts(self):
+        for subreddit, filter_fn in self.filters.items():
+            if filter_fn:
+                log.debug("/r/%s filters: %r", subreddit, filter_fn)
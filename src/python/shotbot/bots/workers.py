@@ -0,0 +1,338 @@
+"""Runs renderers in worker processes, each with its own GIL and memory."""
+import logging
+import logging.handlers
+import multiprocessing
+import signal
+import time
+from threading import Event, Thread
+
+from ..breaker import CircuitBreaker
+from ..exceptions import RendererException
+from ..images import ScreenshotOptimizer
+from ..utils import ScreenshotCache, connect_db
+from .renderer import CommentContextRenderer, DriverFactory, DriverPool
+from .uploader import Uploader
+
+__all__ = ('RendererSupervisor', )
+
+log = logging.getLogger(__name__)
+
+CONTEXT = multiprocessing.get_context('spawn')
+"""
+Workers are spawned, not forked, so they don't inherit the locks and
+connections of the main process's threads.
+"""
+
+STATS = ('renderer_utilization', 'upload_queue_depth', 'uploader_utilization',
+         'open_circuits')
+"""Stats each worker publishes to the supervisor, in order."""
+
+STATS_INTERVAL = 5
+"""Seconds between a worker publishing its stats."""
+
+
+def _publish_stats(stats, renderer, uploader, circuit_breaker, stop):
+    """
+    Copy a worker's stats to shared memory, until `stop` is set.
+
+    :param Array stats: where to write each of :data:`STATS`
+    :param Renderer renderer:
+    :param Uploader uploader:
+    :param CircuitBreaker circuit_breaker:
+    :param Event stop:
+    """
+    while True:
+        values = (renderer.utilization, uploader.queue_depth,
+                  uploader.utilization,
+                  len(circuit_breaker.open_domains()))
+        with stats.get_lock():
+            stats[:] = values
+        if stop.wait(STATS_INTERVAL):
+            break
+
+
+def _run_worker(options, kill_switch, new_submissions, new_screenshots,
+                stats, log_queue, log_level):
+    """
+    Render submissions until killed; the entry point of a worker process.
+
+    Each worker has its own browsers, uploader, screenshot cache and circuit
+    breaker, and claims submissions from the DB like any other renderer.
+
+    :param options: see :meth:`RendererSupervisor.__init__`
+    :type options: dict[str, Any]
+    :param Event kill_switch: set when this worker should finish up and exit
+    :param Event new_submissions:
+    :param Event new_screenshots:
+    :param Array stats: where to publish :data:`STATS` for the supervisor
+    :param Queue log_queue: where to send log records, for the main process
+    to handle
+    :param int log_level:
+    """
+    # the main process decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(log_level)
+
+    db = connect_db(options['db_uri'], **options['db_pool'])
+    driver_pool = DriverPool(
+        DriverFactory(options['reddit_args'], **options['browser']),
+        **dict(options['driver_pool'], min_size=1, max_size=1))
+    optimizer = None
+    if options['optimizer'] is not None:
+        optimizer = ScreenshotOptimizer(**options['optimizer'])
+    screenshot_cache = ScreenshotCache(**options['screenshot_cache'])
+    # uploads outlive the renderer, however it stops, to drain the queue
+    stop_uploads = Event()
+    uploader = Uploader(options['imgur_auth'],
+                        db,
+                        stop_uploads,
+                        new_screenshots=new_screenshots,
+                        optimizer=optimizer,
+                        screenshot_cache=screenshot_cache,
+                        **options['uploader'])
+    circuit_breaker = CircuitBreaker(**options['circuit_breaker'])
+    renderer = CommentContextRenderer(
+        options['imgur_auth'],
+        options['reddit_args'],
+        db,
+        kill_switch,
+        driver_pool,
+        new_submissions=new_submissions,
+        new_screenshots=new_screenshots,
+        uploader=uploader,
+        screenshot_cache=screenshot_cache,
+        circuit_breaker=circuit_breaker,
+        **options['renderer'])
+    upload_thread = Thread(name='uploader', target=uploader.run)
+    upload_thread.start()
+    stop_stats = Event()
+    stats_thread = Thread(name='stats',
+                          target=_publish_stats,
+                          args=(stats, renderer, uploader, circuit_breaker,
+                                stop_stats))
+    stats_thread.start()
+    try:
+        renderer.run()
+    finally:
+        stop_stats.set()
+        stats_thread.join()
+        stop_uploads.set()
+        upload_thread.join()
+        driver_pool.close()
+        if optimizer is not None:
+            optimizer.close()
+        db.engine.dispose()
+
+
+class RendererSupervisor():
+    """
+    Runs renderers in worker processes, restarting any that die.
+
+    A worker that keeps dying soon after it's started is given up on, which
+    stops the supervisor, and with it the bot. The number of workers can be
+    changed while running with :meth:`resize`.
+    """
+
+    CHECK_INTERVAL = 5
+    """Seconds between checks that workers are alive."""
+
+    RESTART_DELAY = 10
+    """Seconds to wait before restarting a dead worker."""
+
+    MAX_RESTARTS = 5
+    """Default most times in a row a worker is restarted."""
+
+    STABLE_TIME = 300
+    """Seconds a worker must live for its restarts to stop counting."""
+
+    SHUTDOWN_TIMEOUT = 60
+    """Seconds workers have to exit once killed before they're terminated."""
+
+    def __init__(self,
+                 worker_count,
+                 options,
+                 kill_switch,
+                 new_submissions,
+                 new_screenshots,
+                 max_restarts=MAX_RESTARTS):
+        """
+        Create a new RendererSupervisor.
+
+        The events must be made with :data:`CONTEXT`, to be shared with
+        worker processes.
+
+        :param int worker_count: number of worker processes
+        :param options: everything a worker needs to build its renderer;
+        `imgur_auth`, `reddit_args`, `db_uri`, `db_pool`, `browser`,
+        `driver_pool`, `uploader`, `optimizer`, `screenshot_cache` and
+        `circuit_breaker` options, and `renderer` keyword arguments
+        :type options: dict[str, Any]
+        :param Event kill_switch: when set, workers finish up and exit
+        :param Event new_submissions: wakes workers when there's work
+        :param Event new_screenshots: set by workers when they store a
+        screenshot
+        :param max_restarts: most times in a row a worker is restarted
+        before giving up; None to never give up
+        :type max_restarts: int or None
+        """
+        self.worker_count = worker_count
+        self._options = options
+        self._kill = kill_switch
+        self._new_submissions = new_submissions
+        self._new_screenshots = new_screenshots
+        self.max_restarts = max_restarts
+        self._log_queue = CONTEXT.Queue()
+        self._workers = []
+        self._stops = []
+        self._started_at = []
+        self._stats = []
+        self.restarts = []
+        self._retired = []
+
+    def __repr__(self):
+        alive = sum(1 for worker in self._workers
+                    if worker is not None and worker.is_alive())
+        template = '<{cls}({alive}/{count} workers alive, {restarts} restarts)>'
+        return template.format(
+            cls=self.__class__.__name__,
+            alive=alive,
+            count=self.worker_count,
+            restarts=sum(self.restarts))
+
+    @property
+    def size(self):
+        """Number of workers that should be running."""
+        return self.worker_count
+
+    def resize(self, size):
+        """
+        Start or stop workers until `size` are running.
+
+        Takes effect at the supervisor's next check; stopped workers finish
+        the submissions they've claimed first.
+
+        :param int size: number of worker processes
+        """
+        self.worker_count = size
+
+    def stats(self):
+        """
+        Gather the stats workers last published.
+
+        Each worker has its own circuit breaker, so a domain tripped in more
+        than one worker is counted once for each.
+
+        :returns: mean renderer utilization, screenshots awaiting upload, mean
+        uploader utilization and domains tripped, across running workers
+        :rtype: dict[str, float]
+        """
+        totals = dict.fromkeys(STATS, 0.0)
+        published = [stats for stats in self._stats if stats is not None]
+        for stats in published:
+            with stats.get_lock():
+                values = list(stats)
+            for name, value in zip(STATS, values):
+                totals[name] += value
+        if published:
+            for name in ('renderer_utilization', 'uploader_utilization'):
+                totals[name] /= len(published)
+        totals['upload_queue_depth'] = int(totals['upload_queue_depth'])
+        totals['open_circuits'] = int(totals['open_circuits'])
+        return totals
+
+    def run(self):
+        """
+        Run workers until killed, then shut them down.
+
+        :raises RendererException: if a worker has to be given up on
+        """
+        log.debug("%r running", self)
+        root = logging.getLogger()
+        listener = logging.handlers.QueueListener(self._log_queue,
+                                                  *root.handlers,
+                                                  respect_handler_level=True)
+        listener.start()
+        try:
+            self._reconcile()
+            while not self._kill.wait(self.CHECK_INTERVAL):
+                for index, worker in enumerate(self._workers):
+                    if not worker.is_alive():
+                        self._restart(index)
+                self._reconcile()
+        finally:
+            self._shutdown()
+            listener.stop()
+
+    def _reconcile(self):
+        while len(self._workers) < self.worker_count:
+            self._workers.append(None)
+            self._stops.append(None)
+            self._started_at.append(None)
+            self._stats.append(None)
+            self.restarts.append(0)
+            self._start(len(self._workers) - 1)
+        while len(self._workers) > self.worker_count:
+            index = len(self._workers) - 1
+            log.debug("stopping renderer worker %d", index)
+            self._stops.pop().set()
+            self._retired.append(self._workers.pop())
+            self._started_at.pop()
+            self._stats.pop()
+            self.restarts.pop()
+            self._new_submissions.set()
+        self._retired = [
+            worker for worker in self._retired if worker.is_alive()
+        ]
+
+    def _start(self, index):
+        # each worker has its own kill switch, so it can be stopped alone
+        stop = CONTEXT.Event()
+        # a restarted worker starts its stats afresh
+        stats = CONTEXT.Array('d', len(STATS))
+        worker = CONTEXT.Process(
+            name='renderer-worker-{}'.format(index),
+            target=_run_worker,
+            args=(self._options, stop, self._new_submissions,
+                  self._new_screenshots, stats, self._log_queue,
+                  logging.getLogger().getEffectiveLevel()))
+        worker.start()
+        self._workers[index] = worker
+        self._stops[index] = stop
+        self._stats[index] = stats
+        self._started_at[index] = time.time()
+        log.debug("started renderer worker %d, pid %d", index, worker.pid)
+
+    def _restart(self, index):
+        worker = self._workers[index]
+        if time.time() - self._started_at[index] >= self.STABLE_TIME:
+            self.restarts[index] = 0
+        self.restarts[index] += 1
+        if (self.max_restarts is not None
+                and self.restarts[index] > self.max_restarts):
+            raise RendererException(
+                "renderer worker {} died {} times in a row; giving up".format(
+                    index, self.restarts[index]))
+        log.warning("renderer worker %d exited with code %s; restarting in "
+                    "%ds", index, worker.exitcode, self.RESTART_DELAY)
+        if self._kill.wait(self.RESTART_DELAY):
+            return
+        self._start(index)
+
+    def _shutdown(self):
+        self._kill.set()
+        for stop in self._stops:
+            if stop is not None:
+                stop.set()
+        self._new_submissions.set()
+        deadline = time.time() + self.SHUTDOWN_TIMEOUT
+        for worker in self._workers + self._retired:
+            if worker is None:
+                continue
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                log.warning("renderer worker %s didn't exit; terminating",
+                            worker.name)
+                worker.terminate()
+                worker.join()
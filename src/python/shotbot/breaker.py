@@ -0,0 +1,147 @@
+"""Keeps renderers away from domains that keep failing."""
+import datetime
+import logging
+import time
+from threading import Lock
+
+__all__ = ('CircuitBreaker', )
+
+log = logging.getLogger(__name__)
+
+
+class _Circuit():
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.renders = 0
+        self.latency = None
+
+
+class CircuitBreaker():
+    """
+    Tracks render failures and latency per domain, tripping on repeated ones.
+
+    A domain's circuit opens after `failure_threshold` failures in a row.
+    While it's open, :meth:`allows` refuses renders of the domain, until
+    `reset_timeout` has passed; then one trial render is let through, and its
+    outcome closes the circuit again or reopens it. A trial that never
+    reports back is given up on after another `reset_timeout`.
+    """
+
+    FAILURE_THRESHOLD = 3
+    """Default consecutive failures that open a domain's circuit."""
+
+    RESET_TIMEOUT = datetime.timedelta(minutes=15)
+    """Default time a domain's circuit stays open before a trial render."""
+
+    LATENCY_SMOOTHING = 0.3
+    """Weight of the latest render in each domain's moving average latency."""
+
+    def __init__(self,
+                 failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        """
+        Create a new CircuitBreaker.
+
+        :param int failure_threshold: consecutive failures that open a
+        domain's circuit
+        :param timedelta reset_timeout: time an open circuit refuses renders
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout.total_seconds()
+        self._lock = Lock()
+        self._circuits = {}
+
+    def __repr__(self):
+        return '<{cls}({open} open of {domains} domains)>'.format(
+            cls=self.__class__.__name__,
+            open=len(self.open_domains()),
+            domains=len(self._circuits))
+
+    def allows(self, domain):
+        """
+        Check whether a render of a domain may go ahead.
+
+        :param str domain:
+        :returns: False while the domain's circuit is open, or while another
+        trial render is under way
+        :rtype: bool
+        """
+        with self._lock:
+            circuit = self._circuits.get(domain)
+            if circuit is None or circuit.opened_at is None:
+                return True
+            now = time.time()
+            if now < self._retry_time(circuit):
+                return False
+            log.info("letting a trial render of %s through", domain)
+            circuit.trial_at = now
+            return True
+
+    def retry_at(self, domain):
+        """
+        :param str domain:
+        :returns: when the domain's circuit next lets a render through
+        :rtype: datetime
+        """
+        with self._lock:
+            circuit = self._circuits.get(domain)
+            retry_time = (self._retry_time(circuit)
+                          if circuit and circuit.opened_at else time.time())
+        return datetime.datetime.utcfromtimestamp(retry_time)
+
+    def _retry_time(self, circuit):
+        last_attempt = max(circuit.opened_at, circuit.trial_at or 0)
+        return last_attempt + self.reset_timeout
+
+    def record(self, domain, latency, failed):
+        """
+        Record how a render of a domain went.
+
+        :param str domain:
+        :param float latency: seconds the render took
+        :param bool failed: whether the render failed or timed out
+        """
+        with self._lock:
+            circuit = self._circuits.setdefault(domain, _Circuit())
+            circuit.renders += 1
+            circuit.latency = latency if circuit.latency is None else (
+                self.LATENCY_SMOOTHING * latency +
+                (1 - self.LATENCY_SMOOTHING) * circuit.latency)
+            was_trial = circuit.trial_at is not None
+            circuit.trial_at = None
+            if not failed:
+                if circuit.opened_at is not None:
+                    log.info("closing circuit for %s", domain)
+                circuit.failures = 0
+                circuit.opened_at = None
+                return
+            circuit.failures += 1
+            if was_trial or circuit.failures >= self.failure_threshold:
+                log.warning(
+                    "opening circuit for %s after %d failures; "
+                    "%.1fs average latency", domain, circuit.failures,
+                    circuit.latency)
+                circuit.opened_at = time.time()
+
+    def open_domains(self):
+        """
+        :returns: domains whose circuits are open
+        :rtype: list[str]
+        """
+        with self._lock:
+            return sorted(domain for domain, circuit in self._circuits.items()
+                          if circuit.opened_at is not None)
+
+    def latency(self, domain):
+        """
+        :param str domain:
+        :returns: moving average seconds renders of the domain take, or None
+        if it's never been rendered
+        :rtype: float or None
+        """
+        with self._lock:
+            circuit = self._circuits.get(domain)
+            return circuit.latency if circuit else None
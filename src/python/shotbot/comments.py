@@ -0,0 +1,156 @@
+"""Renders Reddit comment threads as static pages, from Reddit's JSON API."""
+import datetime
+import logging
+import time
+from urllib.parse import urlsplit
+
+import requests
+from jinja2 import Environment, PackageLoader
+
+from .exceptions import RendererException
+from .utils import comment_id_from_url
+
+__all__ = ('CommentThreadPages', )
+
+log = logging.getLogger(__name__)
+
+REDDIT_API_HOME = 'https://www.reddit.com'
+
+
+def time_ago(epoch, now=None):
+    """
+    :param float epoch: UTC timestamp
+    :param now: UTC timestamp to measure from; defaults to the current time
+    :type now: float or None
+    :returns: how long ago `epoch` was, the way Reddit puts it,
+    e.g. `5 hours ago`
+    :rtype: str
+    """
+    seconds = max((now or time.time()) - epoch, 0)
+    for unit, length in (('year', 365 * 86400), ('month', 30 * 86400),
+                         ('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= length:
+            count = int(seconds // length)
+            return '{} {}{} ago'.format(count, unit, '' if count == 1 else 's')
+    return 'just now'
+
+
+class CommentThreadPages():
+    """
+    Fetches a Reddit comment and its parents, and lays them out as HTML.
+
+    One unauthenticated API request replaces loading a full Reddit page; the
+    page produced is styled after Reddit's own, and needs nothing from the
+    network to display.
+    """
+
+    CONTEXT = 9
+    """Default parent comments shown above a comment."""
+
+    TIMEOUT = 10
+    """Default most seconds to wait on the API."""
+
+    THREAD_ID = 'thread'
+    """HTML ID of the element holding the whole thread."""
+
+    def __init__(self, user_agent, context=CONTEXT, timeout=TIMEOUT):
+        """
+        Create a new CommentThreadPages.
+
+        :param str user_agent: User-Agent to identify ourselves to Reddit by
+        :param int context: most parent comments shown above a comment
+        :param float timeout: most seconds to wait on the API
+        """
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = user_agent
+        self.context = context
+        self.timeout = timeout
+        self._jinja = self._create_jinja_env()
+
+    def __repr__(self):
+        return '<{cls}(context={context})>'.format(
+            cls=self.__class__.__name__, context=self.context)
+
+    @staticmethod
+    def _create_jinja_env():
+        env = Environment(loader=PackageLoader('shotbot'), autoescape=True)
+        env.filters['time_ago'] = time_ago
+        env.filters['parse_utc_epoch'] = datetime.datetime.utcfromtimestamp
+        return env
+
+    def __call__(self, url):
+        """
+        Render the comment a URL links to as a page.
+
+        :param str url: a Reddit comment URL
+        :returns: HTML of the comment below its parents, replies hidden
+        :rtype: str
+        :raises requests.RequestException: if the API request fails
+        :raises RendererException: if the comment isn't in the response
+        """
+        return self.html(self.fetch(url))
+
+    def fetch(self, url):
+        """
+        Fetch a comment and its parents.
+
+        :param str url: a Reddit comment URL
+        :returns: API data of the comments, outermost parent first
+        :rtype: list[dict[str, Any]]
+        :raises requests.RequestException: if the API request fails
+        :raises RendererException: if the comment isn't in the response
+        """
+        comment_id = comment_id_from_url(url)
+        api_url = '{}{}.json'.format(REDDIT_API_HOME,
+                                     urlsplit(url).path.rstrip('/'))
+        log.debug("fetching comment %s from %s", comment_id, api_url)
+        response = self._session.get(api_url,
+                                     params={
+                                         'context': self.context,
+                                         'raw_json': 1,
+                                     },
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        try:
+            _, comment_listing = response.json()
+            comments = {}
+            self._index_comments(comment_listing, comments)
+        except (KeyError, TypeError, ValueError):
+            raise RendererException(
+                "unexpected API response for comment {}".format(comment_id))
+        if comment_id not in comments:
+            raise RendererException(
+                "comment {} not in API response".format(comment_id))
+        chain = [comments[comment_id]]
+        while len(chain) <= self.context:
+            kind, _, parent_id = chain[-1]['parent_id'].partition('_')
+            if kind != 't1' or parent_id not in comments:
+                break
+            chain.append(comments[parent_id])
+        chain.reverse()
+        return chain
+
+    @classmethod
+    def _index_comments(cls, listing, comments):
+        for child in listing['data']['children']:
+            if child['kind'] != 't1':
+                # e.g. "load more comments"
+                continue
+            comments[child['data']['id']] = child['data']
+            if child['data'].get('replies'):
+                cls._index_comments(child['data']['replies'], comments)
+
+    def html(self, comments):
+        """
+        Lay out a comment below its parents.
+
+        :param comments: API data of the comments, outermost parent first
+        :type comments: list[dict[str, Any]]
+        :returns: HTML page, with the comments in the element with ID
+        :attr:`THREAD_ID`
+        :rtype: str
+        """
+        template = self._jinja.get_template('comment_thread.html.j2')
+        return template.render(comments=comments,
+                               thread_id=self.THREAD_ID,
+                               now=time.time())
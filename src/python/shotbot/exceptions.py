@@ -14,3 +14,8 @@ class CommenterException(ShotbotException):
 class RendererException(ShotbotException):
     """Base exception for Renderer exceptions."""
     pass
+
+
+class BrowserUnavailable(RendererException):
+    """No browser could be had to render with, e.g. it failed to start."""
+    pass
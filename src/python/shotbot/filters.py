@@ -0,0 +1,127 @@
+"""Cheap checks deciding which submissions are worth storing."""
+import datetime
+import logging
+import time
+from abc import ABC, abstractmethod
+
+__all__ = ('SubmissionFilter', 'DomainFilter', 'NewerThanFilter',
+           'FilterChain')
+
+log = logging.getLogger(__name__)
+
+
+class SubmissionFilter(ABC):
+    """A predicate over submissions that counts what it accepts and rejects."""
+
+    name = None
+
+    def __init__(self):
+        """Create a new SubmissionFilter."""
+        self.accepted = 0
+        self.rejected = 0
+
+    def __call__(self, submission):
+        if self.accepts(submission):
+            self.accepted += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def __repr__(self):
+        return '<{cls}({accepted} accepted, {rejected} rejected)>'.format(
+            cls=self.__class__.__name__,
+            accepted=self.accepted,
+            rejected=self.rejected)
+
+    @abstractmethod
+    def accepts(self, submission):
+        """
+        :param Submission submission:
+        :returns: True if `submission` should be kept
+        :rtype: bool
+        """
+
+
+class DomainFilter(SubmissionFilter):
+    """Keeps submissions linking to one of a set of domains."""
+
+    name = 'domains'
+
+    def __init__(self, domains):
+        """
+        Create a new DomainFilter.
+
+        :param domains: domains to keep, e.g. `reddit.com`, `self.subreddit`
+        :type domains: iterable[str]
+        """
+        super().__init__()
+        self.domains = frozenset(domains)
+
+    def accepts(self, submission):
+        return submission.domain in self.domains
+
+
+class NewerThanFilter(SubmissionFilter):
+    """Keeps submissions made recently."""
+
+    name = 'newer_than'
+
+    def __init__(self, delta):
+        """
+        Create a new NewerThanFilter.
+
+        :param timedelta delta: oldest submission age to keep
+        """
+        super().__init__()
+        self.max_age = delta.total_seconds()
+
+    def accepts(self, submission):
+        return submission.created_utc >= time.time() - self.max_age
+
+
+class FilterChain():
+    """Keeps submissions every one of its filters keeps."""
+
+    def __init__(self, filters):
+        """
+        Create a new FilterChain.
+
+        Filters are checked in order, stopping at the first rejection.
+
+        :param filters:
+        :type filters: list[SubmissionFilter]
+        """
+        self.filters = filters
+
+    def __call__(self, submission):
+        for _filter in self.filters:
+            if not _filter(submission):
+                log.debug("filtering submission %s: rejected by %s",
+                          submission.id, _filter.name)
+                return False
+        return True
+
+    def __repr__(self):
+        return '<{cls}({filters})>'.format(
+            cls=self.__class__.__name__,
+            filters=', '.join(map(repr, self.filters)))
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Compile a subreddit's `watched_subreddits` options into filters.
+
+        :param options: subreddit options, e.g. `domains`, `newer_than`
+        :type options: dict[str, Any]
+        :returns: a filter chain, or None if there's nothing to filter on
+        :rtype: FilterChain or None
+        """
+        filters = []
+        if 'domains' in options:
+            filters.append(DomainFilter(options['domains']))
+        if 'newer_than' in options:
+            filters.append(
+                NewerThanFilter(datetime.timedelta(**options['newer_than'])))
+        if not filters:
+            return None
+        return cls(filters)
@@ -0,0 +1,158 @@
+"""Post-processing for rendered screenshots."""
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from PIL import Image
+
+__all__ = ('FORMATS', 'ScreenshotOptimizer', 'optimize')
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('png', 'jpeg', 'webp')
+"""Formats screenshots can be re-encoded to."""
+
+MIN_QUALITY = 30
+"""Lowest lossy quality tried when squeezing under a byte budget."""
+
+MIN_WIDTH = 320
+"""Narrowest screenshots are scaled to when squeezing under a byte budget."""
+
+
+def _encode(image, image_format, quality):
+    output = io.BytesIO()
+    if image_format == 'png':
+        image.save(output, 'PNG', optimize=True)
+    elif image_format == 'jpeg':
+        image.convert('RGB').save(output,
+                                  'JPEG',
+                                  quality=quality,
+                                  optimize=True,
+                                  progressive=True)
+    else:
+        image.save(output, 'WEBP', quality=quality, method=6)
+    return output.getvalue()
+
+
+def _prepare(source, width, quantize, colors):
+    image = source
+    if width < source.width:
+        height = max(source.height * width // source.width, 1)
+        image = source.resize((width, height), Image.LANCZOS)
+    if quantize:
+        image = image.quantize(colors)
+    return image
+
+
+def optimize(screenshot,
+             image_format='png',
+             quantize=False,
+             colors=256,
+             quality=85,
+             max_bytes=None):
+    """
+    Shrink a PNG screenshot.
+
+    If `max_bytes` is set, quality is stepped down to :data:`MIN_QUALITY`,
+    then the image scaled down to :data:`MIN_WIDTH`, until it fits; if
+    nothing fits, the last attempt is returned. If re-encoding as PNG saves
+    nothing, the original screenshot is returned.
+
+    :param bytes screenshot: PNG image
+    :param str image_format: one of :data:`FORMATS`
+    :param bool quantize: if True, reduce the image to a palette first
+    :param int colors: palette size when quantizing
+    :param int quality: lossy quality, for `jpeg` and `webp`
+    :param max_bytes: if set, most bytes the optimized image may take
+    :type max_bytes: int or None
+    :returns: optimized image
+    :rtype: bytes
+    """
+    # the alpha channel's wasted on screenshots
+    source = Image.open(io.BytesIO(screenshot)).convert('RGB')
+    width = source.width
+    optimized = _encode(_prepare(source, width, quantize, colors),
+                        image_format, quality)
+    while max_bytes and len(optimized) > max_bytes:
+        if image_format != 'png' and quality > MIN_QUALITY:
+            quality = max(quality - 10, MIN_QUALITY)
+        elif width > MIN_WIDTH:
+            width = max(int(width * 0.8), MIN_WIDTH)
+        else:
+            break
+        optimized = _encode(_prepare(source, width, quantize, colors),
+                            image_format, quality)
+
+    if image_format == 'png' and len(optimized) >= len(screenshot):
+        return screenshot
+    return optimized
+
+
+class ScreenshotOptimizer():
+    """Runs :func:`optimize` in a pool of processes, clear of the GIL."""
+
+    def __init__(self, processes=None, **options):
+        """
+        Create a new ScreenshotOptimizer.
+
+        :param processes: size of the process pool; defaults to the number of
+        CPUs
+        :type processes: int or None
+        :param options: keyword arguments for :func:`optimize`, e.g.
+        `image_format`, `quantize`, `quality`, `max_bytes`
+        :raises ValueError: if `image_format` isn't one of :data:`FORMATS`
+        """
+        image_format = options.get('image_format', 'png')
+        if image_format not in FORMATS:
+            raise ValueError("Unknown image format {!r}; expected one of {}"
+                             .format(image_format, ', '.join(FORMATS)))
+        self.options = options
+        # spawned, like renderer worker processes, so they don't inherit
+        # locks held by other threads when they're started
+        self._pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'))
+        self._lock = Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __repr__(self):
+        return '<{cls}({options})>'.format(
+            cls=self.__class__.__name__,
+            options=', '.join('{}={!r}'.format(key, value)
+                              for key, value in sorted(self.options.items())))
+
+    def __call__(self, screenshot):
+        """
+        Optimize a screenshot, blocking until a process has done so.
+
+        If optimizing fails, the screenshot is returned untouched.
+
+        :param screenshot: PNG image
+        :type screenshot: bytes or memoryview
+        :returns: optimized image
+        :rtype: bytes
+        """
+        screenshot = bytes(screenshot)
+        try:
+            optimized = self._pool.submit(optimize, screenshot,
+                                          **self.options).result()
+        except Exception:  # pylint: disable=broad-except
+            # Pillow raises all sorts on bad images, e.g. SyntaxError on a
+            # corrupt PNG; a broken pool raises BrokenProcessPool
+            log.exception("failed to optimize %d byte screenshot",
+                          len(screenshot))
+            return screenshot
+        with self._lock:
+            self.bytes_in += len(screenshot)
+            self.bytes_out += len(optimized)
+        log.info("optimized screenshot from %d to %d bytes, saving %d",
+                 len(screenshot), len(optimized),
+                 len(screenshot) - len(optimized))
+        return optimized
+
+    def close(self):
+        """Shut down the process pool."""
+        self._pool.shutdown()
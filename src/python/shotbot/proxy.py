@@ -0,0 +1,185 @@
+"""A local HTTP proxy that keeps renderer browsers off unwanted domains."""
+import http.client
+import logging
+import select
+import socket
+from collections import Counter
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+
+__all__ = ('BlockingProxy', )
+
+log = logging.getLogger(__name__)
+
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'
+])
+
+
+class _ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, proxy):
+        super().__init__(address, _ProxyRequestHandler)
+        self.proxy = proxy
+
+
+class _ProxyRequestHandler(BaseHTTPRequestHandler):
+    TIMEOUT = 30
+    BUFFER_SIZE = 64 * 1024
+
+    timeout = TIMEOUT
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        log.debug("%s " + format, self.address_string(), *args)
+
+    def _refuse_blocked(self, host):
+        if self.server.proxy.blocks(host):
+            self.send_error(403, "Blocked by shotbot")
+            return True
+        return False
+
+    def do_CONNECT(self):  # pylint: disable=invalid-name
+        """Tunnel a TLS connection, unless its host is blocked."""
+        host, _, port = self.path.rpartition(':')
+        if self._refuse_blocked(host):
+            return
+        try:
+            upstream = socket.create_connection((host, int(port)),
+                                                self.TIMEOUT)
+        except (OSError, ValueError):
+            self.send_error(502)
+            return
+        with upstream:
+            self.send_response(200, 'Connection Established')
+            self.end_headers()
+            self._tunnel(upstream)
+        self.close_connection = True
+
+    def _tunnel(self, upstream):
+        sockets = [self.connection, upstream]
+        while True:
+            readable, _, broken = select.select(sockets, [], sockets,
+                                                self.TIMEOUT)
+            if broken or not readable:
+                return
+            for sock in readable:
+                data = sock.recv(self.BUFFER_SIZE)
+                if not data:
+                    return
+                other = upstream if sock is self.connection else self.connection
+                other.sendall(data)
+
+    def _forward(self):
+        """Forward a plain HTTP request, unless its host is blocked."""
+        url = urlsplit(self.path)
+        if self._refuse_blocked(url.hostname or ''):
+            return
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS
+        }
+        upstream = http.client.HTTPConnection(url.hostname, url.port or 80,
+                                              timeout=self.TIMEOUT)
+        try:
+            upstream.request(self.command, path, body, headers)
+            response = upstream.getresponse()
+            self.send_response(response.status, response.reason)
+            for name, value in response.getheaders():
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    self.send_header(name, value)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            while True:
+                data = response.read(self.BUFFER_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+        except OSError:
+            self.send_error(502)
+        finally:
+            upstream.close()
+        self.close_connection = True
+
+    do_DELETE = do_GET = do_HEAD = do_OPTIONS = do_POST = do_PUT = _forward
+
+
+class BlockingProxy():
+    """
+    Refuses requests to hosts matching any of a set of glob patterns.
+
+    Plain HTTP requests are forwarded and HTTPS ones tunnelled, so only hosts
+    can be matched, not paths. Refused requests are counted per pattern.
+    """
+
+    def __init__(self, domains, host='127.0.0.1', port=0):
+        """
+        Create a new BlockingProxy.
+
+        :param domains: host patterns to block, e.g. `*.doubleclick.net`
+        :type domains: iterable[str]
+        :param str host: address to listen on
+        :param int port: port to listen on; 0 picks a free one
+        """
+        self.domains = tuple(pattern.lower() for pattern in domains)
+        self.blocked = Counter()
+        self._lock = Lock()
+        self._server = _ProxyServer((host, port), self)
+        self._thread = None
+
+    def __repr__(self):
+        return '<{cls}({host}:{port}, {blocked} blocked)>'.format(
+            cls=self.__class__.__name__,
+            host=self.address[0],
+            port=self.address[1],
+            blocked=sum(self.blocked.values()))
+
+    @property
+    def address(self):
+        """Host and port the proxy listens on."""
+        return self._server.server_address[:2]
+
+    def blocks(self, host):
+        """
+        Check, and count, whether requests to a host are refused.
+
+        :param str host:
+        :returns: True if `host` matches one of the blocked patterns
+        :rtype: bool
+        """
+        host = host.lower()
+        for pattern in self.domains:
+            if fnmatch(host, pattern):
+                with self._lock:
+                    self.blocked[pattern] += 1
+                log.debug("blocked request to %s by %r", host, pattern)
+                return True
+        return False
+
+    def start(self):
+        """Start serving on a background thread."""
+        self._thread = Thread(name='blocking-proxy',
+                              target=self._server.serve_forever,
+                              daemon=True)
+        self._thread.start()
+        log.debug("%r started", self)
+
+    def close(self):
+        """Stop serving, and log what was blocked."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        log.info("%r blocked %s", self, dict(self.blocked.most_common()))
@@ -6,10 +6,17 @@ import random
 import time
 from threading import Event, Thread
 
-import dataset
-
-from .bots import CommentContextRenderer, QuoteCommenter, Watcher
-from .utils import ensure_schema
+from .bots import (CommentContextRenderer, MultiWatcher, QuoteCommenter,
+                   Uploader, Watcher)
+from .bots.autoscaler import Autoscaler, RendererThreads
+from .bots.renderer import DriverFactory, DriverPool
+from .bots.workers import CONTEXT, RendererSupervisor
+from .breaker import CircuitBreaker
+from .filters import FilterChain
+from .images import ScreenshotOptimizer
+from .proxy import BlockingProxy
+from .utils import (ScreenshotCache, connect_db, ensure_schema,
+                    release_connection)
 from .version import SHOTBOT_VERSION
 
 USER_AGENT_TMPL = "{platform}:{name}:{version} (by /u/{owner})"
@@ -35,7 +42,29 @@ class Shotbot():
                  db_uri,
                  dry_run=False,
                  name=None,
-                 version=SHOTBOT_VERSION):
+                 version=SHOTBOT_VERSION,
+                 multiplex_watchers=False,
+                 seen_index_size=Watcher.SEEN_INDEX_SIZE,
+                 db_pool=None,
+                 min_poll_interval=Watcher.MIN_POLL_INTERVAL,
+                 max_poll_interval=Watcher.MAX_POLL_INTERVAL,
+                 extra_fields=False,
+                 renderer_count=None,
+                 driver_pool=None,
+                 browser=None,
+                 claim_batch_size=CommentContextRenderer.CLAIM_BATCH_SIZE,
+                 debug_screenshot_dir=None,
+                 uploader=None,
+                 optimizer=None,
+                 screenshot_cache=None,
+                 render_timeout=CommentContextRenderer.RENDER_TIMEOUT,
+                 ready_state='interactive',
+                 blocking=None,
+                 circuit_breaker=None,
+                 clip_selectors=None,
+                 comment_engine='browser',
+                 renderer_processes=0,
+                 autoscale=None):
         """
         Create a new Shotbot.
 
@@ -52,6 +81,72 @@ class Shotbot():
         :type name: str or None
         :param Version version: bot instance's version; defaults to
         `SHOTBOT_VERSION`
+        :param bool multiplex_watchers: if True, watch every subreddit from a
+        single :class:`MultiWatcher` rather than a :class:`Watcher` each
+        :param int seen_index_size: number of recently seen submission IDs
+        each watcher remembers in memory
+        :param db_pool: connection pool arguments for
+        :func:`sqlalchemy.create_engine`, e.g. `pool_size`, `max_overflow`;
+        the pool is shared by every bot
+        :type db_pool: dict[str, Any] or None
+        :param float min_poll_interval: fewest seconds between polls of a
+        watched listing, however busy
+        :param float max_poll_interval: most seconds between polls of a
+        watched listing, however quiet
+        :param bool extra_fields: if True, submission fields without their
+        own column are stored as JSON in an `extra` column
+        :param renderer_count: number of renderer threads; defaults to one
+        fewer than the number of CPUs
+        :type renderer_count: int or None
+        :param driver_pool: :class:`DriverPool` arguments for the browsers
+        shared by renderers, i.e. `min_size`, `max_size`, `max_uses`;
+        `max_size` defaults to `renderer_count`
+        :type driver_pool: dict[str, int] or None
+        :param browser: :class:`DriverFactory` arguments for the renderers'
+        browsers, e.g. `headless`, `window_size`, `page_load_strategy`,
+        `prefs`, `session_file`, `profile_dir`; `session_max_age` as
+        :class:`timedelta` arguments
+        :type browser: dict[str, Any] or None
+        :param int claim_batch_size: most submissions a renderer claims at once
+        :param debug_screenshot_dir: if set, renderers also save every
+        screenshot here, for debugging
+        :type debug_screenshot_dir: str or None
+        :param uploader: options for the upload stage renderers hand
+        screenshots off to, e.g. `workers`, `queue_size`
+        :type uploader: dict[str, int] or None
+        :param optimizer: if set, screenshots are shrunk before uploading;
+        :class:`ScreenshotOptimizer` options, e.g. `image_format`,
+        `quantize`, `max_bytes`, `processes`
+        :type optimizer: dict[str, Any] or None
+        :param screenshot_cache: options for the cache of recent screenshots
+        shared by renderers, `maxsize` and `ttl`, the latter as
+        :class:`timedelta` arguments
+        :type screenshot_cache: dict[str, Any] or None
+        :param float render_timeout: most seconds a render waits for its page
+        :param str ready_state: `document.readyState` pages other than Reddit
+        comments must reach before rendering, `interactive` or `complete`
+        :param blocking: what renderer browsers shouldn't load; `resources`,
+        kinds of resource, e.g. `images`, and `domains`, host patterns
+        refused by a local :class:`BlockingProxy`
+        :type blocking: dict[str, list[str]] or None
+        :param circuit_breaker: options for the per-domain circuit breaker
+        shared by renderers, `failure_threshold` and `reset_timeout`, the
+        latter as :class:`timedelta` arguments
+        :type circuit_breaker: dict[str, Any] or None
+        :param clip_selectors: CSS selectors of the element to screenshot on
+        pages other than Reddit comments, keyed by host pattern
+        :type clip_selectors: dict[str, str] or None
+        :param str comment_engine: how Reddit comments are rendered; `browser`
+        loads their pages, `api` lays them out from Reddit's API
+        :param int renderer_processes: if set, renderers run in this many
+        supervised worker processes, each with its own browser and uploader,
+        instead of `renderer_count` threads
+        :param autoscale: if set, renderers are started and stopped with the
+        backlog of submissions awaiting screenshots, between `min_size` and
+        `max_size`, the latter defaulting to `renderer_count` or
+        `renderer_processes`; other :class:`Autoscaler` options, with
+        durations as :class:`timedelta` arguments
+        :type autoscale: dict[str, Any] or None
         """
         self.name = name or self.__class__.__name__
         self.version = version
@@ -65,9 +160,71 @@ class Shotbot():
         self._imgur_auth = self._validate_imgur_auth(imgur_auth)
         self.subreddits = watched_subreddits
 
+        self.multiplex_watchers = multiplex_watchers
+        self._watcher_options = {
+            'seen_index_size': seen_index_size,
+            'min_poll_interval': min_poll_interval,
+            'max_poll_interval': max_poll_interval,
+            'extra_fields': extra_fields,
+        }
+
+        self.renderer_count = renderer_count or max(os.cpu_count() - 1, 1)
+        self._driver_pool_options = {'max_size': self.renderer_count}
+        self._driver_pool_options.update(driver_pool or {})
+        self._driver_pool = None
+        self._browser_options = dict(browser or {})
+        if 'session_max_age' in self._browser_options:
+            self._browser_options['session_max_age'] = datetime.timedelta(
+                **self._browser_options['session_max_age'])
+        self._renderer_options = {
+            'claim_batch_size': claim_batch_size,
+            'debug_screenshot_dir': debug_screenshot_dir,
+            'render_timeout': render_timeout,
+            'ready_state': ready_state,
+            'clip_selectors': clip_selectors or {},
+            'comment_engine': comment_engine,
+        }
+        self.renderer_processes = renderer_processes
+        self._uploader_options = uploader or {}
+        self._renderers = []
+        self._renderer_group = None
+        self._renderer_supervisor = None
+        self._uploader = None
+        self._optimizer_options = optimizer
+        self._optimizer = None
+        cache_options = dict(screenshot_cache or {})
+        if 'ttl' in cache_options:
+            cache_options['ttl'] = datetime.timedelta(**cache_options['ttl'])
+        self._screenshot_cache_options = cache_options
+        self._screenshot_cache = ScreenshotCache(**cache_options)
+        blocking = blocking or {}
+        self._browser_options['block_resources'] = blocking.get(
+            'resources', ())
+        self._blocked_domains = blocking.get('domains', ())
+        self._blocking_proxy = None
+        breaker_options = dict(circuit_breaker or {})
+        if 'reset_timeout' in breaker_options:
+            breaker_options['reset_timeout'] = datetime.timedelta(
+                **breaker_options['reset_timeout'])
+        self._circuit_breaker_options = breaker_options
+        self._circuit_breaker = CircuitBreaker(**breaker_options)
+        autoscale_options = None
+        if autoscale is not None:
+            autoscale_options = {
+                'max_size': renderer_processes or self.renderer_count
+            }
+            autoscale_options.update(autoscale)
+            for option in ('scale_up_age', 'scale_up_cooldown',
+                           'scale_down_after'):
+                if option in autoscale_options:
+                    autoscale_options[option] = datetime.timedelta(
+                        **autoscale_options[option])
+        self._autoscale_options = autoscale_options
+
         self.dry_run = dry_run
         self._db_uri = db_uri
-        # self._db = dataset.connect(self._db_uri)
+        self._db_pool = db_pool or {}
+        self._db = None
 
     @staticmethod
     def _validate_reddit_auth(reddit_auth):
@@ -83,85 +240,147 @@ class Shotbot():
                 raise ValueError("Missing Imgur auth param {!r}".format(key))
         return imgur_auth.copy()
 
-    def _spawn_watchers(self, kill_switch):
-        watchers = []
-        domains = None
-        for subreddit, options in self.subreddits.items():
-            filters = []
-            if 'domains' in options:
-                domains = set(options['domains'])
-
-                def _filter_domain(submission):
-                    if submission.domain in domains:
-                        return True
-                    log.debug("filtering submission: domain %r not in %r",
-                              submission.domain, domains)
-                    return False
-
-                filters.append(_filter_domain)
-            if 'newer_than' in options:
-
-                def _filter_newer_than(delta):
-                    def _filter(submission):
-                        oldest = datetime.datetime.utcnow() - delta
-                        then = datetime.datetime.utcfromtimestamp(
-                            submission.created_utc)
-                        if then >= oldest:
-                            return True
-                        log.debug("filtering submission: %s older than %r",
-                                  submission.created_utc, delta)
-                        return False
-
-                    return _filter
-
-                delta = datetime.timedelta(**options['newer_than'])
-                filters.append(_filter_newer_than(delta))
-
-            if filters:
-
-                def _all_filters(filters):
-                    def _all_filters(submission):
-                        return all(_filter(submission) for _filter in filters)
-
-                    return _all_filters
-
-                _filter_fn = _all_filters(filters)
-            else:
-                _filter_fn = None
-
-            watcher = Watcher(self._reddit_args, self._db_uri, subreddit,
-                              kill_switch, _filter_fn)
-            watchers.append(watcher)
-        return watchers
-
-    def _spawn_swarm(self, kill_switch):
+    def _spawn_watchers(self, kill_switch, new_submissions):
+        filters = {
+            subreddit: FilterChain.from_options(options)
+            for subreddit, options in self.subreddits.items()
+        }
+        if self.multiplex_watchers:
+            return [
+                MultiWatcher(self._reddit_args,
+                             self._db,
+                             filters,
+                             kill_switch,
+                             new_submissions=new_submissions,
+                             **self._watcher_options)
+            ]
+        return [
+            Watcher(self._reddit_args,
+                    self._db,
+                    subreddit,
+                    kill_switch,
+                    filter_fn,
+                    new_submissions=new_submissions,
+                    **self._watcher_options)
+            for subreddit, filter_fn in filters.items()
+        ]
+
+    def _spawn_swarm(self, kill_switch, new_submissions, new_screenshots):
         swarm = []
         # create a watcher per subreddit
         if log.isEnabledFor(logging.DEBUG):
             log.debug("spawning observers for %s", ', '.join(self.subreddits))
 
-        watchers = self._spawn_watchers(kill_switch)
-        swarm.extend(Thread(name='watch-{}'.format(bot.subreddit),
-                            target=bot.run) for bot in watchers)
-        # create screenshot worker
-        renderer_count = max(os.cpu_count() - 1, 1)
-        log.debug("spawning %d renderers", renderer_count)
-        renderers = [
-            CommentContextRenderer(self._imgur_auth, self._reddit_args,
-                                   self._db_uri, kill_switch)
-            for _ in range(renderer_count)
-        ]
-        swarm.extend(Thread(name='renderer-{}'.format(i),
-                            target=bot.run) for i, bot in enumerate(renderers))
+        watchers = self._spawn_watchers(kill_switch, new_submissions)
+        for bot in watchers:
+            # a MultiWatcher watches many subreddits, not its `subreddit`
+            name = ('watch-multi' if isinstance(bot, MultiWatcher) else
+                    'watch-{}'.format(bot.subreddit))
+            swarm.append(Thread(name=name, target=bot.run))
+        # create screenshot workers
+        browser_options = dict(self._browser_options)
+        if self._blocked_domains:
+            self._blocking_proxy = BlockingProxy(self._blocked_domains)
+            self._blocking_proxy.start()
+            browser_options['proxy'] = self._blocking_proxy.address
+        if self.renderer_processes:
+            swarm.extend(
+                self._spawn_renderer_processes(kill_switch, new_submissions,
+                                               new_screenshots,
+                                               browser_options))
+        else:
+            swarm.extend(
+                self._spawn_renderer_threads(kill_switch, new_submissions,
+                                             new_screenshots, browser_options))
         # create a commenter
         log.debug("spawning commenter")
-        commenter = QuoteCommenter(self._reddit_args, self._db_uri,
-                                   kill_switch, self.dry_run)
+        commenter = QuoteCommenter(self._reddit_args,
+                                   self._db,
+                                   kill_switch,
+                                   self.dry_run,
+                                   new_screenshots=new_screenshots)
         swarm.append(Thread(name='commenter', target=commenter.run))
         return swarm
 
-    @staticmethod
-    def _await_swarm(swarm, timeout=None):
+    def _spawn_autoscaler(self, kill_switch, target):
+        autoscaler = Autoscaler(self._db, target, kill_switch,
+                                **self._autoscale_options)
+        log.debug("spawning %r", autoscaler)
+        return Thread(name='autoscaler', target=autoscaler.run)
+
+    def _spawn_renderer_processes(self, kill_switch, new_submissions,
+                                  new_screenshots, browser_options):
+        log.debug("spawning %d renderer processes", self.renderer_processes)
+        supervisor = self._renderer_supervisor = RendererSupervisor(
+            self.renderer_processes, {
+                'imgur_auth': self._imgur_auth,
+                'reddit_args': self._reddit_args,
+                'db_uri': self._db_uri,
+                'db_pool': self._db_pool,
+                'browser': browser_options,
+                'driver_pool': self._driver_pool_options,
+                'uploader': self._uploader_options,
+                'optimizer': self._optimizer_options,
+                'screenshot_cache': self._screenshot_cache_options,
+                'circuit_breaker': self._circuit_breaker_options,
+                'renderer': self._renderer_options,
+            }, kill_switch, new_submissions, new_screenshots)
+        threads = [Thread(name='renderer-supervisor', target=supervisor.run)]
+        if self._autoscale_options is not None:
+            threads.append(self._spawn_autoscaler(kill_switch, supervisor))
+        return threads
+
+    def _spawn_renderer_threads(self, kill_switch, new_submissions,
+                                new_screenshots, browser_options):
+        # renderers share a pool of browsers
+        driver_factory = DriverFactory(self._reddit_args, **browser_options)
+        self._driver_pool = DriverPool(driver_factory,
+                                       **self._driver_pool_options)
+        # and a pipelined upload stage, so browsers never wait on Imgur
+        if self._optimizer_options is not None:
+            self._optimizer = ScreenshotOptimizer(**self._optimizer_options)
+        self._uploader = Uploader(self._imgur_auth,
+                                  self._db,
+                                  kill_switch,
+                                  new_screenshots=new_screenshots,
+                                  optimizer=self._optimizer,
+                                  screenshot_cache=self._screenshot_cache,
+                                  **self._uploader_options)
+        threads = [Thread(name='uploader', target=self._uploader.run)]
+        renderer_options = dict(self._renderer_options,
+                                new_submissions=new_submissions,
+                                new_screenshots=new_screenshots,
+                                uploader=self._uploader,
+                                screenshot_cache=self._screenshot_cache,
+                                circuit_breaker=self._circuit_breaker)
+        if self._autoscale_options is not None:
+            # renderers come and go, each stopped by its own event
+            self._renderer_group = RendererThreads(
+                lambda stop: CommentContextRenderer(
+                    self._imgur_auth, self._reddit_args, self._db, stop,
+                    self._driver_pool, **renderer_options), self._driver_pool,
+                new_submissions)
+            threads.append(
+                self._spawn_autoscaler(kill_switch, self._renderer_group))
+            return threads
+        log.debug("spawning %d renderers sharing %r and %r",
+                  self.renderer_count, self._driver_pool, self._uploader)
+        self._renderers = [
+            CommentContextRenderer(self._imgur_auth, self._reddit_args,
+                                   self._db, kill_switch, self._driver_pool,
+                                   **renderer_options)
+            for _ in range(self.renderer_count)
+        ]
+        threads.extend(
+            Thread(name='renderer-{}'.format(i), target=bot.run)
+            for i, bot in enumerate(self._renderers))
+        return threads
+
+    STATS_INTERVAL = 60
+    """Seconds between logging the render pipeline's stats."""
+
+    def _await_swarm(self, swarm, timeout=None):
+        next_stats = time.time() + self.STATS_INTERVAL
         while True:
             for thread in swarm:
                 if not thread.is_alive():
@@ -170,16 +389,73 @@ class Shotbot():
             if timeout and time.time() >= timeout:
                 log.debug("time ends")
                 break
+            if time.time() >= next_stats:
+                self._log_pipeline_stats()
+                next_stats += self.STATS_INTERVAL
             time.sleep(1)
 
+    def pipeline_stats(self):
+        """
+        Measure how busy and backed up each render pipeline stage is.
+
+        Renderers running in worker processes report their own renderer,
+        uploader and circuit breaker stats, as of their last publishing them.
+
+        :returns: submissions awaiting render, mean renderer utilization,
+        screenshots awaiting upload, mean uploader utilization, requests
+        blocked and domains tripped
+        :rtype: dict[str, float]
+        """
+        submissions = self._db['submissions']
+        try:
+            render_queue = submissions.count(bot_screenshot_at=None,
+                                             bot_screenshot_lock=None)
+        finally:
+            release_connection(self._db)
+        stats = {
+            'render_queue_depth': render_queue,
+            # every renderer's browser goes through the one proxy, however
+            # the renderers run
+            'blocked_requests':
+            sum(self._blocking_proxy.blocked.values())
+            if self._blocking_proxy else 0,
+        }
+        if self._renderer_supervisor is not None:
+            stats.update(self._renderer_supervisor.stats())
+            return stats
+        renderers = (self._renderer_group.renderers
+                     if self._renderer_group is not None else self._renderers)
+        stats.update({
+            'renderer_utilization':
+            sum(bot.utilization for bot in renderers) / len(renderers)
+            if renderers else 0.0,
+            'upload_queue_depth':
+            self._uploader.queue_depth if self._uploader else 0,
+            'uploader_utilization':
+            self._uploader.utilization if self._uploader else 0.0,
+            'open_circuits': len(self._circuit_breaker.open_domains()),
+        })
+        return stats
+
+    def _log_pipeline_stats(self):
+        stats = self.pipeline_stats()
+        log.info("render queue %d, renderers %.0f%% busy; "
+                 "upload queue %d, uploaders %.0f%% busy; "
+                 "%d requests blocked, %d domains tripped",
+                 stats['render_queue_depth'],
+                 stats['renderer_utilization'] * 100,
+                 stats['upload_queue_depth'],
+                 stats['uploader_utilization'] * 100,
+                 stats['blocked_requests'],
+                 stats['open_circuits'])
+
     def _ensure_db_schema(self):
-        db = dataset.connect(self._db_uri)
-        submissions = db.create_table('submissions', primary_id='id')
+        submissions = self._db.create_table('submissions', primary_id='id')
         ensure_schema(submissions)
-        db.commit()
-        db.engine.dispose()
+        self._db.commit()
+        release_connection(self._db)
 
-    def run(self, timeout=None):  # pylint: disable=missing-raises-doc
+    def run(self, timeout=None):
         """
         Watch subreddits for submissions, render screenshots and make comments.
 
@@ -191,11 +467,29 @@ class Shotbot():
             log.info("dry run, no comments will be posted")
         if timeout is not None:
             timeout = time.time() + timeout
-        kill_switch = Event()
-
-        self._ensure_db_schema()
+        kill_switch = self._event()
 
-        swarm = self._spawn_swarm(kill_switch)
+        self._db = connect_db(self._db_uri, **self._db_pool)
+        try:
+            self._ensure_db_schema()
+            self._run_swarm(kill_switch, timeout)
+        finally:
+            self._db.engine.dispose()
+            self._db = None
+
+    def _event(self):
+        """Make an event that can be shared with renderers, however they run."""
+        if self.renderer_processes:
+            return CONTEXT.Event()
+        return Event()
+
+    def _run_swarm(self, kill_switch, timeout):
+        # wake downstream bots as soon as there's work for them; the DB stays
+        # the source of truth, these just save waiting for the next poll
+        new_submissions = self._event()
+        new_screenshots = self._event()
+        swarm = self._spawn_swarm(kill_switch, new_submissions,
+                                  new_screenshots)
 
         # orchestrate the whole thing or crash idk
         # heeeeere we go
@@ -214,8 +508,18 @@ class Shotbot():
         finally:
             log.info("throwing kill switch and reaping swarm")
             kill_switch.set()
+            new_submissions.set()
+            new_screenshots.set()
             for thread in swarm:
                 thread.join()
+            if self._renderer_group is not None:
+                self._renderer_group.stop()
+            if self._driver_pool is not None:
+                self._driver_pool.close()
+            if self._optimizer is not None:
+                self._optimizer.close()
+            if self._blocking_proxy is not None:
+                self._blocking_proxy.close()
 
     def run_forever(self):
         """Run until something exceptional makes us stop."""
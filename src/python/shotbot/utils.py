@@ -1,12 +1,20 @@
 """Useful functions that don't have a better home."""
-import copy
+import datetime
 import itertools
+import json
 import logging
 import re
 import string
+import time
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import dataset
 import praw
 import sqlalchemy.types
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import and_, func, or_
 
 log = logging.getLogger(__name__)
 
@@ -124,44 +132,79 @@ BLACKLISTED_FIELDS = set([
 """Submission fields we don't care to store in the DB."""
 
 
-def remove_blacklisted_fields(submission):
-    """
-    Remove blacklisted fields from submission dict.
+SUBMISSION_FIELDS = {
+    'author': sqlalchemy.types.String(length=32),
+    'created': sqlalchemy.types.Float,
+    'created_utc': sqlalchemy.types.Float,
+    'domain': sqlalchemy.types.String(length=256),
+    'is_self': sqlalchemy.types.Boolean,
+    'num_comments': sqlalchemy.types.Integer,
+    'over_18': sqlalchemy.types.Boolean,
+    'permalink': sqlalchemy.types.String(length=512),
+    'score': sqlalchemy.types.Integer,
+    'selftext': sqlalchemy.types.UnicodeText,
+    'subreddit': sqlalchemy.types.String(length=32),
+    'title': sqlalchemy.types.UnicodeText,
+    'url': sqlalchemy.types.UnicodeText,
+}
+"""Submission fields stored in the DB, besides `id`."""
+
+EXTRA_FIELDS_COLUMN = 'extra'
+"""Column holding any other submission fields, as JSON, if enabled."""
 
-    :param submission: submission as a dict, likely from a DB
-    :type submission: dict[str, Any]
-    :returns: submission minus blacklisted fields
-    :rtype: dict[str, Any]
-    """
-    submission = submission.copy()
-    for field in set(submission.keys()) & BLACKLISTED_FIELDS:
-        del submission[field]
-    return submission
+
+def _flatten_field(value):
+    if isinstance(value, praw.models.Redditor):
+        return value.name
+    if isinstance(value, praw.models.Subreddit):
+        return value.display_name
+    return value
 
 
-def submission_as_dict(submission):
+def submission_as_dict(submission, extra_fields=False):
     """
     Convert a :class:`Submission` to a flat `dict`.
 
-    Also decodes the base36 encoded `id` field to a plain integer.
+    Only the fields in :data:`SUBMISSION_FIELDS` are kept, so the DB schema
+    doesn't change when Reddit adds new ones. Also decodes the base36 encoded
+    `id` field to a plain integer.
 
     :param Submission submission:
+    :param bool extra_fields: if True, any other fields not in
+    :data:`BLACKLISTED_FIELDS` are kept as JSON in :data:`EXTRA_FIELDS_COLUMN`
     :returns: a `dict` suitable for storing
     :rtype: dict[str, Any]
     """
-    data = {}
-    for k, v in submission.__dict__.items():
-        if k.startswith('_'):
-            continue
-        if isinstance(v, praw.models.Redditor):
-            v = v.name
-        elif isinstance(v, praw.models.Subreddit):
-            v = v.display_name
-        data[k] = copy.copy(v)
-    data['id'] = base36_decode(data['id'])
+    attrs = submission.__dict__
+    data = {
+        field: _flatten_field(attrs.get(field))
+        for field in SUBMISSION_FIELDS
+    }
+    data['id'] = base36_decode(attrs['id'])
+    if extra_fields:
+        extras = {
+            k: _flatten_field(v)
+            for k, v in attrs.items()
+            if not (k.startswith('_') or k == 'id' or k in SUBMISSION_FIELDS or
+                    k in BLACKLISTED_FIELDS)
+        }
+        data[EXTRA_FIELDS_COLUMN] = json.dumps(extras,
+                                               default=str,
+                                               separators=(',', ':'),
+                                               sort_keys=True)
     return data
 
 
+def subreddit_name(submission):
+    """
+    :param Submission submission:
+    :returns: lower-cased name of the subreddit `submission` was posted to
+    :rtype: str
+    """
+    subreddit = submission.subreddit
+    return str(getattr(subreddit, 'display_name', subreddit)).lower()
+
+
 def load_submission_for_dict(reddit, submission):
     """
     Load the :class:`Submission` for a submission dict.
@@ -175,26 +218,246 @@ def load_submission_for_dict(reddit, submission):
     return reddit.submission(id=base36_encode(submission['id']))
 
 
+class SeenIndex():
+    """
+    A bounded, least-recently-used set of IDs we've already seen.
+
+    Membership tests are counted as hits or misses so the index can be sized.
+    """
+
+    def __init__(self, maxsize):
+        """
+        Create a new SeenIndex.
+
+        :param int maxsize: most IDs to remember before forgetting the least
+        recently used
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+
+    def __contains__(self, _id):
+        if _id in self._ids:
+            self._ids.move_to_end(_id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return '<{cls}({size}/{maxsize}, {hits} hits, {misses} misses)>'.format(
+            cls=self.__class__.__name__,
+            size=len(self),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses)
+
+    def add(self, _id):
+        """
+        Remember an ID, forgetting the least recently used if full.
+
+        :param _id:
+        """
+        self._ids[_id] = True
+        self._ids.move_to_end(_id)
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+    def discard(self, _id):
+        """
+        Forget an ID, if remembered.
+
+        :param _id:
+        """
+        self._ids.pop(_id, None)
+
+
+class ScreenshotCache():
+    """
+    A bounded, expiring map of canonical URLs to hosted screenshots.
+
+    Safe to share between threads. Lookups are counted as hits or misses so
+    the cache can be sized.
+    """
+
+    MAXSIZE = 1000
+    """Default most screenshots to remember."""
+
+    TTL = datetime.timedelta(hours=1)
+    """Default time a screenshot is reused for."""
+
+    def __init__(self, maxsize=MAXSIZE, ttl=TTL):
+        """
+        Create a new ScreenshotCache.
+
+        :param int maxsize: most screenshots to remember before forgetting the
+        least recently used
+        :param timedelta ttl: how long after it's stored a screenshot's reused
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl.total_seconds()
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._screenshots = OrderedDict()
+
+    def __len__(self):
+        return len(self._screenshots)
+
+    def __repr__(self):
+        return '<{cls}({size}/{maxsize}, {hits} hits, {misses} misses)>'.format(
+            cls=self.__class__.__name__,
+            size=len(self),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses)
+
+    def get(self, key):
+        """
+        Look up a screenshot that hasn't expired.
+
+        :param str key: canonical URL of the screenshotted page
+        :returns: URL of screenshot and image deletehash, or None
+        :rtype: tuple[str, str] or None
+        """
+        with self._lock:
+            try:
+                stored_at, screenshot = self._screenshots[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if stored_at + self.ttl < time.time():
+                del self._screenshots[key]
+                self.misses += 1
+                return None
+            self._screenshots.move_to_end(key)
+            self.hits += 1
+            return screenshot
+
+    def put(self, key, url, deletehash):
+        """
+        Remember a screenshot, forgetting the least recently used if full.
+
+        :param str key: canonical URL of the screenshotted page
+        :param str url: URL of screenshot
+        :param str deletehash: image deletehash
+        """
+        with self._lock:
+            self._screenshots[key] = (time.time(), (url, deletehash))
+            self._screenshots.move_to_end(key)
+            while len(self._screenshots) > self.maxsize:
+                self._screenshots.popitem(last=False)
+
+
+def connect_db(db, **engine_kwargs):
+    """
+    Connect to a database, unless given one that's already connected.
+
+    A :class:`Database` keeps a connection per thread, borrowed from its
+    engine's pool, so one may be shared by every bot. SQLite connections can't
+    cross threads, so unless told otherwise, each is opened when it's borrowed
+    rather than all threads sharing one, as :mod:`dataset` would have it.
+
+    Reflected tables stay bound to whichever thread's connection reflected
+    them, so statements must be run on :attr:`Database.executable`, never
+    executed implicitly.
+
+    :param db: a connected database, or an SQLAlchemy-style DB URI
+    :type db: Database or str
+    :param engine_kwargs: extra arguments for :func:`sqlalchemy.create_engine`,
+    e.g. `pool_size`; ignored if `db` is already connected
+    :returns: connected database
+    :rtype: Database
+    """
+    if isinstance(db, dataset.Database):
+        return db
+    if db.lower().startswith('sqlite'):
+        engine_kwargs.setdefault('poolclass', NullPool)
+    return dataset.connect(db, engine_kwargs=engine_kwargs or None)
+
+
+def release_connection(db):
+    """
+    Return the calling thread's connection, if it has one, to the pool.
+
+    :param Database db:
+    """
+    conn = getattr(db.local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        del db.local.conn
+
+
 SUBMISSIONS_COLUMNS = {
     'bot_commented_at': sqlalchemy.types.DateTime,
     'bot_screenshot_at': sqlalchemy.types.DateTime,
     'bot_screenshot_deletehash': sqlalchemy.types.String(length=16),
+    'bot_screenshot_failures': sqlalchemy.types.Integer,
     'bot_screenshot_lock': sqlalchemy.types.DateTime,
     'bot_screenshot_url': sqlalchemy.types.String(length=256),
+    'bot_screenshot_worker': sqlalchemy.types.String(length=64),
 }
 
 
+MAX_SCREENSHOT_FAILURES = 3
+"""Failed attempts after which a submission's screenshot is given up on."""
+
+
+def needs_screenshot(columns):
+    """
+    :param columns: the submissions table's columns
+    :returns: clause matching submissions without a screenshot that haven't
+    failed too often to try again
+    :rtype: ClauseElement
+    """
+    return and_(
+        columns.bot_screenshot_at == None,  # noqa
+        or_(columns.bot_screenshot_failures == None,  # noqa
+            columns.bot_screenshot_failures < MAX_SCREENSHOT_FAILURES))
+
+
+def record_screenshot_failure(submissions_table, submission_id):
+    """
+    Count a failed attempt to screenshot a submission.
+
+    Any claim on the submission is left to expire, so it's retried no sooner,
+    and not at all once it's failed :data:`MAX_SCREENSHOT_FAILURES` times.
+
+    :param Table submissions_table:
+    :param int submission_id:
+    """
+    table = submissions_table.table
+    col = table.columns
+    submissions_table.db.executable.execute(
+        table.update().where(col.id == submission_id).values(
+            bot_screenshot_failures=func.coalesce(
+                col.bot_screenshot_failures, 0) + 1))
+
+
 def ensure_schema(submissions_table):
     """
     Ensure the required columns exist in the submissions table.
 
+    Creating them all up front means inserts never need to alter the table.
+
     :param Table submissions_table:
     """
-    if all(map(submissions_table.has_column, SUBMISSIONS_COLUMNS)):
+    columns = dict(SUBMISSION_FIELDS)
+    columns[EXTRA_FIELDS_COLUMN] = sqlalchemy.types.UnicodeText
+    columns.update(SUBMISSIONS_COLUMNS)
+    missing = [
+        column for column in columns
+        if not submissions_table.has_column(column)
+    ]
+    if not missing:
         return
-    log.debug("Adding screenshot columns to table")
-    for column, _type in SUBMISSIONS_COLUMNS.items():
-        submissions_table.create_column(column, _type)
+    log.debug("Adding columns to table: %s", ', '.join(missing))
+    for column in missing:
+        submissions_table.create_column(column, columns[column])
 
 
 def markdown_quote(text, quote='> '):
@@ -248,3 +511,27 @@ def comment_id_from_url(url):
     :rtype: str
     """
     return COMMENT_URL_RE.match(url).group('id')
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonical_url(url):
+    """
+    Normalize the parts of a URL that don't change the page it points to.
+
+    Lowercases the scheme and host, drops default ports, fragments and
+    trailing slashes, and sorts query parameters.
+
+    :param str url:
+    :returns: canonical form of the URL
+    :rtype: str
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, parts.port)
+    path = parts.path.rstrip('/') or '/'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ''))
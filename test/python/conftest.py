@@ -8,7 +8,7 @@ from mock import MagicMock, Mock, patch
 from pytest import fixture
 
 from shotbot import Shotbot
-from shotbot.bots import Renderer
+from shotbot.bots.renderer import DriverFactory
 from shotbot.utils import ensure_schema
 
 SCREENSHOT_PNG_CONTENT = b'deadbeef'
@@ -60,6 +60,7 @@ def mocked_driver():
         with patch('shotbot.bots.renderer.webdriver.Firefox', driver):
             driver = driver.return_value
             driver.get_screenshot_as_png.return_value = SCREENSHOT_PNG_CONTENT
+            driver.execute_script.return_value = 'complete'
             find_result = driver.find_element_by_xpath.return_value
             find_result.screenshot_as_png = SCREENSHOT_PNG_CONTENT
             find_result.size = {'height': 1000, 'widht': 1000}
@@ -94,7 +95,7 @@ def mocked_imgur():
     with patch('imgurpython.ImgurClient', autospec=True) as imgur:
         with patch('shotbot.bots.renderer.imgurpython.ImgurClient', imgur):
             imgur = imgur.return_value
-            imgur.upload_from_path.return_value = {
+            imgur.make_request.return_value = {
                 'link': 'https://i.imgur.com/404',
                 'deletehash': 'none',
             }
@@ -123,5 +124,5 @@ def isolated_shotbot(mocked_reddit, mocked_driver, mocked_imgur,
                       owner='owner',
                       watched_subreddits={'fakesub': {}})
     finally:
-        if os.path.exists(Renderer.UBLOCK_XPI_PATH):
-            os.remove(Renderer.UBLOCK_XPI_PATH)
+        if os.path.exists(DriverFactory.UBLOCK_XPI_PATH):
+            os.remove(DriverFactory.UBLOCK_XPI_PATH)
@@ -86,8 +86,10 @@ def mock_submission(reddit=None):
 
     data = {
         "author": _author(),
-        "created": created,
-        "created_utc": created,
+        "created": created.replace(tzinfo=datetime.timezone.utc).timestamp(),
+        "created_utc": created.replace(
+            tzinfo=datetime.timezone.utc).timestamp(),
+        "fullname": "t3_{}".format(submission_id),
         "id": submission_id,
         "permalink": permalink,
         "score": _score(),
@@ -0,0 +1,142 @@
+"""Validate that :class:`Autoscaler` behaves correctly."""
+import datetime
+import time
+
+from mock import Mock, patch
+from pytest import fixture, raises
+
+from helpers import mock_submission
+from shotbot.bots.autoscaler import Autoscaler, RendererThreads
+from shotbot.exceptions import RendererException
+from shotbot.utils import MAX_SCREENSHOT_FAILURES, submission_as_dict
+
+
+@fixture
+def autoscaler(temporary_sqlite_uri, submissions_table):
+    target = Mock(size=1)
+    yield Autoscaler(temporary_sqlite_uri,
+                     target,
+                     Mock(),
+                     min_size=1,
+                     max_size=3,
+                     scale_up_backlog=10,
+                     scale_down_backlog=2,
+                     scale_up_age=datetime.timedelta(minutes=10),
+                     scale_up_cooldown=datetime.timedelta(minutes=1),
+                     scale_down_after=datetime.timedelta(minutes=10))
+
+
+def test_scales_up_on_backlog_within_limits(autoscaler):
+    assert autoscaler._desired_size(1, 10, 0, 1000) == 2
+    # cooling down
+    assert autoscaler._desired_size(2, 20, 0, 1030) == 2
+    assert autoscaler._desired_size(2, 20, 0, 1060) == 3
+    assert autoscaler._desired_size(3, 300, 0, 2000) == 3
+
+
+def test_scales_up_on_age(autoscaler):
+    assert autoscaler._desired_size(1, 1, 600, 1000) == 2
+
+
+def test_scale_up_held_back_by_memory(autoscaler):
+    autoscaler.min_free_memory = 512
+    with patch.object(autoscaler, '_free_memory', return_value=256):
+        assert autoscaler._desired_size(1, 100, 0, 1000) == 1
+
+
+def test_free_memory_counts_page_cache(autoscaler, tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal:        8000000 kB\n'
+                  'MemFree:          100000 kB\n'
+                  'MemAvailable:    2097152 kB\n')
+    with patch.object(Autoscaler, 'MEMINFO_PATH', str(meminfo)):
+        assert autoscaler._free_memory() == 2048
+
+
+def test_free_memory_falls_back_to_sysconf(autoscaler, tmpdir):
+    with patch.object(Autoscaler, 'MEMINFO_PATH', str(tmpdir.join('none'))), \
+            patch('os.sysconf', side_effect=[256, 4096]):
+        assert autoscaler._free_memory() == 1
+
+
+def test_scales_down_once_calm(autoscaler):
+    assert autoscaler._desired_size(3, 3, 0, 1000) == 3
+    # between the thresholds; not calm, but no need for more either
+    assert autoscaler._desired_size(3, 15, 0, 1300) == 3
+    assert autoscaler._desired_size(3, 3, 0, 1400) == 3
+    assert autoscaler._desired_size(3, 3, 0, 2000) == 2
+    assert autoscaler._desired_size(2, 0, 0, 2100) == 2
+    assert autoscaler._desired_size(2, 0, 0, 2600) == 1
+    assert autoscaler._desired_size(1, 0, 0, 9000) == 1
+
+
+def test_measure_backlog(autoscaler, db, submissions_table):
+    now = time.time()
+    rows = [submission_as_dict(mock_submission()) for _ in range(4)]
+    for age, row in zip((60, 120, 180, 240), rows):
+        row['created_utc'] = now - age
+    rows[0]['bot_screenshot_at'] = datetime.datetime.utcnow()
+    # deferred by a circuit breaker
+    rows[3]['bot_screenshot_lock'] = (datetime.datetime.utcnow() +
+                                      datetime.timedelta(minutes=5))
+    for row in rows:
+        submissions_table.insert(row)
+    db.commit()
+
+    backlog, oldest_age = autoscaler._measure_backlog()
+    assert backlog == 2
+    assert 180 <= oldest_age < 190
+
+
+def test_failing_submission_doesnt_pin_size(autoscaler, db,
+                                            submissions_table):
+    stale = time.time() - 3600
+    backing_off, given_up = (submission_as_dict(mock_submission())
+                             for _ in range(2))
+    backing_off.update(created_utc=stale,
+                       bot_screenshot_failures=1,
+                       bot_screenshot_worker='some-renderer',
+                       bot_screenshot_lock=(datetime.datetime.utcnow() +
+                                            datetime.timedelta(minutes=5)))
+    given_up.update(created_utc=stale,
+                    bot_screenshot_failures=MAX_SCREENSHOT_FAILURES)
+    for row in (backing_off, given_up):
+        submissions_table.insert(row)
+    db.commit()
+
+    backlog, oldest_age = autoscaler._measure_backlog()
+    assert (backlog, oldest_age) == (0, 0)
+    assert autoscaler._desired_size(3, backlog, oldest_age, 1000) == 3
+    assert autoscaler._desired_size(3, backlog, oldest_age, 1600) == 2
+
+
+def test_renderer_threads_resize():
+    renderers = []
+
+    def factory(stop):
+        renderer = Mock()
+        renderer.run.side_effect = lambda: stop.wait(5)
+        renderers.append(renderer)
+        return renderer
+
+    driver_pool = Mock()
+    group = RendererThreads(factory, driver_pool, Mock())
+    try:
+        group.resize(2)
+        assert group.renderers == renderers
+        driver_pool.resize.assert_called_with(2)
+
+        group.resize(1)
+        assert group.renderers == renderers[:1]
+        driver_pool.resize.assert_called_with(1)
+    finally:
+        group.stop()
+    assert group.size == 0
+
+
+def test_renderer_threads_dead_renderer_raises():
+    group = RendererThreads(lambda stop: Mock(), Mock(), Mock())
+    group.resize(1)
+    group._running[0][1].join()
+    with raises(RendererException):
+        group.resize(1)
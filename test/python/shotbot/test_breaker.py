@@ -0,0 +1,60 @@
+"""Validate that :class:`CircuitBreaker` behaves correctly."""
+import datetime
+
+from mock import patch
+from pytest import fixture
+
+from shotbot.breaker import CircuitBreaker
+
+DOMAIN = 'slow.example.com'
+
+
+@fixture
+def mocked_time():
+    with patch('shotbot.breaker.time.time') as mocked:
+        mocked.return_value = 1000
+        yield mocked
+
+
+@fixture
+def breaker(mocked_time):
+    yield CircuitBreaker(failure_threshold=2,
+                         reset_timeout=datetime.timedelta(seconds=60))
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record(DOMAIN, 30, failed=True)
+    breaker.record(DOMAIN, 1, failed=False)
+    breaker.record(DOMAIN, 30, failed=True)
+    assert breaker.allows(DOMAIN)
+    breaker.record(DOMAIN, 30, failed=True)
+
+    assert not breaker.allows(DOMAIN)
+    assert breaker.allows('fast.example.com')
+    assert breaker.open_domains() == [DOMAIN]
+    assert breaker.retry_at(DOMAIN) == datetime.datetime.utcfromtimestamp(
+        1060)
+
+
+def test_trial_render_closes_or_reopens(breaker, mocked_time):
+    for _ in range(2):
+        breaker.record(DOMAIN, 30, failed=True)
+
+    mocked_time.return_value = 1061
+    assert breaker.allows(DOMAIN)
+    assert not breaker.allows(DOMAIN)  # one trial at a time
+    breaker.record(DOMAIN, 30, failed=True)
+    assert not breaker.allows(DOMAIN)
+
+    mocked_time.return_value = 1122
+    assert breaker.allows(DOMAIN)
+    breaker.record(DOMAIN, 2, failed=False)
+    assert breaker.allows(DOMAIN)
+    assert not breaker.open_domains()
+
+
+def test_tracks_latency(breaker):
+    assert breaker.latency(DOMAIN) is None
+    breaker.record(DOMAIN, 10, failed=False)
+    breaker.record(DOMAIN, 20, failed=False)
+    assert breaker.latency(DOMAIN) == 13
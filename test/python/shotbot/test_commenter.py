@@ -9,7 +9,7 @@ from pytest import fixture
 
 from helpers import mock_submission
 from shotbot.bots import Commenter
-from shotbot.utils import remove_blacklisted_fields, submission_as_dict
+from shotbot.utils import submission_as_dict
 
 SUBREDDIT = 'fakesub'
 
@@ -25,7 +25,7 @@ def isolated_commenter(mocked_reddit, submissions_table, temporary_sqlite_uri):
 @fixture
 def submissions_in_db(db, submissions_table):
     mock_submissions = [
-        remove_blacklisted_fields(submission_as_dict(mock_submission()))
+        submission_as_dict(mock_submission())
         for _ in range(100)
     ]
     for submission in mock_submissions:
@@ -67,8 +67,7 @@ def test_process_submissions(isolated_commenter, submissions_in_db):
 def test_process_submission(isolated_commenter, mocked_reddit, db,
                             submissions_table):
     """:func:`_process_submission` behaves as expected."""
-    submission = remove_blacklisted_fields(submission_as_dict(mock_submission(
-    )))
+    submission = submission_as_dict(mock_submission())
     submission['bot_screenshot_at'] = datetime.datetime.utcnow()
     submission['bot_screenshot_url'] = 'https://imgur.com/404'
     submissions_table.insert(submission)
@@ -97,8 +96,7 @@ def test_process_submission(isolated_commenter, mocked_reddit, db,
 def test_dry_run(isolated_commenter, mocked_reddit, db, submissions_table):
     isolated_commenter.dry_run = True
 
-    submission = remove_blacklisted_fields(submission_as_dict(mock_submission(
-    )))
+    submission = submission_as_dict(mock_submission())
     submission['bot_screenshot_at'] = datetime.datetime.utcnow()
     submission['bot_screenshot_url'] = 'https://imgur.com/404'
     submissions_table.insert(submission)
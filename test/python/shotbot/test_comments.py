@@ -0,0 +1,88 @@
+"""Validate that :class:`CommentThreadPages` behaves correctly."""
+from mock import patch
+from pytest import fixture, raises
+
+from shotbot.comments import CommentThreadPages, time_ago
+from shotbot.exceptions import RendererException
+
+COMMENT_URL = 'https://www.reddit.com/r/sub/comments/abc/title/ccc/'
+
+
+def comment(_id, parent_id, *replies):
+    return {
+        'kind': 't1',
+        'data': {
+            'id': _id,
+            'parent_id': parent_id,
+            'author': 'author_' + _id,
+            'score': 1,
+            'created_utc': 0,
+            'body_html': '<div class="md"><p>body {}</p></div>'.format(_id),
+            'replies': {
+                'data': {
+                    'children': list(replies)
+                }
+            } if replies else '',
+        }
+    }
+
+
+@fixture
+def pages():
+    with patch('shotbot.comments.requests.Session') as session:
+        pages = CommentThreadPages('test agent', context=9)
+        response = session.return_value.get.return_value
+        response.json.return_value = [{}, {
+            'data': {
+                'children': [
+                    comment('aaa', 't3_abc',
+                            comment('bbb', 't1_aaa',
+                                    comment('ccc', 't1_bbb',
+                                            comment('ddd', 't1_ccc')),
+                                    {'kind': 'more', 'data': {}}))
+                ]
+            }
+        }]
+        yield pages
+
+
+def test_fetch_comment_chain(pages):
+    chain = pages.fetch(COMMENT_URL + '?context=3')
+
+    assert [data['id'] for data in chain] == ['aaa', 'bbb', 'ccc']
+    pages._session.get.assert_called_once_with(
+        'https://www.reddit.com/r/sub/comments/abc/title/ccc.json',
+        params={'context': 9, 'raw_json': 1},
+        timeout=CommentThreadPages.TIMEOUT)
+
+
+def test_fetch_limits_context(pages):
+    pages.context = 1
+    assert [data['id'] for data in pages.fetch(COMMENT_URL)] == ['bbb', 'ccc']
+
+
+def test_fetch_missing_comment(pages):
+    with raises(RendererException):
+        pages.fetch('https://www.reddit.com/r/sub/comments/abc/title/zzz/')
+
+
+def test_html_nests_chain(pages):
+    html = pages(COMMENT_URL)
+
+    assert html.index('id="thing_t1_aaa"') < html.index('id="thing_t1_ccc"')
+    assert 'thing_t1_ddd' not in html
+    assert '<p>body ccc</p>' in html
+    assert html.count('<div') == html.count('</div>')
+
+
+def test_html_escapes_fields(pages):
+    chain = pages.fetch(COMMENT_URL)
+    chain[0]['author'] = '<script>'
+
+    assert '<script>' not in pages.html(chain)
+
+
+def test_time_ago():
+    assert time_ago(0, now=30) == 'just now'
+    assert time_ago(0, now=60) == '1 minute ago'
+    assert time_ago(0, now=5 * 3600 + 59) == '5 hours ago'
@@ -0,0 +1,56 @@
+"""Validate that submission filters behave correctly."""
+import datetime
+import time
+
+from mock import Mock
+from pytest import raises
+
+from shotbot.filters import (DomainFilter, FilterChain, NewerThanFilter,
+                             SubmissionFilter)
+
+
+class TruthFilter(SubmissionFilter):
+    def accepts(self, submission):
+        return bool(submission)
+
+
+def test_filter_must_implement_accepts():
+    with raises(TypeError):
+        SubmissionFilter()
+
+
+def test_counts():
+    _filter = TruthFilter()
+    assert [_filter(s) for s in (True, False, False)] == [True, False, False]
+    assert (_filter.accepted, _filter.rejected) == (1, 2)
+
+
+def test_domain_filter():
+    _filter = DomainFilter(['reddit.com'])
+    assert _filter(Mock(domain='reddit.com'))
+    assert not _filter(Mock(domain='example.com'))
+
+
+def test_newer_than_filter():
+    _filter = NewerThanFilter(datetime.timedelta(hours=1))
+    assert _filter(Mock(created_utc=time.time() - 60))
+    assert not _filter(Mock(created_utc=time.time() - 7200))
+
+
+def test_chain_stops_at_first_rejection():
+    chain = FilterChain.from_options({
+        'domains': ['reddit.com'],
+        'newer_than': {'hours': 1},
+    })
+    domains, newer_than = chain.filters
+
+    assert not chain(Mock(domain='example.com', created_utc=time.time()))
+    assert domains.rejected == 1
+    assert newer_than.accepted == newer_than.rejected == 0
+
+    assert chain(Mock(domain='reddit.com', created_utc=time.time()))
+    assert domains.accepted == newer_than.accepted == 1
+
+
+def test_chain_from_empty_options():
+    assert FilterChain.from_options({}) is None
@@ -0,0 +1,75 @@
+"""Validate that screenshot optimization behaves correctly."""
+import io
+import os
+
+from mock import Mock
+from PIL import Image
+from pytest import fixture, raises
+
+from shotbot.images import ScreenshotOptimizer, optimize
+
+
+def _png(image):
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+@fixture
+def flat_screenshot():
+    yield _png(Image.new('RGBA', (800, 600), 'white'))
+
+
+@fixture
+def noisy_screenshot():
+    yield _png(Image.frombytes('RGB', (1000, 1000), os.urandom(3000000)))
+
+
+def test_optimize_png(flat_screenshot):
+    optimized = optimize(flat_screenshot, quantize=True)
+    assert len(optimized) <= len(flat_screenshot)
+    image = Image.open(io.BytesIO(optimized))
+    assert image.format == 'PNG'
+    assert image.size == (800, 600)
+
+
+def test_optimize_fits_max_bytes(noisy_screenshot):
+    optimized = optimize(noisy_screenshot,
+                         image_format='jpeg',
+                         max_bytes=100000)
+    assert len(optimized) <= 100000
+    image = Image.open(io.BytesIO(optimized))
+    assert image.format == 'JPEG'
+    assert image.width < 1000
+
+
+def test_optimizer_rejects_unknown_format():
+    with raises(ValueError):
+        ScreenshotOptimizer(image_format='gif')
+
+
+def test_optimizer_spawns_processes(flat_screenshot):
+    optimizer = ScreenshotOptimizer(processes=1, quantize=True)
+    try:
+        assert optimizer._pool._mp_context.get_start_method() == 'spawn'
+        assert len(optimizer(flat_screenshot)) <= len(flat_screenshot)
+        assert optimizer.bytes_in == len(flat_screenshot)
+    finally:
+        optimizer.close()
+
+
+def test_optimizer_falls_back_to_original():
+    optimizer = ScreenshotOptimizer(processes=1)
+    try:
+        assert optimizer(b'not a png') == b'not a png'
+    finally:
+        optimizer.close()
+
+
+def test_optimizer_falls_back_on_any_error():
+    optimizer = ScreenshotOptimizer(processes=1)
+    optimizer.close()
+    optimizer._pool = Mock()
+    optimizer._pool.submit.return_value.result.side_effect = SyntaxError
+
+    assert optimizer(b'corrupt png') == b'corrupt png'
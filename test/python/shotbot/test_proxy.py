@@ -0,0 +1,41 @@
+"""Validate that :class:`BlockingProxy` behaves correctly."""
+import http.client
+
+from pytest import fixture
+
+from shotbot.proxy import BlockingProxy
+
+
+@fixture
+def blocking_proxy():
+    proxy = BlockingProxy(['*.ads.example', 'tracker.example'])
+    proxy.start()
+    try:
+        yield proxy
+    finally:
+        proxy.close()
+
+
+def test_blocks_matching_hosts():
+    proxy = BlockingProxy(['*.ads.example'])
+    try:
+        assert proxy.blocks('cdn.ADS.example')
+        assert not proxy.blocks('reddit.com')
+        assert proxy.blocked == {'*.ads.example': 1}
+    finally:
+        proxy.close()
+
+
+def test_refuses_blocked_tunnels(blocking_proxy):
+    conn = http.client.HTTPConnection(*blocking_proxy.address)
+    conn.request('CONNECT', 'tracker.example:443')
+    assert conn.getresponse().status == 403
+    conn.close()
+
+
+def test_refuses_blocked_requests(blocking_proxy):
+    conn = http.client.HTTPConnection(*blocking_proxy.address)
+    conn.request('GET', 'http://pixel.ads.example/spy.gif')
+    assert conn.getresponse().status == 403
+    conn.close()
+    assert blocking_proxy.blocked['*.ads.example'] == 1
@@ -1,18 +1,31 @@
 """Validate that :class:`Renderer` behaves correctly."""
+import base64
 import copy
+import datetime
 import os
-from tempfile import NamedTemporaryFile
+import stat
+import time
+from threading import Event, Thread
+from urllib.parse import urlsplit
 
-from mock import Mock, patch
+from mock import Mock, PropertyMock, patch
 from pytest import fixture, raises
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 from helpers import SCREENSHOT_PNG_CONTENT, mock_submission
-from shotbot.bots import Renderer
-from shotbot.exceptions import RendererException
-from shotbot.utils import remove_blacklisted_fields, submission_as_dict
+from shotbot.bots import CommentContextRenderer, Renderer
+from shotbot.bots.renderer import (CAP_HEIGHT_JS, MAX_SCREENSHOT_HEIGHT,
+                                   DriverFactory, DriverPool, SessionCookies)
+from shotbot.exceptions import BrowserUnavailable, RendererException
+from shotbot.utils import (MAX_SCREENSHOT_FAILURES, ScreenshotCache,
+                           submission_as_dict)
 
 SUBREDDIT = 'fakesub'
 
+IMGUR_AUTH = {'client_id': '', 'client_secret': ''}
+
+REDDIT_ARGS = {'username': 'USERNAME', 'password': 'PASSWORD'}
+
 
 @fixture
 def isolated_renderer(mocked_driver, mocked_imgur, mocked_requests_get,
@@ -20,33 +33,97 @@ def isolated_renderer(mocked_driver, mocked_imgur, mocked_requests_get,
     """Return a Renderer with mocked dependencies."""
     kill_switch = Mock()
     kill_switch.is_set.return_value = False
-    imgur_auth = {'client_id': '', 'client_secret': ''}
-    reddit_args = {'username': 'USERNAME', 'password': 'PASSWORD'}
-    renderer = Renderer(imgur_auth, reddit_args, temporary_sqlite_uri,
+    renderer = Renderer(IMGUR_AUTH, REDDIT_ARGS, temporary_sqlite_uri,
                         kill_switch)
     renderer.driver = mocked_driver
     try:
         yield renderer
     finally:
-        if os.path.exists(Renderer.UBLOCK_XPI_PATH):
-            os.remove(Renderer.UBLOCK_XPI_PATH)
+        if os.path.exists(DriverFactory.UBLOCK_XPI_PATH):
+            os.remove(DriverFactory.UBLOCK_XPI_PATH)
 
 
 def test_render_url(isolated_renderer, mocked_driver):
     """:func:`render` behaves as expected."""
     some_url = "http://example.com"
-    temp_file = isolated_renderer.render(some_url)
-    assert os.path.exists(temp_file)
-    with open(temp_file, 'rb') as temp_fh:
-        assert temp_fh.read() == SCREENSHOT_PNG_CONTENT
+    assert isolated_renderer.render(some_url) == SCREENSHOT_PNG_CONTENT
 
     mocked_driver.get.assert_called_once_with(some_url)
 
 
+def test_render_caps_height(isolated_renderer, mocked_driver):
+    body = mocked_driver.find_element_by_xpath.return_value
+    body.size = {'height': 5000, 'width': 1000}
+
+    isolated_renderer.render("http://example.com", max_height=4000)
+
+    mocked_driver.execute_script.assert_called_with(CAP_HEIGHT_JS, body, 4000)
+
+
+def test_render_clips_to_selector(isolated_renderer, mocked_driver):
+    content = Mock(size={'height': 100, 'width': 100},
+                   screenshot_as_png=b'content')
+    mocked_driver.find_elements_by_css_selector.return_value = [content]
+    isolated_renderer.clip_selectors = {'*.example.com': '#content'}
+
+    assert isolated_renderer.render("http://en.example.com/wiki") == (
+        b'content')
+    mocked_driver.find_elements_by_css_selector.assert_called_once_with(
+        '#content')
+    assert isolated_renderer.render("http://example.org") == (
+        SCREENSHOT_PNG_CONTENT)
+
+
+def test_comment_clipped_to_thread():
+    renderer = CommentContextRenderer.__new__(CommentContextRenderer)
+    renderer.driver = Mock()
+    thread = renderer.driver.execute_script.return_value
+
+    assert renderer._clip_element(
+        'https://www.reddit.com/r/sub/comments/abc/title/def/') is thread
+    renderer.driver.execute_script.assert_called_once_with(
+        CommentContextRenderer.COMMENT_THREAD_JS, 'thing_t1_def')
+
+
+def test_render_waits_for_ready_state(isolated_renderer, mocked_driver):
+    mocked_driver.execute_script.side_effect = ['loading', 'interactive']
+    isolated_renderer.render("http://example.com", max_height=None)
+    mocked_driver.execute_script.assert_called_with(
+        'return document.readyState;')
+
+
+def test_render_stops_page_after_timeout(isolated_renderer, mocked_driver):
+    mocked_driver.execute_script.return_value = 'loading'
+    isolated_renderer.render_timeout = 0.1
+
+    assert isolated_renderer.render(
+        "http://example.com", max_height=None) == SCREENSHOT_PNG_CONTENT
+    mocked_driver.execute_script.assert_called_with('window.stop();')
+
+
+def test_renderer_rejects_unknown_ready_state(isolated_renderer):
+    with raises(ValueError):
+        Renderer({}, {}, isolated_renderer._db, Mock(), ready_state='soon')
+
+
+def test_comment_ready_condition():
+    renderer = CommentContextRenderer.__new__(CommentContextRenderer)
+    condition = renderer._ready_condition(
+        'https://www.reddit.com/r/sub/comments/abc/title/def/?context=9')
+    driver = Mock()
+    driver.find_element.return_value.is_displayed.return_value = True
+
+    assert condition(driver)
+    driver.find_element.assert_called_once_with('id', 'thing_t1_def')
+
+    driver.find_element.return_value.is_displayed.return_value = False
+    assert not condition(driver)
+
+
 def test_process_next_submission(isolated_renderer, db, submissions_table):
     """:func:`_process_submissions` behaves as expected."""
     mock_submissions = [
-        remove_blacklisted_fields(submission_as_dict(mock_submission()))
+        submission_as_dict(mock_submission())
         for _ in range(100)
     ]
     submissions_table.insert_many(mock_submissions)
@@ -54,15 +131,116 @@ def test_process_next_submission(isolated_renderer, db, submissions_table):
 
     with patch.object(isolated_renderer,
                       '_process_submission') as mocked_process:
-        isolated_renderer._process_next_submission()
-        mocked_process.assert_called_once()
+        isolated_renderer._process_next_submissions()
+        assert mocked_process.call_count == Renderer.CLAIM_BATCH_SIZE
+
+
+def test_new_screenshots_signalled(isolated_renderer, db, submissions_table):
+    submissions_table.insert(submission_as_dict(mock_submission()))
+    db.commit()
+    isolated_renderer._new_screenshots = Event()
+
+    with patch.object(isolated_renderer, '_process_submission'):
+        isolated_renderer._process_next_submissions()
+
+    assert isolated_renderer._new_screenshots.is_set()
+
+
+def test_claim_submissions_is_exclusive(isolated_renderer, db,
+                                        submissions_table):
+    """Claimed submissions can't be claimed again until the lock expires."""
+    submissions_table.insert_many([
+        submission_as_dict(mock_submission()) for _ in range(5)
+    ])
+    db.commit()
+    other = copy.copy(isolated_renderer)
+    other.worker_id = 'other-worker'
+
+    first = isolated_renderer._claim_submissions(db, submissions_table, 3)
+    second = other._claim_submissions(db, submissions_table, 3)
+
+    assert len(first) == 3
+    assert len(second) == 2
+    assert not set(first) & set(second)
+    for _id in first:
+        row = submissions_table.find_one(id=_id)
+        assert row['bot_screenshot_worker'] == isolated_renderer.worker_id
+    assert not other._claim_submissions(db, submissions_table, 3)
+
+
+def test_unprocessed_claims_released_on_kill(isolated_renderer, db,
+                                             submissions_table):
+    submissions_table.insert_many([
+        submission_as_dict(mock_submission()) for _ in range(3)
+    ])
+    db.commit()
+    isolated_renderer._kill.is_set.return_value = True
+
+    with patch.object(isolated_renderer,
+                      '_process_submission') as mocked_process:
+        assert isolated_renderer._process_next_submissions() == 3
+        mocked_process.assert_not_called()
+
+    for row in submissions_table.find():
+        assert row['bot_screenshot_lock'] is None
+        assert row['bot_screenshot_worker'] is None
+
+
+def test_claims_released_when_no_browser(isolated_renderer, db,
+                                         submissions_table):
+    submissions_table.insert_many([
+        submission_as_dict(mock_submission()) for _ in range(3)
+    ])
+    db.commit()
+    isolated_renderer.driver_pool = DriverPool(
+        Mock(side_effect=WebDriverException))
+
+    assert isolated_renderer._process_next_submissions() == 3
+
+    isolated_renderer._kill.wait.assert_called_once_with(
+        Renderer.BROWSER_RETRY_DELAY)
+    for row in submissions_table.find():
+        assert row['bot_screenshot_lock'] is None
+        assert row['bot_screenshot_worker'] is None
+
+
+def test_failed_submission_kept_claimed(isolated_renderer, db,
+                                        submissions_table):
+    """An unexpected error keeps that claim, and moves on to the next."""
+    submissions_table.insert_many([
+        submission_as_dict(mock_submission()) for _ in range(2)
+    ])
+    db.commit()
+
+    with patch.object(isolated_renderer, '_process_submission',
+                      side_effect=RuntimeError) as mocked_process:
+        assert isolated_renderer._process_next_submissions() == 2
+        assert isolated_renderer._process_next_submissions() == 0
+        assert mocked_process.call_count == 2
+
+    for row in submissions_table.find():
+        assert row['bot_screenshot_worker'] == isolated_renderer.worker_id
+        assert row['bot_screenshot_lock'] > datetime.datetime.utcnow()
+        assert row['bot_screenshot_failures'] == 1
+
+
+def test_failing_submission_given_up(isolated_renderer, db,
+                                     submissions_table):
+    submissions_table.insert(submission_as_dict(mock_submission()))
+    db.commit()
+    isolated_renderer.LOCK_TIME = datetime.timedelta(seconds=-1)
+
+    with patch.object(isolated_renderer, '_process_submission',
+                      side_effect=RuntimeError) as mocked_process:
+        for _ in range(MAX_SCREENSHOT_FAILURES + 1):
+            isolated_renderer._process_next_submissions()
+        assert mocked_process.call_count == MAX_SCREENSHOT_FAILURES
 
 
 def test_process_submission(isolated_renderer, mocked_driver, mocked_imgur, db,
                             submissions_table):
     """:func:`_process_submission` behaves as expected."""
-    submission = remove_blacklisted_fields(
-        submission_as_dict(mock_submission()))
+    submission = submission_as_dict(mock_submission())
     submissions_table.insert(submission)
     db.commit()
 
@@ -76,35 +254,457 @@ def test_process_submission(isolated_renderer, mocked_driver, mocked_imgur, db,
     assert updated_submission['bot_screenshot_url']
 
 
+def test_process_submission_hands_off_upload(isolated_renderer, mocked_imgur,
+                                             db, submissions_table):
+    submission = submission_as_dict(mock_submission())
+    submissions_table.insert(submission)
+    db.commit()
+    isolated_renderer.uploader = Mock()
+
+    assert not isolated_renderer._process_submission(submissions_table,
+                                                     copy.copy(submission))
+
+    isolated_renderer.uploader.submit.assert_called_once_with(
+        submission['id'], isolated_renderer.worker_id, SCREENSHOT_PNG_CONTENT,
+        isolated_renderer.cache_key(submission['url']))
+    mocked_imgur.make_request.assert_not_called()
+    row = submissions_table.find_one(id=submission['id'])
+    assert row['bot_screenshot_url'] is None
+
+
+def test_cached_screenshot_reused(isolated_renderer, mocked_imgur, db,
+                                  submissions_table):
+    first, second = (submission_as_dict(mock_submission()) for _ in range(2))
+    second['url'] = first['url'] + '#fragment'
+    submissions_table.insert_many([first, second])
+    db.commit()
+    isolated_renderer.screenshot_cache = ScreenshotCache()
+
+    for submission in (first, second):
+        assert isolated_renderer._process_submission(submissions_table,
+                                                     copy.copy(submission))
+
+    mocked_imgur.make_request.assert_called_once()
+    rows = [submissions_table.find_one(id=s['id']) for s in (first, second)]
+    assert rows[0]['bot_screenshot_url'] == rows[1]['bot_screenshot_url']
+
+
+def test_comment_rendered_from_api():
+    renderer = CommentContextRenderer.__new__(CommentContextRenderer)
+    renderer.driver = Mock()
+    renderer.comment_pages = Mock(THREAD_ID='thread')
+    thread = renderer.driver.find_element_by_id.return_value
+    thread.size = {'height': 100, 'width': 100}
+
+    assert renderer.render('https://www.reddit.com/r/sub/comments/abc/title/'
+                           'def/') is thread.screenshot_as_png
+    renderer.comment_pages.assert_called_once_with(
+        'https://www.reddit.com/r/sub/comments/abc/title/def/?context=9')
+    renderer.driver.execute_script.assert_called_once_with(
+        CommentContextRenderer.WRITE_PAGE_JS,
+        renderer.comment_pages.return_value)
+    renderer.driver.find_element_by_id.assert_called_once_with('thread')
+
+
+def test_comment_api_failure_falls_back(isolated_renderer):
+    renderer = CommentContextRenderer(IMGUR_AUTH, REDDIT_ARGS,
+                                      isolated_renderer._db,
+                                      Mock(),
+                                      comment_engine='api')
+    renderer.driver = isolated_renderer.driver
+    url = 'https://www.reddit.com/r/sub/comments/abc/title/def/'
+
+    with patch.object(renderer, 'comment_pages',
+                      side_effect=RendererException):
+        with patch.object(Renderer, 'render') as browser_render:
+            renderer.render(url)
+
+    browser_render.assert_called_once_with(url + '?context=9',
+                                           MAX_SCREENSHOT_HEIGHT)
+    with raises(ValueError):
+        CommentContextRenderer(IMGUR_AUTH, REDDIT_ARGS,
+                               isolated_renderer._db,
+                               Mock(),
+                               comment_engine='telepathy')
+
+
+def test_comment_cache_key():
+    renderer = CommentContextRenderer.__new__(CommentContextRenderer)
+    key = renderer.cache_key(
+        'https://www.reddit.com/r/sub/comments/abc/title/def/?context=3')
+    assert key == renderer.cache_key(
+        'https://np.reddit.com/r/sub/comments/abc/other/def')
+    assert key == 'comment:def?context={}'.format(
+        CommentContextRenderer.COMMENT_CONTEXT)
+
+
+def test_tripped_domain_deferred(isolated_renderer, mocked_driver, db,
+                                 submissions_table):
+    submissions_table.insert(submission_as_dict(mock_submission()))
+    db.commit()
+    claimed = isolated_renderer._claim_submissions(db, submissions_table, 1)
+    submission = submissions_table.find_one(id=claimed[0])
+    retry_at = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
+    isolated_renderer.circuit_breaker = Mock()
+    isolated_renderer.circuit_breaker.allows.return_value = False
+    isolated_renderer.circuit_breaker.retry_at.return_value = retry_at
+
+    assert not isolated_renderer._process_submission(submissions_table,
+                                                     submission)
+
+    mocked_driver.get.assert_not_called()
+    row = submissions_table.find_one(id=submission['id'])
+    assert row['bot_screenshot_lock'] == retry_at
+    assert row['bot_screenshot_worker'] is None
+    assert not isolated_renderer._claim_submissions(db, submissions_table, 1)
+
+
+def test_render_failure_recorded(isolated_renderer, db, submissions_table):
+    submission = submission_as_dict(mock_submission())
+    submissions_table.insert(submission)
+    db.commit()
+    isolated_renderer.circuit_breaker = Mock()
+    isolated_renderer.circuit_breaker.allows.return_value = True
+
+    # only the render fails; the pool still starts a browser
+    with patch.object(isolated_renderer, 'render',
+                      side_effect=WebDriverException):
+        with raises(WebDriverException):
+            isolated_renderer._process_submission(submissions_table,
+                                                  submission)
+
+    domain, _, failed = isolated_renderer.circuit_breaker.record.call_args[0]
+    assert domain == urlsplit(submission['url']).hostname
+    assert failed
+
+
+def test_pool_wait_not_recorded(isolated_renderer, db, submissions_table):
+    submission = submission_as_dict(mock_submission())
+    submissions_table.insert(submission)
+    db.commit()
+    isolated_renderer.circuit_breaker = Mock()
+    isolated_renderer.circuit_breaker.allows.return_value = True
+    isolated_renderer.driver_pool = DriverPool(
+        Mock(side_effect=WebDriverException))
+
+    with raises(BrowserUnavailable):
+        isolated_renderer._process_submission(submissions_table, submission)
+
+    isolated_renderer.circuit_breaker.record.assert_not_called()
+
+
 def test_upload(isolated_renderer, mocked_imgur):
     """:func:`upload` behaves as expected."""
-    path = "/some/path.png"
-    isolated_renderer.upload(path)
-    mocked_imgur.upload_from_path.assert_called_once_with(path)
+    assert isolated_renderer.upload(SCREENSHOT_PNG_CONTENT) == (
+        'https://i.imgur.com/404', 'none')
+    method, route, data, anon = mocked_imgur.make_request.call_args[0]
+    assert (method, route, anon) == ('POST', 'upload', True)
+    assert data == {
+        'image': base64.b64encode(SCREENSHOT_PNG_CONTENT),
+        'type': 'base64',
+    }
 
 
-def test_capture(isolated_renderer, mocked_driver):
+def test_capture(isolated_renderer, mocked_driver, tmpdir):
     some_url = "http://example.com"
 
-    with NamedTemporaryFile(delete=False) as temp_file:
-        with patch.object(isolated_renderer, 'render') as mocked_render:
-            mocked_render.return_value = temp_file.name
-            with patch.object(isolated_renderer, 'upload') as mocked_upload:
-                mocked_upload.return_value = 'https://imgur.com/404', 'deadbeef'
+    with patch.object(isolated_renderer, 'render') as mocked_render:
+        mocked_render.return_value = SCREENSHOT_PNG_CONTENT
+        with patch.object(isolated_renderer, 'upload') as mocked_upload:
+            mocked_upload.return_value = 'https://imgur.com/404', 'deadbeef'
+
+            isolated_renderer.capture(some_url)
+            mocked_upload.assert_called_once_with(SCREENSHOT_PNG_CONTENT)
+            assert not tmpdir.listdir()
 
-                assert os.path.exists(temp_file.name)
-                isolated_renderer.capture(some_url)
-                assert not os.path.exists(temp_file.name)
+            isolated_renderer.debug_screenshot_dir = str(tmpdir)
+            isolated_renderer.capture(some_url)
+            saved, = tmpdir.listdir()
+            assert saved.read_binary() == SCREENSHOT_PNG_CONTENT
 
 
 @patch('shotbot.bots.renderer.NamedTemporaryFile', autospec=True)
 @patch('shotbot.bots.renderer.WebDriverWait', autospec=True)
 def test_driver_quits_on_create_exception(mocked_wait, mocked_file,
                                           isolated_renderer, mocked_driver):
-    mocked_wait.return_value.until.side_effect = TimeoutError
+    mocked_wait.return_value.until.side_effect = TimeoutException
     with raises(RendererException):
-        isolated_renderer._create_driver()
+        DriverFactory(isolated_renderer._reddit_args)()
 
     mocked_driver.quit.assert_called_once()
     mocked_file_in_with = mocked_file.return_value.__enter__.return_value
     mocked_file_in_with.write.assert_called_once_with(SCREENSHOT_PNG_CONTENT)
+
+
+def test_driver_pool_reuses_and_recycles():
+    factory = Mock(side_effect=lambda: Mock(name='driver'))
+    pool = DriverPool(factory, max_size=1, max_uses=2)
+
+    with pool.driver() as first:
+        pass
+    with pool.driver() as second:
+        assert second is first
+    first.quit.assert_called_once()
+
+    with pool.driver() as third:
+        assert third is not first
+    assert factory.call_count == 2
+
+
+def test_driver_pool_recycles_on_error():
+    pool = DriverPool(Mock(side_effect=lambda: Mock(name='driver')))
+
+    with raises(ValueError):
+        with pool.driver() as broken:
+            raise ValueError
+
+    broken.quit.assert_called_once()
+    with pool.driver() as driver:
+        assert driver is not broken
+
+
+def test_driver_pool_discards_unhealthy():
+    pool = DriverPool(Mock(side_effect=lambda: Mock(name='driver')))
+    with pool.driver() as unhealthy:
+        pass
+    type(unhealthy).current_url = PropertyMock(side_effect=WebDriverException)
+
+    with pool.driver() as driver:
+        assert driver is not unhealthy
+    unhealthy.quit.assert_called_once()
+
+
+def test_driver_pool_quits_unhealthy_unlocked():
+    pool = DriverPool(Mock(side_effect=lambda: Mock(name='driver')))
+    with pool.driver() as unhealthy:
+        pass
+    type(unhealthy).current_url = PropertyMock(side_effect=WebDriverException)
+
+    locked = []
+
+    def try_lock():
+        locked.append(pool._available.acquire(blocking=False))
+        if locked[-1]:
+            pool._available.release()
+
+    def quit_unlocked():
+        # other checkouts can take the lock meanwhile
+        thread = Thread(target=try_lock)
+        thread.start()
+        thread.join()
+
+    unhealthy.quit.side_effect = quit_unlocked
+    with pool.driver():
+        unhealthy.quit.assert_called_once()
+    assert locked == [True]
+
+
+def test_driver_pool_cleans_up_after_quitting():
+    factory = Mock(side_effect=lambda: Mock(name='driver'))
+    pool = DriverPool(factory, max_uses=1)
+    with pool.driver() as driver:
+        pass
+
+    driver.quit.assert_called_once_with()
+    factory.cleanup.assert_called_once_with(driver)
+
+
+def test_driver_pool_timeout():
+    pool = DriverPool(Mock(side_effect=lambda: Mock(name='driver')))
+    with pool.driver():
+        with raises(BrowserUnavailable):
+            with pool.driver(timeout=0.01):
+                pass
+
+
+def test_driver_pool_resize():
+    pool = DriverPool(Mock(side_effect=lambda: Mock(name='driver')),
+                      max_size=2)
+    with pool.driver() as busy:
+        with pool.driver() as idle:
+            pass
+
+    with pool.driver() as driver:
+        assert driver is busy
+        pool.resize(1)
+        idle.quit.assert_called_once()
+    busy.quit.assert_not_called()
+
+    pool.resize(3)
+    with pool.driver():
+        with pool.driver():
+            with pool.driver():
+                pass
+
+
+def test_driver_factory_options(isolated_renderer, mocked_driver):
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            headless=True,
+                            window_size=[1024, 768],
+                            page_load_strategy='none',
+                            prefs={'network.prefetch-next': True})
+    with patch('shotbot.bots.renderer.webdriver.Firefox') as mocked_firefox:
+        mocked_firefox.return_value = mocked_driver
+        factory()
+
+    _, kwargs = mocked_firefox.call_args
+    assert '-headless' in kwargs['firefox_options'].arguments
+    assert kwargs['firefox_options'].preferences['network.prefetch-next']
+    assert kwargs['capabilities']['pageLoadStrategy'] == 'none'
+    mocked_driver.set_window_size.assert_called_once_with(1024, 768)
+
+
+def test_driver_factory_loads_eagerly_by_default(isolated_renderer):
+    factory = DriverFactory(isolated_renderer._reddit_args)
+    assert factory._capabilities()['pageLoadStrategy'] == 'eager'
+
+
+@patch('shotbot.bots.renderer.RemoteConnection', autospec=True)
+def test_driver_factory_times_out_before_launch(mocked_connection,
+                                                isolated_renderer,
+                                                mocked_driver):
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            command_timeout=60)
+    calls = []
+    mocked_connection.set_timeout.side_effect = calls.append
+    with patch('shotbot.bots.renderer.webdriver.Firefox') as mocked_firefox:
+        mocked_firefox.side_effect = (
+            lambda **_: calls.append('launch') or mocked_driver)
+        factory()
+
+    assert calls[:2] == [60, 'launch']
+
+
+def test_driver_factory_rejects_unknown_strategy():
+    with raises(ValueError):
+        DriverFactory({}, page_load_strategy='eventually')
+
+
+def test_driver_factory_blocking():
+    factory = DriverFactory({},
+                            block_resources=['images', 'fonts'],
+                            proxy=('127.0.0.1', 8118))
+    prefs = factory._firefox_options().preferences
+    assert prefs['permissions.default.image'] == 2
+    assert prefs['gfx.downloadable_fonts.enabled'] is False
+    assert 'media.mp4.enabled' not in prefs
+    assert prefs['network.proxy.ssl'] == '127.0.0.1'
+    assert prefs['network.proxy.ssl_port'] == 8118
+
+    with raises(ValueError):
+        DriverFactory({}, block_resources=['javascript'])
+
+
+def test_session_cookies_saved_privately(tmpdir):
+    path = str(tmpdir.join('sessions', 'reddit.json'))
+    cookies = SessionCookies(path, 'USERNAME')
+    assert cookies.load() is None
+
+    session = {'name': 'reddit_session', 'value': 'abc',
+               'expiry': time.time() + 60}
+    stale = {'name': 'stale', 'value': 'def', 'expiry': time.time() - 60}
+    cookies.save([session, stale])
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert cookies.load() == [session]
+    assert SessionCookies(path, 'SOMEONE_ELSE').load() is None
+    cookies.clear()
+    assert cookies.load() is None
+
+
+def test_session_cookies_expire(tmpdir):
+    path = str(tmpdir.join('reddit.json'))
+    SessionCookies(path, 'USERNAME', datetime.timedelta(0)).save([{
+        'name': 'reddit_session',
+        'value': 'abc'
+    }])
+    assert SessionCookies(path, 'USERNAME').load() is None
+
+
+def test_driver_factory_restores_session(isolated_renderer, mocked_driver,
+                                         tmpdir):
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            session_file=str(tmpdir.join('reddit.json')))
+    session = {'name': 'reddit_session', 'value': 'abc'}
+    factory.session_cookies.save([session])
+
+    with patch.object(factory, '_authenticate_reddit') as authenticate:
+        factory()
+
+    authenticate.assert_not_called()
+    mocked_driver.add_cookie.assert_called_once_with(session)
+
+
+def test_driver_factory_logs_in_if_session_rejected(isolated_renderer,
+                                                    mocked_driver, tmpdir):
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            session_file=str(tmpdir.join('reddit.json')))
+    factory.session_cookies.save([{'name': 'reddit_session', 'value': 'old'}])
+    mocked_driver.find_elements_by_class_name.return_value = []
+    fresh = {'name': 'reddit_session', 'value': 'new'}
+    mocked_driver.get_cookies.return_value = [fresh]
+
+    with patch.object(factory, '_authenticate_reddit') as authenticate:
+        factory()
+
+    authenticate.assert_called_once_with(mocked_driver)
+    mocked_driver.delete_all_cookies.assert_called_once_with()
+    assert factory.session_cookies.load() == [fresh]
+
+
+def test_driver_factory_builds_profile_once(isolated_renderer, mocked_driver,
+                                            tmpdir):
+    profile_dir = tmpdir.join('profile')
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            profile_dir=str(profile_dir))
+    factory.PROFILE_SETTLE_TIME = 0
+
+    with patch.object(factory, '_launch',
+                      return_value=mocked_driver) as launch:
+        factory.build_profile()
+        factory.build_profile()
+
+    launch.assert_called_once()
+    mocked_driver.install_addon.assert_called_once_with(
+        DriverFactory.UBLOCK_XPI_PATH)
+    mocked_driver.quit.assert_called_once_with()
+    assert profile_dir.check(dir=True)
+    assert tmpdir.listdir() == [profile_dir]
+
+
+def test_driver_factory_starts_from_profile_copy(isolated_renderer,
+                                                 mocked_driver, tmpdir):
+    profile_dir = tmpdir.mkdir('profile')
+    profile_dir.join('prefs.js').write('// prefs')
+    profile_dir.join('lock').write('')
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            profile_dir=str(profile_dir))
+
+    with patch('shotbot.bots.renderer.webdriver.Firefox') as mocked_firefox:
+        mocked_firefox.return_value = mocked_driver
+        factory()
+
+    mocked_driver.install_addon.assert_not_called()
+    _, kwargs = mocked_firefox.call_args
+    arguments = kwargs['firefox_options'].arguments
+    clone = arguments[arguments.index('-profile') + 1]
+    assert clone != str(profile_dir)
+    assert os.path.dirname(clone) == str(tmpdir)
+    assert sorted(os.listdir(clone)) == ['prefs.js']
+
+    factory.cleanup(mocked_driver)
+    assert tmpdir.listdir() == [profile_dir]
+
+
+def test_driver_factory_sweeps_stale_clones(isolated_renderer, tmpdir):
+    profile_dir = tmpdir.mkdir('profile')
+    stale = tmpdir.mkdir('{}999999999-abc'.format(DriverFactory.CLONE_PREFIX))
+    live = tmpdir.mkdir('{}{}-abc'.format(DriverFactory.CLONE_PREFIX,
+                                          os.getpid()))
+    factory = DriverFactory(isolated_renderer._reddit_args,
+                            profile_dir=str(profile_dir))
+
+    factory._sweep_clones()
+
+    assert sorted(tmpdir.listdir()) == sorted([profile_dir, live])
+    assert not stale.check()
@@ -0,0 +1,138 @@
+"""Validate that :class:`Uploader` behaves correctly."""
+import base64
+import datetime
+from threading import Event
+
+import requests
+from imgurpython.helpers.error import ImgurClientRateLimitError
+from mock import Mock
+from pytest import fixture
+
+from helpers import SCREENSHOT_PNG_CONTENT, mock_submission
+from shotbot.bots import Uploader
+from shotbot.utils import submission_as_dict
+
+WORKER_ID = 'some-renderer'
+
+
+@fixture
+def isolated_uploader(mocked_imgur, temporary_sqlite_uri):
+    """Return an Uploader with mocked dependencies."""
+    kill_switch = Mock()
+    kill_switch.is_set.return_value = False
+    imgur_auth = {'client_id': '', 'client_secret': ''}
+    yield Uploader(imgur_auth, temporary_sqlite_uri, kill_switch, queue_size=1)
+
+
+@fixture
+def claimed_submission(db, submissions_table):
+    submission = submission_as_dict(mock_submission())
+    submission['bot_screenshot_lock'] = (datetime.datetime.utcnow() +
+                                         datetime.timedelta(minutes=5))
+    submission['bot_screenshot_worker'] = WORKER_ID
+    submissions_table.insert(submission)
+    db.commit()
+    yield submission
+
+
+def test_upload_stores_screenshot(isolated_uploader, mocked_imgur,
+                                  submissions_table, claimed_submission):
+    isolated_uploader._new_screenshots = Event()
+
+    isolated_uploader._process_upload(claimed_submission['id'], WORKER_ID,
+                                      SCREENSHOT_PNG_CONTENT)
+
+    row = submissions_table.find_one(id=claimed_submission['id'])
+    assert row['bot_screenshot_url'] == 'https://i.imgur.com/404'
+    assert row['bot_screenshot_deletehash'] == 'none'
+    assert row['bot_screenshot_at']
+    assert isolated_uploader.uploaded == 1
+    assert isolated_uploader._new_screenshots.is_set()
+
+
+def test_failed_upload_keeps_claim(isolated_uploader, mocked_imgur,
+                                   submissions_table, claimed_submission):
+    mocked_imgur.make_request.side_effect = requests.ConnectionError
+
+    isolated_uploader._process_upload(claimed_submission['id'], WORKER_ID,
+                                      SCREENSHOT_PNG_CONTENT)
+
+    row = submissions_table.find_one(id=claimed_submission['id'])
+    assert row['bot_screenshot_url'] is None
+    assert row['bot_screenshot_lock'] == claimed_submission[
+        'bot_screenshot_lock']
+    assert row['bot_screenshot_worker'] == WORKER_ID
+    assert row['bot_screenshot_failures'] == 1
+    assert isolated_uploader.failed == 1
+
+
+def test_rate_limited_upload_deferred(isolated_uploader, mocked_imgur,
+                                      submissions_table, claimed_submission):
+    mocked_imgur.make_request.side_effect = ImgurClientRateLimitError
+
+    isolated_uploader._process_upload(claimed_submission['id'], WORKER_ID,
+                                      SCREENSHOT_PNG_CONTENT)
+
+    row = submissions_table.find_one(id=claimed_submission['id'])
+    assert row['bot_screenshot_worker'] is None
+    # not claimable again until the rate limit's lifted
+    assert row['bot_screenshot_lock'] >= (datetime.datetime.utcnow() +
+                                          Uploader.RATE_LIMIT_DELAY -
+                                          datetime.timedelta(minutes=1))
+    assert not row['bot_screenshot_failures']
+
+
+def test_submit_is_bounded(isolated_uploader):
+    assert isolated_uploader.submit(1, WORKER_ID, SCREENSHOT_PNG_CONTENT)
+    assert isolated_uploader.queue_depth == 1
+
+    isolated_uploader.WAIT_INTERVAL = 0.01
+    isolated_uploader._kill.is_set.side_effect = [False, True]
+    assert not isolated_uploader.submit(2, WORKER_ID, SCREENSHOT_PNG_CONTENT)
+    assert isolated_uploader.queue_depth == 1
+
+
+def test_run_drains_queue_when_killed(isolated_uploader, mocked_imgur,
+                                      submissions_table, claimed_submission):
+    isolated_uploader.submit(claimed_submission['id'], WORKER_ID,
+                             SCREENSHOT_PNG_CONTENT)
+    isolated_uploader.WAIT_INTERVAL = 0.01
+    isolated_uploader._kill.is_set.return_value = True
+
+    isolated_uploader.run()
+
+    assert isolated_uploader.queue_depth == 0
+    row = submissions_table.find_one(id=claimed_submission['id'])
+    assert row['bot_screenshot_url']
+
+
+def test_upload_optimized(isolated_uploader, mocked_imgur, claimed_submission):
+    isolated_uploader.optimizer = Mock(return_value=b'smaller')
+
+    isolated_uploader._process_upload(claimed_submission['id'], WORKER_ID,
+                                      SCREENSHOT_PNG_CONTENT)
+
+    isolated_uploader.optimizer.assert_called_once_with(SCREENSHOT_PNG_CONTENT)
+    data = mocked_imgur.make_request.call_args[0][2]
+    assert data['image'] == base64.b64encode(b'smaller')
+
+
+def test_unexpected_error_counted_and_keeps_working(
+        isolated_uploader, mocked_imgur, submissions_table,
+        claimed_submission):
+    isolated_uploader.optimizer = Mock(side_effect=[RuntimeError, b'fine'])
+    isolated_uploader.workers = 1
+    isolated_uploader._queue.maxsize = 2
+    for _ in range(2):
+        isolated_uploader.submit(claimed_submission['id'], WORKER_ID,
+                                 SCREENSHOT_PNG_CONTENT)
+    isolated_uploader.WAIT_INTERVAL = 0.01
+    isolated_uploader._kill.is_set.return_value = True
+
+    isolated_uploader.run()
+
+    assert isolated_uploader.queue_depth == 0
+    assert isolated_uploader.failed == 1
+    assert isolated_uploader.uploaded == 1
+    row = submissions_table.find_one(id=claimed_submission['id'])
+    assert row['bot_screenshot_failures'] == 1
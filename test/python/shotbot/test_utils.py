@@ -1,6 +1,15 @@
+import datetime
+import json
+from threading import Thread
+
 import pytest
+from mock import patch
 
-from shotbot.utils import base36_decode, base36_encode, seq_encode
+from helpers import mock_submission
+from shotbot.utils import (EXTRA_FIELDS_COLUMN, SUBMISSION_FIELDS,
+                           ScreenshotCache, SeenIndex, base36_decode,
+                           base36_encode, canonical_url, connect_db,
+                           release_connection, seq_encode, submission_as_dict)
 
 BASE36_SAMPLES = {
     0: '0',
@@ -30,3 +39,86 @@ def test_base36_encode(encoded, number):
 def test_seq_encode(sequence, format_char):
     for i in range(1000):
         assert seq_encode(i, sequence) == format(i, format_char)
+
+
+def test_seen_index_evicts_least_recently_used():
+    index = SeenIndex(2)
+    index.add(1)
+    index.add(2)
+    assert 1 in index
+    index.add(3)
+    assert 2 not in index
+    assert 1 in index
+    assert 3 in index
+    assert len(index) == 2
+    assert (index.hits, index.misses) == (3, 1)
+
+
+@patch('shotbot.utils.time.time')
+def test_screenshot_cache_expires_and_evicts(mocked_time):
+    mocked_time.return_value = 1000
+    cache = ScreenshotCache(maxsize=2, ttl=datetime.timedelta(seconds=60))
+    cache.put('a', 'https://i.imgur.com/a', 'hash-a')
+    cache.put('b', 'https://i.imgur.com/b', 'hash-b')
+    assert cache.get('a') == ('https://i.imgur.com/a', 'hash-a')
+    cache.put('c', 'https://i.imgur.com/c', 'hash-c')
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    mocked_time.return_value = 1061
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+@pytest.mark.parametrize('url', [
+    'HTTPS://Example.com:443/some/page/?b=2&a=1#top',
+    'https://example.com/some/page?a=1&b=2',
+])
+def test_canonical_url(url):
+    assert canonical_url(url) == 'https://example.com/some/page?a=1&b=2'
+
+
+def test_connect_db_shares_connected_database(db):
+    assert connect_db(db) is db
+
+
+def test_connect_db_sqlite_threads_own_connections(temporary_sqlite_uri):
+    db = connect_db(temporary_sqlite_uri)
+    db.query('SELECT 1')
+    results = []
+    thread = Thread(target=lambda: results.extend(db.query('SELECT 1 AS one')))
+    thread.start()
+    thread.join()
+    assert [row['one'] for row in results] == [1]
+
+
+def test_release_connection(db):
+    conn = db.executable
+    release_connection(db)
+    assert conn.closed
+    assert db.executable is not conn
+    release_connection(db)
+    release_connection(db)
+
+
+def test_submission_as_dict_projects_declared_fields():
+    submission = mock_submission()
+    submission.some_new_reddit_field = {'complex': ['value']}
+
+    data = submission_as_dict(submission)
+
+    assert set(data) == set(SUBMISSION_FIELDS) | {'id'}
+    assert data['id'] == base36_decode(submission.id)
+    assert data['title'] == submission.title
+
+
+def test_submission_as_dict_extra_fields():
+    submission = mock_submission()
+    submission.some_new_reddit_field = {'complex': ['value']}
+
+    data = submission_as_dict(submission, extra_fields=True)
+
+    extras = json.loads(data[EXTRA_FIELDS_COLUMN])
+    assert extras['some_new_reddit_field'] == {'complex': ['value']}
+    assert 'title' not in extras
+    assert 'comments' not in extras
@@ -1,11 +1,14 @@
 """Validate that :class:`Watcher` behaves correctly."""
 from threading import Event
 
-from mock import patch
+import sqlalchemy.types
+from sqlalchemy import event
+from mock import Mock, patch
 from pytest import fixture
 
 from helpers import mock_submission
-from shotbot.bots import Watcher
+from shotbot.bots import MultiWatcher, Watcher
+from shotbot.bots.watcher import PollSchedule
 from shotbot.utils import base36_decode
 
 SUBREDDIT = 'fakesub'
@@ -62,3 +65,210 @@ def test_process_submissions_skips_duplicates(isolated_watcher,
 
     for submission in submissions:
         assert submissions_table.count(id=base36_decode(submission.id)) == 1
+
+
+def test_multi_watcher_combine():
+    names = ['a' * 10, 'b' * 10, 'c' * 10, 'd' * 30]
+    assert MultiWatcher.combine(names, 21) == [
+        'a' * 10 + '+' + 'b' * 10, 'c' * 10, 'd' * 30
+    ]
+    assert MultiWatcher.combine(names, 1000) == ['+'.join(names)]
+
+
+def test_multi_watcher_routes_filters(mocked_reddit, submissions_table,
+                                      temporary_sqlite_uri):
+    """MultiWatcher applies each submission's own subreddit's filter."""
+    submission = mock_submission()
+    filters = {'FAKE_SUBREDDIT': Mock(return_value=True), 'other': Mock()}
+    watchbot = MultiWatcher({}, temporary_sqlite_uri, filters, Event())
+    mocked_reddit.subreddit.assert_called_once_with('FAKE_SUBREDDIT+other')
+    watchbot.subreddits[0].stream.submissions.return_value = [submission]
+
+    watchbot._process_submissions()
+
+    filters['FAKE_SUBREDDIT'].assert_called_once_with(submission)
+    filters['other'].assert_not_called()
+    assert submissions_table.find_one(id=base36_decode(submission.id))
+
+
+def test_seen_index_skips_db_lookup(isolated_watcher, submissions_table):
+    """Duplicates already in the seen index never hit the database."""
+    subreddit = isolated_watcher.subreddit
+    submissions = [mock_submission() for _ in range(10)]
+    subreddit.stream.submissions.return_value = submissions * 3
+
+    isolated_watcher._process_submissions()
+
+    assert isolated_watcher.seen_ids.hits == 20
+    assert isolated_watcher.seen_ids.misses == 10
+
+
+def test_seen_index_seeded_from_db(isolated_watcher, db, submissions_table):
+    submissions_table.insert_many([{'id': _id} for _id in range(1, 6)])
+    db.commit()
+    isolated_watcher.subreddit.stream.submissions.return_value = []
+
+    isolated_watcher._process_submissions()
+
+    assert len(isolated_watcher.seen_ids) == 5
+    assert 3 in isolated_watcher.seen_ids
+
+
+def test_pending_submissions_flushed_on_kill(isolated_watcher,
+                                             submissions_table):
+    """Buffered submissions are written when the kill switch is thrown."""
+    submissions = [mock_submission() for _ in range(10)]
+
+    def _stream(**_):
+        for i, submission in enumerate(submissions):
+            if i == 5:
+                isolated_watcher._kill.set()
+            yield submission
+
+    isolated_watcher.subreddit.stream.submissions.side_effect = _stream
+
+    isolated_watcher._process_submissions()
+
+    assert submissions_table.count() == 5
+    for submission in submissions[:5]:
+        assert submissions_table.find_one(id=base36_decode(submission.id))
+
+
+def test_pending_submissions_flushed_in_batches(isolated_watcher,
+                                                submissions_table):
+    subreddit = isolated_watcher.subreddit
+    subreddit.stream.submissions.return_value = [
+        mock_submission() for _ in range(25)
+    ]
+    batches = []
+
+    def record_insert(conn, cursor, statement, parameters, context,
+                      executemany):  # pylint: disable=unused-argument
+        if statement.startswith('INSERT INTO submissions'):
+            batches.append(len(parameters) if executemany else 1)
+
+    engine = isolated_watcher._db.engine
+    event.listen(engine, 'before_cursor_execute', record_insert)
+    try:
+        with patch.object(isolated_watcher, 'INSERT_BATCH_SIZE', 10):
+            isolated_watcher._process_submissions()
+    finally:
+        event.remove(engine, 'before_cursor_execute', record_insert)
+
+    assert batches == [10, 10, 5]
+    assert submissions_table.count() == 25
+
+
+def test_cursor_saved(isolated_watcher, db, submissions_table):
+    submissions = [mock_submission() for _ in range(10)]
+    newest = max(submissions, key=lambda submission: submission.created_utc)
+    isolated_watcher.subreddit.stream.submissions.return_value = submissions
+
+    isolated_watcher._process_submissions()
+
+    cursor = db[Watcher.CURSOR_TABLE].find_one(listing=SUBREDDIT)
+    assert cursor['fullname'] == newest.fullname
+
+
+def test_catch_up_from_cursor(isolated_watcher, db, submissions_table):
+    """Watcher pages forward from a saved cursor before streaming."""
+    db.create_table(Watcher.CURSOR_TABLE, primary_id='listing',
+                    primary_type=sqlalchemy.types.String(length=512)).insert({
+                        'listing': SUBREDDIT,
+                        'fullname': 't3_cursor',
+                        'created_utc': 0.0,
+                    })
+    db.commit()
+    missed = [mock_submission() for _ in range(3)]
+    subreddit = isolated_watcher.subreddit
+    subreddit.new.return_value = missed
+    subreddit.stream.submissions.return_value = []
+
+    isolated_watcher._process_submissions()
+
+    subreddit.new.assert_called_once_with(
+        limit=Watcher.CATCH_UP_PAGE_SIZE, params={'before': 't3_cursor'})
+    for submission in missed:
+        assert submissions_table.find_one(id=base36_decode(submission.id))
+
+
+def test_catch_up_past_deleted_cursor(isolated_watcher, db,
+                                      submissions_table):
+    """Watcher scans back by time when the cursor's submission is gone."""
+    older, missed = mock_submission(), [mock_submission() for _ in range(3)]
+    older.created_utc = 0.0
+    for submission in missed:
+        submission.created_utc = 100.0
+    db.create_table(Watcher.CURSOR_TABLE, primary_id='listing',
+                    primary_type=sqlalchemy.types.String(length=512)).insert({
+                        'listing': SUBREDDIT,
+                        'fullname': 't3_deleted',
+                        'created_utc': 50.0,
+                    })
+    db.commit()
+    subreddit = isolated_watcher.subreddit
+    subreddit.new.side_effect = [[], missed + [older]]
+    subreddit.stream.submissions.return_value = []
+
+    isolated_watcher._process_submissions()
+
+    subreddit.new.assert_called_with(limit=Watcher.CATCH_UP_PAGE_SIZE,
+                                     params={})
+    for submission in missed:
+        assert submissions_table.find_one(id=base36_decode(submission.id))
+    assert not submissions_table.find_one(id=base36_decode(older.id))
+
+
+def test_filtered_submissions_not_stored(isolated_watcher, submissions_table):
+    """Filtered submissions never reach the seen index or the database."""
+    submissions = [mock_submission() for _ in range(10)]
+    isolated_watcher.subreddit.stream.submissions.return_value = submissions
+    isolated_watcher.filter = Mock(return_value=False)
+
+    with patch('shotbot.bots.watcher.submission_as_dict') as mocked_as_dict:
+        isolated_watcher._process_submissions()
+        mocked_as_dict.assert_not_called()
+
+    assert submissions_table.count() == 0
+    assert isolated_watcher.seen_ids.misses == 0
+
+
+def test_poll_schedule_adapts_to_rate():
+    schedule = PollSchedule(10, 300, smoothing=1)
+    schedule.polled(100, now=0)  # replayed listing; rate unknown
+    assert schedule.interval == 10
+    assert not schedule.due(now=9)
+    assert schedule.due(now=10)
+
+    schedule.polled(3, now=300)  # one every 100s
+    assert schedule.interval == 100
+    schedule.polled(60, now=400)  # faster than the minimum
+    assert schedule.interval == 10
+    schedule.polled(0, now=410)
+    assert schedule.interval == 300
+
+
+def test_watcher_skips_listings_not_due(isolated_watcher, submissions_table):
+    stream = isolated_watcher.subreddit.stream.submissions
+    stream.return_value = [mock_submission(), None]
+
+    isolated_watcher._process_submissions()
+    isolated_watcher._process_submissions()
+
+    stream.assert_called_once_with(pause_after=0)
+    assert isolated_watcher._seconds_until_due() > 0
+
+
+def test_new_submissions_signalled(isolated_watcher, submissions_table):
+    isolated_watcher._new_submissions = Event()
+    isolated_watcher.subreddit.stream.submissions.return_value = []
+    isolated_watcher._process_submissions()
+    assert not isolated_watcher._new_submissions.is_set()
+
+    isolated_watcher._streams.clear()
+    isolated_watcher._schedules.clear()
+    isolated_watcher.subreddit.stream.submissions.return_value = [
+        mock_submission()
+    ]
+    isolated_watcher._process_submissions()
+    assert isolated_watcher._new_submissions.is_set()
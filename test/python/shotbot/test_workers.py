@@ -0,0 +1,108 @@
+"""Validate that :class:`RendererSupervisor` behaves correctly."""
+import multiprocessing
+
+from mock import Mock, patch
+from pytest import fixture, raises
+
+from shotbot.bots.workers import STATS, RendererSupervisor, _publish_stats
+from shotbot.exceptions import RendererException
+
+
+@fixture
+def mocked_process():
+    with patch('shotbot.bots.workers.CONTEXT') as context:
+        context.Process.return_value.pid = 1234
+        context.Event.side_effect = lambda: Mock()
+        yield context.Process
+
+
+@fixture
+def supervisor(mocked_process):
+    kill_switch = Mock()
+    kill_switch.wait.return_value = False
+    supervisor = RendererSupervisor(2, {},
+                                    kill_switch,
+                                    Mock(),
+                                    Mock(),
+                                    max_restarts=1)
+    supervisor.RESTART_DELAY = 0
+    yield supervisor
+
+
+def test_restarts_dead_workers(supervisor, mocked_process):
+    supervisor._reconcile()
+
+    supervisor._restart(0)
+
+    assert mocked_process.call_count == 3
+    assert mocked_process.return_value.start.call_count == 3
+    assert supervisor.restarts == [1, 0]
+    with raises(RendererException):
+        supervisor._restart(0)
+
+
+def test_stable_workers_restart_count_resets(supervisor):
+    supervisor._reconcile()
+    supervisor._restart(0)
+    supervisor._started_at[0] -= supervisor.STABLE_TIME
+
+    supervisor._restart(0)
+    assert supervisor.restarts[0] == 1
+
+
+def test_resize_starts_and_stops_workers(supervisor, mocked_process):
+    supervisor._reconcile()
+    supervisor.resize(3)
+    supervisor._reconcile()
+    assert mocked_process.call_count == 3
+    assert supervisor.restarts == [0, 0, 0]
+
+    stops = list(supervisor._stops)
+    supervisor.resize(1)
+    supervisor._reconcile()
+    assert len(supervisor._workers) == 1
+    stops[0].set.assert_not_called()
+    stops[1].set.assert_called_once_with()
+    stops[2].set.assert_called_once_with()
+    supervisor._new_submissions.set.assert_called_with()
+
+
+def test_shutdown_terminates_stragglers(supervisor, mocked_process):
+    supervisor._reconcile()
+    supervisor.SHUTDOWN_TIMEOUT = 0
+    mocked_process.return_value.is_alive.return_value = True
+
+    supervisor._shutdown()
+
+    supervisor._kill.set.assert_called_once_with()
+    assert mocked_process.return_value.terminate.call_count == 2
+
+
+def test_stats_gathered_from_workers(supervisor, mocked_process):
+    assert supervisor.stats()['renderer_utilization'] == 0.0
+    supervisor._reconcile()
+    supervisor._stats = [
+        multiprocessing.Array('d', [0.5, 2, 0.25, 1]),
+        multiprocessing.Array('d', [1.0, 3, 0.75, 2]),
+    ]
+
+    assert supervisor.stats() == {
+        'renderer_utilization': 0.75,
+        'upload_queue_depth': 5,
+        'uploader_utilization': 0.5,
+        'open_circuits': 3,
+    }
+
+
+def test_worker_publishes_stats():
+    stats = multiprocessing.Array('d', len(STATS))
+    renderer = Mock(utilization=0.5)
+    uploader = Mock(queue_depth=2, utilization=0.25)
+    circuit_breaker = Mock()
+    circuit_breaker.open_domains.return_value = ['example.com']
+    stop = Mock()
+    stop.wait.return_value = True
+
+    _publish_stats(stats, renderer, uploader, circuit_breaker, stop)
+
+    assert list(stats) == [0.5, 2, 0.25, 1]